@@ -6,6 +6,7 @@ import time
 import click
 
 from chatchat.server.knowledge_base.migrate import (
+    convert_faiss_docstore,
     create_tables,
     folder2db,
     import_from_db,
@@ -24,8 +25,8 @@ def worker(args: dict):
     start_time = datetime.now()
 
     try:
-        if args.get("create_tables"):
-            create_tables()  # confirm tables exist
+        if args.get("create_tables") or args.get("update_in_db") or args.get("increment") or args.get("sync"):
+            create_tables()  # confirm tables exist, and add columns introduced by upgrades
 
         if args.get("clear_tables"):
             reset_tables()
@@ -35,27 +36,42 @@ def worker(args: dict):
             create_tables()
             print("recreating all vector stores")
             folder2db(
-                kb_names=args.get("kb_name"), mode="recreate_vs", embed_model=args.get("embed_model")
+                kb_names=args.get("kb_name"), mode="recreate_vs", embed_model=args.get("embed_model"),
+                parse_executor=args.get("parse_executor"), parse_workers=args.get("parse_workers"),
             )
         elif args.get("import_db"):
             import_from_db(args.get("import_db"))
         elif args.get("update_in_db"):
             folder2db(
-                kb_names=args.get("kb_name"), mode="update_in_db", embed_model=args.get("embed_model")
+                kb_names=args.get("kb_name"), mode="update_in_db", embed_model=args.get("embed_model"),
+                parse_executor=args.get("parse_executor"), parse_workers=args.get("parse_workers"),
             )
         elif args.get("increment"):
             folder2db(
-                kb_names=args.get("kb_name"), mode="increment", embed_model=args.get("embed_model")
+                kb_names=args.get("kb_name"), mode="increment", embed_model=args.get("embed_model"),
+                parse_executor=args.get("parse_executor"), parse_workers=args.get("parse_workers"),
+            )
+        elif args.get("sync"):
+            folder2db(
+                kb_names=args.get("kb_name"), mode="sync", embed_model=args.get("embed_model"),
+                parse_executor=args.get("parse_executor"), parse_workers=args.get("parse_workers"),
             )
         elif args.get("prune_db"):
             prune_db_docs(args.get("kb_name"))
         elif args.get("prune_folder"):
             prune_folder_files(args.get("kb_name"))
+        elif args.get("convert_docstore"):
+            convert_faiss_docstore(args.get("kb_name"), args.get("convert_docstore"))
 
         end_time = datetime.now()
         print(f"总计用时\t：{end_time-start_time}\n")
     except Exception as e:
         logger.exception(e)
+    finally:
+        # 子进程退出时不会执行 atexit，需要主动保存延迟写入的向量库
+        from chatchat.server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool
+
+        kb_faiss_pool.flush_all()
 
 
 @click.command(help="知识库相关功能")
@@ -104,6 +120,17 @@ def worker(args: dict):
             """
         ),
 )
+@click.option(
+        "-s",
+        "--sync",
+        is_flag=True,
+        help=(
+            """
+            sync vector store with local folder by file content hash.
+            only changed chunks of modified files are re-embedded, deleted files are removed from vector store and database.
+            """
+        ),
+)
 @click.option(
         "--prune-db",
         is_flag=True,
@@ -140,10 +167,33 @@ def worker(args: dict):
         default=get_default_embedding(),
         help=("specify embeddings model."),
 )
+@click.option(
+        "--parse-executor",
+        type=click.Choice(["thread", "process"]),
+        default=None,
+        help=("parse files in threads or processes. default is FILE_PARSE_EXECUTOR in kb_settings.yaml."),
+)
+@click.option(
+        "--parse-workers",
+        type=int,
+        default=0,
+        help=("number of processes to parse files when --parse-executor=process. default is cpu count."),
+)
 @click.option(
         "--import-db",
         help="import tables from specified sqlite database"
 )
+@click.option(
+        "--convert-docstore",
+        type=click.Choice(["sqlite", "memory"]),
+        help=(
+            """
+            convert docstore of existed faiss vector stores without re-embedding.
+            sqlite: move documents from index.pkl to docstore.db, which is loaded lazily and suitable for large knowledge bases.
+            memory: convert back to in-memory docstore.
+            """
+        ),
+)
 def main(**kwds):
     p = mp.Process(target=worker, args=(kwds,), daemon=True)
     p.start()
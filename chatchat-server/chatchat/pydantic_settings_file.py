@@ -16,7 +16,7 @@ from ruamel.yaml.comments import CommentedBase
 
 __all__ = ["YamlTemplate", "MyBaseModel", "BaseFileSettings", "Field",
            "SubModelComment", "SettingsConfigDict",
-           "computed_field", "cached_property", "settings_property"]
+           "computed_field", "cached_property", "settings_property", "settings_version"]
 
 
 def import_yaml() -> ruamel.yaml.YAML:
@@ -241,6 +241,13 @@ def _lazy_load_key(settings: BaseSettings):
 _T = t.TypeVar("_T", bound=BaseFileSettings)
 
 
+def settings_version(*settings: BaseSettings) -> t.Tuple:
+    """
+    the version of settings, changes when any of their configuration files changed
+    """
+    return tuple(_lazy_load_key(s) for s in settings)
+
+
 @cached(max_size=1, algorithm=CachingAlgorithmFlag.LRU, thread_safe=True, custom_key_maker=_lazy_load_key)
 def _cached_settings(settings: _T) -> _T:
     """
@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from typing import Dict, Literal, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.memory import MemorySaver
+
+from chatchat.settings import Settings
+from chatchat.server.utils import BaseResponse, build_logger, get_graph_memory_type
+
+logger = build_logger()
+
+
+class BoundedMemorySaver(MemorySaver):
+    """
+    保留有限数量对话 (thread) 的 MemorySaver.
+    整个进程共用一个实例, 多轮对话之间可以取回历史消息; 超过 max_threads 后淘汰最久未使用的对话, 避免内存无限增长.
+    """
+
+    def __init__(self, max_threads: int = 1000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_threads = max_threads
+        self._threads: "OrderedDict[str, None]" = OrderedDict()
+        self._threads_lock = threading.Lock()
+
+    def _touch(self, config: RunnableConfig):
+        thread_id = config.get("configurable", {}).get("thread_id")
+        if thread_id is None:
+            return
+        with self._threads_lock:
+            self._threads[thread_id] = None
+            self._threads.move_to_end(thread_id)
+            evicted = []
+            while self.max_threads > 0 and len(self._threads) > self.max_threads:
+                evicted.append(self._threads.popitem(last=False)[0])
+        for thread_id in evicted:
+            self._evict(thread_id)
+
+    def _evict(self, thread_id: str):
+        if hasattr(super(), "delete_thread"):
+            super().delete_thread(thread_id)
+            return
+        self.storage.pop(thread_id, None)
+        for key in [k for k in self.writes if k[0] == thread_id]:
+            self.writes.pop(key, None)
+        blobs = getattr(self, "blobs", {})
+        for key in [k for k in blobs if k[0] == thread_id]:
+            blobs.pop(key, None)
+
+    def get_tuple(self, config: RunnableConfig):
+        self._touch(config)
+        return super().get_tuple(config)
+
+    def put(self, config: RunnableConfig, *args, **kwargs) -> RunnableConfig:
+        self._touch(config)
+        return super().put(config, *args, **kwargs)
+
+    def put_writes(self, config: RunnableConfig, *args, **kwargs) -> None:
+        self._touch(config)
+        return super().put_writes(config, *args, **kwargs)
+
+    @property
+    def threads_count(self) -> int:
+        return len(self._threads)
+
+
+class CheckpointerManager:
+    """
+    管理整个服务共用的 checkpointer, 在 FastAPI lifespan 中创建和关闭:
+    - memory: 进程内唯一的 BoundedMemorySaver
+    - sqlite: 一个长期打开的 AsyncSqliteSaver 连接
+    - postgres: 一个连接池, 大小由 POSTGRESQL_GRAPH_CONNECTION_POOLS_MIN_SIZE / MAX_SIZE 配置
+    数据表只在启动时创建一次 (setup), 不再在每次对话请求中执行.
+    """
+
+    def __init__(self):
+        self.memory_type: Optional[Literal["memory", "sqlite", "postgres"]] = None
+        self._checkpointer: Optional[BaseCheckpointSaver] = None
+        self._pool = None
+        self._stack: Optional[AsyncExitStack] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def started(self) -> bool:
+        return self._checkpointer is not None
+
+    async def start(self) -> BaseCheckpointSaver:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._checkpointer is not None:
+                return self._checkpointer
+            memory_type = get_graph_memory_type()
+            stack = AsyncExitStack()
+            try:
+                if memory_type == "memory":
+                    checkpointer = BoundedMemorySaver(
+                        max_threads=Settings.tool_settings.GRAPH_MEMORY_MAX_THREADS
+                    )
+                elif memory_type == "sqlite":
+                    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+                    checkpointer = await stack.enter_async_context(
+                        AsyncSqliteSaver.from_conn_string(Settings.basic_settings.SQLITE_GRAPH_DATABASE_URI)
+                    )
+                    await checkpointer.setup()
+                else:
+                    from psycopg_pool import AsyncConnectionPool
+                    from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+
+                    self._pool = await stack.enter_async_context(
+                        AsyncConnectionPool(
+                            conninfo=Settings.basic_settings.POSTGRESQL_GRAPH_DATABASE_URI,
+                            min_size=Settings.basic_settings.POSTGRESQL_GRAPH_CONNECTION_POOLS_MIN_SIZE,
+                            max_size=Settings.basic_settings.POSTGRESQL_GRAPH_CONNECTION_POOLS_MAX_SIZE,
+                            kwargs=Settings.basic_settings.POSTGRESQL_GRAPH_CONNECTION_POOLS_KWARGS,
+                            open=False,
+                        )
+                    )
+                    checkpointer = AsyncPostgresSaver(self._pool)
+                    await checkpointer.setup()
+            except Exception as e:
+                logger.error(f"创建 {memory_type} checkpointer 失败: {e}")
+                self._pool = None
+                await stack.aclose()
+                raise
+            self.memory_type = memory_type
+            self._stack = stack
+            self._checkpointer = checkpointer
+            logger.info(f"已创建 {memory_type} checkpointer")
+            return checkpointer
+
+    async def get(self) -> BaseCheckpointSaver:
+        """
+        获取共用的 checkpointer. 未在 lifespan 中启动 (如直接运行 server_app) 或启动时创建失败的,
+        在使用时创建, 失败时下次请求再重试
+        """
+        if self._checkpointer is not None:
+            return self._checkpointer
+        return await self.start()
+
+    async def health(self) -> Dict:
+        if self._checkpointer is None:
+            return {"status": "not_started", "memory_type": get_graph_memory_type()}
+        start = time.perf_counter()
+        info = {"memory_type": self.memory_type}
+        try:
+            if self.memory_type == "memory":
+                info["threads"] = self._checkpointer.threads_count
+                info["max_threads"] = self._checkpointer.max_threads
+            elif self.memory_type == "sqlite":
+                async with self._checkpointer.conn.execute("SELECT 1") as cursor:
+                    await cursor.fetchone()
+            else:
+                async with self._pool.connection() as conn:
+                    await conn.execute("SELECT 1")
+                info["pool"] = self._pool.get_stats()
+            info["status"] = "ok"
+        except Exception as e:
+            logger.error(f"checkpointer 健康检查失败: {e}")
+            info.update(status="error", error=f"{e.__class__.__name__}: {e}")
+        info["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return info
+
+    async def close(self):
+        if self._stack is not None:
+            try:
+                await self._stack.aclose()
+                logger.info(f"已关闭 {self.memory_type} checkpointer")
+            except Exception as e:
+                logger.error(f"关闭 checkpointer 失败: {e}")
+        self._stack = None
+        self._pool = None
+        self._checkpointer = None
+
+
+checkpointer_manager = CheckpointerManager()
+
+
+async def get_checkpointer_health() -> BaseResponse:
+    """
+    检查对话历史 checkpointer 是否可用, 返回连接池状态等信息
+    """
+    info = await checkpointer_manager.health()
+    if info["status"] == "error":
+        return BaseResponse(code=500, msg=info["error"], data=info)
+    return BaseResponse(data=info)
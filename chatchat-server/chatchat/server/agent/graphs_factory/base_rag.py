@@ -8,6 +8,7 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.tools import BaseTool
 from langchain_core.messages import BaseMessage, ToolMessage, HumanMessage, filter_messages, AIMessage
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import END, StateGraph, START
 from langgraph.graph.state import CompiledStateGraph
 from langgraph.prebuilt import ToolNode, tools_condition
@@ -59,13 +60,14 @@ class BaseRagGraph(Graph):
         self.top_k = top_k
         self.score_threshold = score_threshold
 
-    async def async_history_manager(self, state: BaseRagState) -> BaseRagState:
+    async def async_history_manager(self, state: BaseRagState, config: RunnableConfig) -> BaseRagState:
         """
         目的: 1. 节约成本; 2. 初始化 state
         做法: 给 llm 传递历史上下文时, 把 AIMessage(Function Call) 和 ToolMessage 过滤, 只保留 history_len 长度的 AIMessage
         和 HumanMessage 作为历史上下文.
         todo: 目前 history_len 直接截取了 messages 长度, 希望通过 对话轮数 来限制.
         todo: 原因: 一轮对话会追加数个 message, 但是目前没有从 snapshot(graph.get_state) 中找到很好的办法来获取一轮对话.
+        知识库参数优先从 config["configurable"] 中获取, 已编译的 graph 可以在不同请求间复用.
         """
         try:
             filtered_messages = []
@@ -73,11 +75,12 @@ class BaseRagGraph(Graph):
                 if isinstance(message, AIMessage) and message.tool_calls:
                     continue
                 filtered_messages.append(message)
+            configurable = (config or {}).get("configurable", {})
             state["history"] = filtered_messages[-self.history_len:]
             state["question"] = state["history"][-1].content
-            state["knowledge_base"] = self.knowledge_base
-            state["top_k"] = self.top_k
-            state["score_threshold"] = self.score_threshold
+            state["knowledge_base"] = configurable.get("knowledge_base", self.knowledge_base)
+            state["top_k"] = configurable.get("top_k", self.top_k)
+            state["score_threshold"] = configurable.get("score_threshold", self.score_threshold)
             return state
         except Exception as e:
             raise Exception(f"Filtering messages error: {e}")
@@ -0,0 +1,155 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List
+
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.graph.state import CompiledStateGraph
+
+from chatchat.settings import Settings
+from chatchat.server.utils import (
+    build_logger,
+    create_agent_models,
+    get_graph_memory_type,
+    get_tool,
+    get_tools_generation,
+)
+from .graphs_registry import get_graph_class
+
+logger = build_logger()
+
+
+class CompiledGraphCache:
+    """
+    已编译 graph 的 LRU 缓存.
+    构建 graph (创建 llm, 加载工具, 实例化 graph 类, get_graph + compile) 每次需要数十毫秒, 且与具体对话无关,
+    相同 graph、模型参数、工具组合、checkpointer 类型的请求复用同一个已编译的 graph.
+    缓存的 graph 不绑定 checkpointer, 也不包含知识库名称等单次请求的参数, 这些参数通过 config["configurable"] 传入.
+    """
+
+    def __init__(self, max_size: int = 32):
+        self.max_size = max_size
+        self._cache: "OrderedDict[Hashable, CompiledStateGraph]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get_or_build(self, key: Hashable, builder: Callable[[], CompiledStateGraph]) -> CompiledStateGraph:
+        if self.max_size <= 0:
+            return builder()
+        with self._lock:
+            if (graph := self._cache.get(key)) is not None:
+                self._cache.move_to_end(key)
+                self._stats["hits"] += 1
+                return graph
+            self._stats["misses"] += 1
+        # 在锁外构建, 不阻塞其它 graph 的请求. 并发请求同一个 key 时可能重复构建, 结果相同
+        graph = builder()
+        with self._lock:
+            self._cache[key] = graph
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return graph
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self._stats, "size": len(self._cache), "max_size": self.max_size}
+
+
+compiled_graph_cache = CompiledGraphCache(max_size=Settings.tool_settings.GRAPH_CACHE_SIZE)
+
+
+def build_graph(
+        name: str,
+        model: str,
+        max_tokens: int,
+        temperature: float,
+        stream: bool,
+        tool_names: List[str],
+        checkpointer: BaseCheckpointSaver = None,
+) -> CompiledStateGraph:
+    """
+    构建并编译 graph, 不使用缓存.
+    """
+    graph_class = get_graph_class(name)
+    llm = create_agent_models(configs=None,
+                              model=model,
+                              max_tokens=max_tokens,
+                              temperature=temperature,
+                              stream=stream)
+    tools = [tool for tool in get_tool().values() if tool.name in tool_names]
+    graph_class_ins = graph_class(llm=llm,
+                                  tools=tools,
+                                  history_len=Settings.model_settings.HISTORY_LEN,
+                                  checkpoint=checkpointer,
+                                  knowledge_base=None,
+                                  top_k=None,
+                                  score_threshold=None)
+    graph = graph_class_ins.get_graph()
+    if not graph:
+        raise ValueError(f"Graph '{graph_class}' is not registered.")
+    return graph
+
+
+def get_compiled_graph(
+        name: str,
+        model: str,
+        max_tokens: int,
+        temperature: float,
+        stream: bool,
+        tool_names: List[str],
+        checkpointer: BaseCheckpointSaver,
+) -> CompiledStateGraph:
+    """
+    获取已编译的 graph, 并绑定本次请求使用的 checkpointer.
+    缓存键包含配置版本和工具快照版本, 配置文件修改 (如 HISTORY_LEN, prompt) 或知识库列表变化后重新构建.
+    """
+    tool_names = tuple(sorted(set(tool_names or [])))
+    key = (
+        name,
+        (model, max_tokens, temperature, stream),
+        tool_names,
+        get_graph_memory_type(),
+        get_tools_generation(),
+        Settings.version(),
+    )
+    graph = compiled_graph_cache.get_or_build(
+        key,
+        lambda: build_graph(name=name,
+                            model=model,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            stream=stream,
+                            tool_names=list(tool_names)),
+    )
+    # 浅拷贝, 不会重新编译
+    return graph.copy(update={"checkpointer": checkpointer})
+
+
+if __name__ == "__main__":
+    # 单次请求构建 graph 的耗时: 每次重新构建 vs 使用缓存
+    import sys
+    import time
+
+    from langgraph.checkpoint.memory import MemorySaver
+
+    graph_name = sys.argv[1] if len(sys.argv) > 1 else "base_agent"
+    n = 50
+    kwargs = dict(name=graph_name, model=None, max_tokens=None, temperature=None, stream=True, tool_names=[])
+
+    start = time.perf_counter()
+    for _ in range(n):
+        build_graph(checkpointer=MemorySaver(), **kwargs)
+    uncached = (time.perf_counter() - start) / n
+
+    get_compiled_graph(checkpointer=MemorySaver(), **kwargs)
+    start = time.perf_counter()
+    for _ in range(n):
+        get_compiled_graph(checkpointer=MemorySaver(), **kwargs)
+    cached = (time.perf_counter() - start) / n
+
+    print(f"{graph_name}: build every request={uncached * 1000:.2f}ms  cached={cached * 1000:.3f}ms")
+    print(compiled_graph_cache.stats())
@@ -4,18 +4,33 @@ from typing import List
 
 from fastapi import APIRouter
 
-from chatchat.server.knowledge_base.kb_api import create_kb, delete_kb, list_kbs
+from chatchat.server.knowledge_base.kb_api import (
+    create_kb,
+    delete_kb,
+    get_vs_cache_stats,
+    list_kbs,
+)
 from chatchat.server.knowledge_base.kb_doc_api import (
+    asearch_docs,
     delete_docs,
     download_doc,
     list_files,
     recreate_vector_store,
-    search_docs,
     update_docs,
     update_info,
     upload_docs,
     search_temp_docs,
 )
+from chatchat.server.knowledge_base.kb_executor import kb_endpoint
+from chatchat.server.knowledge_base.kb_job_api import (
+    cancel_kb_job,
+    get_kb_job,
+    kb_job_events,
+    list_kb_jobs,
+    submit_recreate_summary_vector_store,
+    submit_recreate_vector_store,
+    submit_upload_docs,
+)
 from chatchat.server.knowledge_base.kb_summary_api import (
     recreate_summary_vector_store,
     summary_doc_ids_to_vector_store,
@@ -40,10 +55,10 @@ kb_router.post(
 
 kb_router.get(
     "/list_files", response_model=ListResponse, summary="获取知识库内的文件列表"
-)(list_files)
+)(kb_endpoint("query")(list_files))
 
 kb_router.post("/search_docs", response_model=List[dict], summary="搜索知识库")(
-    search_docs
+    asearch_docs
 )
 
 kb_router.post(
@@ -54,15 +69,15 @@ kb_router.post(
 
 kb_router.post(
     "/delete_docs", response_model=BaseResponse, summary="删除知识库内指定文件"
-)(delete_docs)
+)(kb_endpoint("ingest")(delete_docs))
 
 kb_router.post("/update_info", response_model=BaseResponse, summary="更新知识库介绍")(
-    update_info
+    kb_endpoint("ingest")(update_info)
 )
 
 kb_router.post(
     "/update_docs", response_model=BaseResponse, summary="更新现有文件到知识库"
-)(update_docs)
+)(kb_endpoint("ingest")(update_docs))
 
 kb_router.get("/download_doc", summary="下载对应的知识文件")(download_doc)
 
@@ -71,9 +86,41 @@ kb_router.post(
 )(recreate_vector_store)
 
 kb_router.post("/search_temp_docs", summary="检索临时知识库")(
-    search_temp_docs
+    kb_endpoint("query")(search_temp_docs)
+)
+
+kb_router.post(
+    "/jobs/recreate_vector_store", response_model=BaseResponse, summary="提交后台重建向量库任务"
+)(submit_recreate_vector_store)
+
+kb_router.post(
+    "/jobs/recreate_summary_vector_store",
+    response_model=BaseResponse,
+    summary="提交后台重建知识库摘要任务",
+)(submit_recreate_summary_vector_store)
+
+kb_router.post(
+    "/jobs/upload_docs", response_model=BaseResponse, summary="上传文件到知识库，并提交后台向量化任务"
+)(submit_upload_docs)
+
+kb_router.get("/jobs/list", response_model=ListResponse, summary="获取后台任务列表")(
+    kb_endpoint("query")(list_kb_jobs)
 )
 
+kb_router.get("/jobs/detail", response_model=BaseResponse, summary="获取后台任务状态")(
+    kb_endpoint("query")(get_kb_job)
+)
+
+kb_router.get("/jobs/events", summary="流式输出后台任务进度")(kb_job_events)
+
+kb_router.post("/jobs/cancel", response_model=BaseResponse, summary="取消后台任务")(
+    kb_endpoint("ingest")(cancel_kb_job)
+)
+
+kb_router.get(
+    "/vector_store_cache_stats", response_model=BaseResponse, summary="获取向量库缓存统计"
+)(get_vs_cache_stats)
+
 summary_router = APIRouter(prefix="/kb_summary_api")
 summary_router.post(
     "/summary_file_to_vector_store", summary="单个知识库根据文件名称摘要"
@@ -82,7 +129,7 @@ summary_router.post(
     "/summary_doc_ids_to_vector_store",
     summary="单个知识库根据doc_ids摘要",
     response_model=BaseResponse,
-)(summary_doc_ids_to_vector_store)
+)(kb_endpoint("ingest")(summary_doc_ids_to_vector_store))
 summary_router.post("/recreate_summary_vector_store", summary="重建单个知识库文件摘要")(
     recreate_summary_vector_store
 )
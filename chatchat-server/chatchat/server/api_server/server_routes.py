@@ -1,7 +1,12 @@
 from fastapi import APIRouter
 
 from chatchat.settings import Settings
-from chatchat.server.utils import get_server_configs
+from chatchat.server.agent.checkpointer import get_checkpointer_health
+from chatchat.server.utils import (
+    get_embed_model_health,
+    get_embedding_cache_stats,
+    get_server_configs,
+)
 
 server_router = APIRouter(prefix="/server", tags=["Server State"])
 
@@ -12,3 +17,18 @@ server_router.post(
     "/configs",
     summary="获取服务器原始配置信息",
 )(get_server_configs)
+
+server_router.get(
+    "/embed_model_health",
+    summary="获取嵌入模型可用性状态",
+)(get_embed_model_health)
+
+server_router.get(
+    "/embedding_cache_stats",
+    summary="获取嵌入向量缓存命中统计",
+)(get_embedding_cache_stats)
+
+server_router.get(
+    "/checkpointer_health",
+    summary="获取对话历史 checkpointer 可用性状态",
+)(get_checkpointer_health)
@@ -15,3 +15,22 @@ class BaseModel:
     )
     create_by = Column(String, default=None, comment="创建者")
     update_by = Column(String, default=None, comment="更新者")
+
+
+def name_key(name: str) -> str:
+    """
+    知识库名称、文件名的规范化形式，用于大小写不敏感的等值查询。
+    查询时对参数做同样的转换后与 *_key 列比较，可以使用索引，不再使用 ilike 全表扫描
+    """
+    return name.lower() if name else name
+
+
+def name_key_default(column: str):
+    """
+    *_key 列的默认值：插入时根据 column 列的值自动生成，ORM 和批量 INSERT 均适用
+    """
+
+    def default(context):
+        return name_key(context.get_current_parameters().get(column))
+
+    return default
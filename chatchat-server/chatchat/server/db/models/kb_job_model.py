@@ -0,0 +1,30 @@
+from sqlalchemy import JSON, Boolean, Column, DateTime, Float, Integer, String, func
+
+from chatchat.server.db.base import Base
+
+
+class KBJobModel(Base):
+    """
+    知识库后台任务模型
+    """
+
+    __tablename__ = "kb_job"
+    id = Column(String(32), primary_key=True, comment="任务ID")
+    kb_name = Column(String(50), index=True, comment="知识库名称")
+    job_type = Column(String(50), comment="任务类型")
+    params = Column(JSON, default={}, comment="任务参数")
+    status = Column(String(20), default="pending", index=True, comment="任务状态")
+    total = Column(Integer, default=0, comment="需要处理的文件数量")
+    finished = Column(Integer, default=0, comment="已处理的文件数量")
+    checkpoint = Column(JSON, default={}, comment="任务检查点，用于中断后继续执行")
+    msg = Column(String(1024), default="", comment="最近一条进度或错误信息")
+    cancel_requested = Column(Boolean, default=False, comment="是否已请求取消")
+    worker = Column(String(100), default="", comment="执行任务的 worker")
+    attempts = Column(Integer, default=0, comment="执行次数")
+    heartbeat_time = Column(Float, default=0.0, comment="worker 最近一次心跳时间")
+    create_time = Column(DateTime, default=func.now(), comment="创建时间")
+    start_time = Column(DateTime, default=None, comment="开始时间")
+    end_time = Column(DateTime, default=None, comment="结束时间")
+
+    def __repr__(self):
+        return f"<KBJob(id='{self.id}', kb_name='{self.kb_name}', job_type='{self.job_type}', status='{self.status}', finished='{self.finished}/{self.total}', create_time='{self.create_time}')>"
@@ -1,6 +1,7 @@
-from sqlalchemy import JSON, Boolean, Column, DateTime, Float, Integer, String, func
+from sqlalchemy import JSON, Boolean, Column, DateTime, Float, Index, Integer, String, func
 
 from chatchat.server.db.base import Base
+from chatchat.server.db.models.base import name_key_default
 
 
 class KnowledgeFileModel(Base):
@@ -9,15 +10,19 @@ class KnowledgeFileModel(Base):
     """
 
     __tablename__ = "knowledge_file"
+    __table_args__ = (Index("ix_knowledge_file_kb_key_file_key", "kb_key", "file_key"),)
     id = Column(Integer, primary_key=True, autoincrement=True, comment="知识文件ID")
     file_name = Column(String(255), comment="文件名")
     file_ext = Column(String(10), comment="文件扩展名")
     kb_name = Column(String(50), comment="所属知识库名称")
+    kb_key = Column(String(50), default=name_key_default("kb_name"), comment="小写的知识库名称，用于查询")
+    file_key = Column(String(255), default=name_key_default("file_name"), comment="小写的文件名，用于查询")
     document_loader_name = Column(String(50), comment="文档加载器名称")
     text_splitter_name = Column(String(50), comment="文本分割器名称")
     file_version = Column(Integer, default=1, comment="文件版本")
     file_mtime = Column(Float, default=0.0, comment="文件修改时间")
     file_size = Column(Integer, default=0, comment="文件大小")
+    file_hash = Column(String(64), default="", comment="文件内容哈希（sha256）")
     custom_docs = Column(Boolean, default=False, comment="是否自定义docs")
     docs_count = Column(Integer, default=0, comment="切分文档数量")
     create_time = Column(DateTime, default=func.now(), comment="创建时间")
@@ -32,10 +37,17 @@ class FileDocModel(Base):
     """
 
     __tablename__ = "file_doc"
+    __table_args__ = (
+        Index("ix_file_doc_kb_key_file_key", "kb_key", "file_key"),
+        Index("ix_file_doc_kb_key_doc_id", "kb_key", "doc_id"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True, comment="ID")
     kb_name = Column(String(50), comment="知识库名称")
     file_name = Column(String(255), comment="文件名称")
+    kb_key = Column(String(50), default=name_key_default("kb_name"), comment="小写的知识库名称，用于查询")
+    file_key = Column(String(255), default=name_key_default("file_name"), comment="小写的文件名称，用于查询")
     doc_id = Column(String(50), comment="向量库文档ID")
+    chunk_hash = Column(String(64), default="", comment="文档内容哈希，用于增量更新")
     meta_data = Column(JSON, default={})
 
     def __repr__(self):
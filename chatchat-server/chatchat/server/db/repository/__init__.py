@@ -1,4 +1,5 @@
 from .conversation_repository import *
+from .kb_job_repository import *
 from .knowledge_base_repository import *
 from .knowledge_file_repository import *
 from .message_repository import *
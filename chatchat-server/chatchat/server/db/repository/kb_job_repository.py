@@ -0,0 +1,232 @@
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+
+from chatchat.server.db.models.kb_job_model import KBJobModel
+from chatchat.server.db.session import with_session
+
+
+KB_JOB_FINAL_STATUS = ("succeeded", "failed", "cancelled")
+
+
+def _job_to_dict(job: KBJobModel) -> Dict:
+    return {
+        "id": job.id,
+        "kb_name": job.kb_name,
+        "job_type": job.job_type,
+        "params": job.params or {},
+        "status": job.status,
+        "total": job.total,
+        "finished": job.finished,
+        "checkpoint": job.checkpoint or {},
+        "msg": job.msg,
+        "cancel_requested": job.cancel_requested,
+        "worker": job.worker,
+        "attempts": job.attempts,
+        "heartbeat_time": job.heartbeat_time,
+        "create_time": job.create_time,
+        "start_time": job.start_time,
+        "end_time": job.end_time,
+    }
+
+
+@with_session
+def add_kb_job_to_db(
+    session, job_id: str, kb_name: str, job_type: str, params: Dict
+) -> Dict:
+    job = KBJobModel(
+        id=job_id,
+        kb_name=kb_name,
+        job_type=job_type,
+        params=params,
+        status="pending",
+        checkpoint={},
+    )
+    session.add(job)
+    session.flush()
+    return _job_to_dict(job)
+
+
+@with_session
+def get_kb_job_from_db(session, job_id: str) -> Optional[Dict]:
+    job = session.query(KBJobModel).filter_by(id=job_id).first()
+    return _job_to_dict(job) if job else None
+
+
+@with_session
+def list_kb_jobs_from_db(
+    session, kb_name: str = None, status: str = None, limit: int = 100
+) -> List[Dict]:
+    query = session.query(KBJobModel)
+    if kb_name:
+        query = query.filter(KBJobModel.kb_name.ilike(kb_name))
+    if status:
+        query = query.filter_by(status=status)
+    jobs = query.order_by(KBJobModel.create_time.desc()).limit(limit).all()
+    return [_job_to_dict(job) for job in jobs]
+
+
+@with_session
+def count_active_kb_jobs(session, kb_name: str) -> int:
+    """
+    知识库等待中和执行中的任务数（知识库名称不区分大小写）
+    """
+    return (
+        session.query(KBJobModel)
+        .filter(func.lower(KBJobModel.kb_name) == kb_name.lower())
+        .filter(KBJobModel.status.in_(("pending", "running")))
+        .count()
+    )
+
+
+@with_session
+def claim_kb_job(session, worker: str, max_per_kb: int = 1) -> Optional[Dict]:
+    """
+    领取一个等待中的任务，同一知识库正在执行的任务数不超过 max_per_kb。
+    状态检查与更新在同一条 UPDATE 语句中完成，多个 worker 进程同时领取时每个任务只会被领取一次。
+    """
+    candidates = (
+        session.query(KBJobModel.id, KBJobModel.kb_name)
+        .filter_by(status="pending")
+        .order_by(KBJobModel.create_time)
+        .limit(20)
+        .all()
+    )
+    running = aliased(KBJobModel)
+    for job_id, kb_name in candidates:
+        running_count = (
+            session.query(func.count(running.id))
+            .filter(running.kb_name == kb_name, running.status == "running")
+            .scalar_subquery()
+        )
+        claimed = (
+            session.query(KBJobModel)
+            .filter(
+                KBJobModel.id == job_id,
+                KBJobModel.status == "pending",
+                running_count < max(1, max_per_kb),
+            )
+            .update(
+                {
+                    "status": "running",
+                    "worker": worker,
+                    "attempts": KBJobModel.attempts + 1,
+                    "heartbeat_time": time.time(),
+                    "start_time": datetime.now(),
+                },
+                synchronize_session=False,
+            )
+        )
+        if claimed:
+            session.commit()
+            job = session.query(KBJobModel).filter_by(id=job_id).first()
+            return _job_to_dict(job)
+    return None
+
+
+@with_session
+def update_kb_job_progress(
+    session,
+    job_id: str,
+    total: int = None,
+    finished: int = None,
+    checkpoint: Dict = None,
+    msg: str = None,
+) -> bool:
+    """
+    更新任务进度和检查点，同时刷新心跳时间。返回任务是否已被请求取消
+    """
+    job = session.query(KBJobModel).filter_by(id=job_id).first()
+    if job is None:
+        return True
+    if total is not None:
+        job.total = total
+    if finished is not None:
+        job.finished = finished
+    if checkpoint is not None:
+        job.checkpoint = dict(checkpoint)
+    if msg is not None:
+        job.msg = msg[:1024]
+    job.heartbeat_time = time.time()
+    return bool(job.cancel_requested)
+
+
+@with_session
+def touch_kb_job(session, job_id: str) -> bool:
+    """
+    刷新任务心跳时间，返回任务是否已被请求取消
+    """
+    job = session.query(KBJobModel).filter_by(id=job_id).first()
+    if job is None:
+        return True
+    job.heartbeat_time = time.time()
+    return bool(job.cancel_requested)
+
+
+@with_session
+def finish_kb_job(session, job_id: str, status: str, msg: str = None) -> bool:
+    job = session.query(KBJobModel).filter_by(id=job_id).first()
+    if job is None:
+        return False
+    job.status = status
+    if msg is not None:
+        job.msg = msg[:1024]
+    job.end_time = datetime.now()
+    return True
+
+
+@with_session
+def cancel_kb_job_in_db(session, job_id: str) -> Optional[str]:
+    """
+    取消任务：等待中的任务直接标记为已取消，执行中的任务标记取消请求，由 worker 在处理完当前文件后停止。
+    返回任务当前状态，任务不存在时返回 None
+    """
+    job = session.query(KBJobModel).filter_by(id=job_id).first()
+    if job is None:
+        return None
+    if job.status == "pending":
+        job.status = "cancelled"
+        job.msg = "任务已取消"
+        job.end_time = datetime.now()
+    elif job.status == "running":
+        job.cancel_requested = True
+    return job.status
+
+
+@with_session
+def requeue_stale_kb_jobs(session, stale_seconds: float) -> List[str]:
+    """
+    将心跳超时的执行中任务（worker 进程已退出或崩溃）重新放回队列，任务从检查点处继续执行
+    """
+    jobs = (
+        session.query(KBJobModel)
+        .filter(
+            KBJobModel.status == "running",
+            KBJobModel.heartbeat_time < time.time() - stale_seconds,
+        )
+        .all()
+    )
+    for job in jobs:
+        if job.cancel_requested:
+            job.status = "cancelled"
+            job.end_time = datetime.now()
+        else:
+            job.status = "pending"
+            job.worker = ""
+    return [job.id for job in jobs]
+
+
+@with_session
+def list_kb_jobs_finished_since(session, since: datetime) -> List[Dict]:
+    jobs = (
+        session.query(KBJobModel)
+        .filter(
+            KBJobModel.status.in_(KB_JOB_FINAL_STATUS),
+            KBJobModel.end_time > since,
+        )
+        .all()
+    )
+    return [_job_to_dict(job) for job in jobs]
@@ -1,3 +1,4 @@
+from chatchat.server.db.models.base import name_key
 from chatchat.server.db.models.knowledge_base_model import (
     KnowledgeBaseModel,
     KnowledgeBaseSchema,
@@ -10,7 +11,7 @@ def add_kb_to_db(session, kb_name, kb_info, vs_type, embed_model):
     # 创建知识库实例
     kb = (
         session.query(KnowledgeBaseModel)
-        .filter(KnowledgeBaseModel.kb_name.ilike(kb_name))
+        .filter(KnowledgeBaseModel.kb_key == name_key(kb_name))
         .first()
     )
     if not kb:
@@ -36,11 +37,30 @@ def list_kbs_from_db(session, min_file_count: int = -1):
     return kbs
 
 
+@with_session
+def get_kbs_signature(session) -> tuple:
+    """
+    知识库列表的签名, 只读取名称、简介、向量库类型和嵌入模型. 多个进程通过比较签名判断知识库列表是否被其它进程修改
+    """
+    rows = (
+        session.query(
+            KnowledgeBaseModel.id,
+            KnowledgeBaseModel.kb_name,
+            KnowledgeBaseModel.kb_info,
+            KnowledgeBaseModel.vs_type,
+            KnowledgeBaseModel.embed_model,
+        )
+        .order_by(KnowledgeBaseModel.id)
+        .all()
+    )
+    return tuple(tuple(row) for row in rows)
+
+
 @with_session
 def kb_exists(session, kb_name):
     kb = (
         session.query(KnowledgeBaseModel)
-        .filter(KnowledgeBaseModel.kb_name.ilike(kb_name))
+        .filter(KnowledgeBaseModel.kb_key == name_key(kb_name))
         .first()
     )
     status = True if kb else False
@@ -51,7 +71,7 @@ def kb_exists(session, kb_name):
 def load_kb_from_db(session, kb_name):
     kb = (
         session.query(KnowledgeBaseModel)
-        .filter(KnowledgeBaseModel.kb_name.ilike(kb_name))
+        .filter(KnowledgeBaseModel.kb_key == name_key(kb_name))
         .first()
     )
     if kb:
@@ -65,7 +85,7 @@ def load_kb_from_db(session, kb_name):
 def delete_kb_from_db(session, kb_name):
     kb = (
         session.query(KnowledgeBaseModel)
-        .filter(KnowledgeBaseModel.kb_name.ilike(kb_name))
+        .filter(KnowledgeBaseModel.kb_key == name_key(kb_name))
         .first()
     )
     if kb:
@@ -77,7 +97,7 @@ def delete_kb_from_db(session, kb_name):
 def get_kb_detail(session, kb_name: str) -> dict:
     kb: KnowledgeBaseModel = (
         session.query(KnowledgeBaseModel)
-        .filter(KnowledgeBaseModel.kb_name.ilike(kb_name))
+        .filter(KnowledgeBaseModel.kb_key == name_key(kb_name))
         .first()
     )
     if kb:
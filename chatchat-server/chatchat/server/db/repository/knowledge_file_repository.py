@@ -1,5 +1,8 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
+from sqlalchemy import insert
+
+from chatchat.server.db.models.base import name_key
 from chatchat.server.db.models.knowledge_base_model import KnowledgeBaseModel
 from chatchat.server.db.models.knowledge_file_model import (
     FileDocModel,
@@ -9,6 +12,13 @@ from chatchat.server.db.session import with_session
 from chatchat.server.knowledge_base.utils import KnowledgeFile
 
 
+def _file_docs_query(session, kb_name: str, file_name: str = None):
+    query = session.query(FileDocModel).filter(FileDocModel.kb_key == name_key(kb_name))
+    if file_name:
+        query = query.filter(FileDocModel.file_key == name_key(file_name))
+    return query
+
+
 @with_session
 def list_file_num_docs_id_by_kb_name_and_file_name(
     session,
@@ -21,7 +31,10 @@ def list_file_num_docs_id_by_kb_name_and_file_name(
     """
     doc_ids = (
         session.query(FileDocModel.doc_id)
-        .filter_by(kb_name=kb_name, file_name=file_name)
+        .filter(
+            FileDocModel.kb_key == name_key(kb_name),
+            FileDocModel.file_key == name_key(file_name),
+        )
         .all()
     )
     return [int(_id[0]) for _id in doc_ids]
@@ -38,9 +51,13 @@ def list_docs_from_db(
     列出某知识库某文件对应的所有Document。
     返回形式：[{"id": str, "metadata": dict}, ...]
     """
-    docs = session.query(FileDocModel).filter(FileDocModel.kb_name.ilike(kb_name))
-    if file_name:
-        docs = docs.filter(FileDocModel.file_name.ilike(file_name))
+    if file_name and "%" in file_name:
+        # 文件名支持 sql 通配符
+        docs = _file_docs_query(session, kb_name).filter(
+            FileDocModel.file_key.like(name_key(file_name))
+        )
+    else:
+        docs = _file_docs_query(session, kb_name, file_name)
     for k, v in metadata.items():
         docs = docs.filter(FileDocModel.meta_data[k].as_string() == str(v))
 
@@ -57,20 +74,34 @@ def delete_docs_from_db(
     删除某知识库某文件对应的所有Document，并返回被删除的Document。
     返回形式：[{"id": str, "metadata": dict}, ...]
     """
-    docs = list_docs_from_db(kb_name=kb_name, file_name=file_name)
-    query = session.query(FileDocModel).filter(FileDocModel.kb_name.ilike(kb_name))
-    if file_name:
-        query = query.filter(FileDocModel.file_name.ilike(file_name))
-    query.delete(synchronize_session=False)
-    session.commit()
+    docs = list_docs_from_db(kb_name=kb_name, file_name=file_name, session=session)
+    _file_docs_query(session, kb_name, file_name).delete(synchronize_session=False)
     return docs
 
 
+@with_session
+def list_doc_hashes_from_db(session, kb_name: str, file_name: str) -> List[Tuple[str, str]]:
+    """
+    列出某知识库某文件对应的所有Document的id与内容哈希。
+    返回形式：[(doc_id, chunk_hash), ...]，旧版本添加的文档 chunk_hash 为空
+    """
+    rows = (
+        session.query(FileDocModel.doc_id, FileDocModel.chunk_hash)
+        .filter(
+            FileDocModel.kb_key == name_key(kb_name),
+            FileDocModel.file_key == name_key(file_name),
+        )
+        .all()
+    )
+    return [(doc_id, chunk_hash or "") for doc_id, chunk_hash in rows]
+
+
 @with_session
 def add_docs_to_db(session, kb_name: str, file_name: str, doc_infos: List[Dict]):
     """
     将某知识库某文件对应的所有Document信息添加到数据库。
-    doc_infos形式：[{"id": str, "metadata": dict}, ...]
+    doc_infos形式：[{"id": str, "metadata": dict, "chunk_hash": str}, ...]，chunk_hash 可省略
+    使用一条批量 INSERT 写入，不逐个创建 ORM 对象
     """
     # ! 这里会出现doc_infos为None的情况，需要进一步排查
     if doc_infos is None:
@@ -78,14 +109,23 @@ def add_docs_to_db(session, kb_name: str, file_name: str, doc_infos: List[Dict])
             "输入的server.db.repository.knowledge_file_repository.add_docs_to_db的doc_infos参数为None"
         )
         return False
-    for d in doc_infos:
-        obj = FileDocModel(
-            kb_name=kb_name,
-            file_name=file_name,
-            doc_id=d["id"],
-            meta_data=d["metadata"],
+    if doc_infos:
+        kb_key, file_key = name_key(kb_name), name_key(file_name)
+        session.execute(
+            insert(FileDocModel),
+            [
+                {
+                    "kb_name": kb_name,
+                    "file_name": file_name,
+                    "kb_key": kb_key,
+                    "file_key": file_key,
+                    "doc_id": d["id"],
+                    "meta_data": d["metadata"],
+                    "chunk_hash": d.get("chunk_hash", ""),
+                }
+                for d in doc_infos
+            ],
         )
-        session.add(obj)
     return True
 
 
@@ -93,7 +133,7 @@ def add_docs_to_db(session, kb_name: str, file_name: str, doc_infos: List[Dict])
 def count_files_from_db(session, kb_name: str) -> int:
     return (
         session.query(KnowledgeFileModel)
-        .filter(KnowledgeFileModel.kb_name.ilike(kb_name))
+        .filter(KnowledgeFileModel.kb_key == name_key(kb_name))
         .count()
     )
 
@@ -102,7 +142,7 @@ def count_files_from_db(session, kb_name: str) -> int:
 def list_files_from_db(session, kb_name):
     files = (
         session.query(KnowledgeFileModel)
-        .filter(KnowledgeFileModel.kb_name.ilike(kb_name))
+        .filter(KnowledgeFileModel.kb_key == name_key(kb_name))
         .all()
     )
     docs = [f.file_name for f in files]
@@ -117,23 +157,29 @@ def add_file_to_db(
     custom_docs: bool = False,
     doc_infos: List[Dict] = [],  # 形式：[{"id": str, "metadata": dict}, ...]
 ):
-    kb = session.query(KnowledgeBaseModel).filter_by(kb_name=kb_file.kb_name).first()
+    kb = (
+        session.query(KnowledgeBaseModel)
+        .filter(KnowledgeBaseModel.kb_key == name_key(kb_file.kb_name))
+        .first()
+    )
     if kb:
         # 如果已经存在该文件，则更新文件信息与版本号
         existing_file: KnowledgeFileModel = (
             session.query(KnowledgeFileModel)
             .filter(
-                KnowledgeFileModel.kb_name.ilike(kb_file.kb_name),
-                KnowledgeFileModel.file_name.ilike(kb_file.filename),
+                KnowledgeFileModel.kb_key == name_key(kb_file.kb_name),
+                KnowledgeFileModel.file_key == name_key(kb_file.filename),
             )
             .first()
         )
         mtime = kb_file.get_mtime()
         size = kb_file.get_size()
+        file_hash = kb_file.get_hash()
 
         if existing_file:
             existing_file.file_mtime = mtime
             existing_file.file_size = size
+            existing_file.file_hash = file_hash
             existing_file.docs_count = docs_count
             existing_file.custom_docs = custom_docs
             existing_file.file_version += 1
@@ -147,60 +193,101 @@ def add_file_to_db(
                 text_splitter_name=kb_file.text_splitter_name or "SpacyTextSplitter",
                 file_mtime=mtime,
                 file_size=size,
+                file_hash=file_hash,
                 docs_count=docs_count,
                 custom_docs=custom_docs,
             )
             kb.file_count += 1
             session.add(new_file)
         add_docs_to_db(
-            kb_name=kb_file.kb_name, file_name=kb_file.filename, doc_infos=doc_infos
+            kb_name=kb_file.kb_name,
+            file_name=kb_file.filename,
+            doc_infos=doc_infos,
+            session=session,
         )
     return True
 
 
+@with_session
+def update_file_docs_in_db(
+    session,
+    kb_file: KnowledgeFile,
+    docs_count: int,
+    add_doc_infos: List[Dict] = [],
+    delete_doc_ids: List[str] = [],
+):
+    """
+    增量更新文件后同步数据库：更新文件信息与版本号，删除已从向量库移除的文档，添加新增的文档。
+    add_doc_infos形式：[{"id": str, "metadata": dict, "chunk_hash": str}, ...]
+    """
+    existing_file: KnowledgeFileModel = (
+        session.query(KnowledgeFileModel)
+        .filter(
+            KnowledgeFileModel.kb_key == name_key(kb_file.kb_name),
+            KnowledgeFileModel.file_key == name_key(kb_file.filename),
+        )
+        .first()
+    )
+    if existing_file is None:
+        return False
+    existing_file.file_mtime = kb_file.get_mtime()
+    existing_file.file_size = kb_file.get_size()
+    existing_file.file_hash = kb_file.get_hash()
+    existing_file.docs_count = docs_count
+    existing_file.custom_docs = False
+    existing_file.file_version += 1
+    for i in range(0, len(delete_doc_ids), 500):
+        _file_docs_query(session, kb_file.kb_name, kb_file.filename).filter(
+            FileDocModel.doc_id.in_(delete_doc_ids[i: i + 500]),
+        ).delete(synchronize_session=False)
+    add_docs_to_db(
+        kb_name=kb_file.kb_name,
+        file_name=kb_file.filename,
+        doc_infos=add_doc_infos,
+        session=session,
+    )
+    return True
+
+
 @with_session
 def delete_file_from_db(session, kb_file: KnowledgeFile):
     existing_file = (
         session.query(KnowledgeFileModel)
         .filter(
-            KnowledgeFileModel.file_name.ilike(kb_file.filename),
-            KnowledgeFileModel.kb_name.ilike(kb_file.kb_name),
+            KnowledgeFileModel.file_key == name_key(kb_file.filename),
+            KnowledgeFileModel.kb_key == name_key(kb_file.kb_name),
         )
         .first()
     )
     if existing_file:
+        # 文件记录、文档记录、知识库文件数在同一个事务中更新
         session.delete(existing_file)
-        delete_docs_from_db(kb_name=kb_file.kb_name, file_name=kb_file.filename)
-        session.commit()
-
+        _file_docs_query(session, kb_file.kb_name, kb_file.filename).delete(
+            synchronize_session=False
+        )
         kb = (
             session.query(KnowledgeBaseModel)
-            .filter(KnowledgeBaseModel.kb_name.ilike(kb_file.kb_name))
+            .filter(KnowledgeBaseModel.kb_key == name_key(kb_file.kb_name))
             .first()
         )
         if kb:
             kb.file_count -= 1
-            session.commit()
     return True
 
 
 @with_session
 def delete_files_from_db(session, knowledge_base_name: str):
     session.query(KnowledgeFileModel).filter(
-        KnowledgeFileModel.kb_name.ilike(knowledge_base_name)
-    ).delete(synchronize_session=False)
-    session.query(FileDocModel).filter(
-        FileDocModel.kb_name.ilike(knowledge_base_name)
+        KnowledgeFileModel.kb_key == name_key(knowledge_base_name)
     ).delete(synchronize_session=False)
+    _file_docs_query(session, knowledge_base_name).delete(synchronize_session=False)
     kb = (
         session.query(KnowledgeBaseModel)
-        .filter(KnowledgeBaseModel.kb_name.ilike(knowledge_base_name))
+        .filter(KnowledgeBaseModel.kb_key == name_key(knowledge_base_name))
         .first()
     )
     if kb:
         kb.file_count = 0
-
-    session.commit()
     return True
 
 
@@ -209,8 +296,8 @@ def file_exists_in_db(session, kb_file: KnowledgeFile):
     existing_file = (
         session.query(KnowledgeFileModel)
         .filter(
-            KnowledgeFileModel.file_name.ilike(kb_file.filename),
-            KnowledgeFileModel.kb_name.ilike(kb_file.kb_name),
+            KnowledgeFileModel.file_key == name_key(kb_file.filename),
+            KnowledgeFileModel.kb_key == name_key(kb_file.kb_name),
         )
         .first()
     )
@@ -222,8 +309,8 @@ def get_file_detail(session, kb_name: str, filename: str) -> dict:
     file: KnowledgeFileModel = (
         session.query(KnowledgeFileModel)
         .filter(
-            KnowledgeFileModel.file_name.ilike(filename),
-            KnowledgeFileModel.kb_name.ilike(kb_name),
+            KnowledgeFileModel.file_key == name_key(filename),
+            KnowledgeFileModel.kb_key == name_key(kb_name),
         )
         .first()
     )
@@ -238,8 +325,80 @@ def get_file_detail(session, kb_name: str, filename: str) -> dict:
             "create_time": file.create_time,
             "file_mtime": file.file_mtime,
             "file_size": file.file_size,
+            "file_hash": file.file_hash,
             "custom_docs": file.custom_docs,
             "docs_count": file.docs_count,
         }
     else:
         return {}
+
+
+@with_session
+def list_file_hashes_from_db(session, kb_name: str) -> Dict[str, str]:
+    """
+    列出知识库中所有文件的内容哈希，返回形式：{file_name: file_hash}，旧版本添加的文件哈希为空
+    """
+    rows = (
+        session.query(KnowledgeFileModel.file_name, KnowledgeFileModel.file_hash)
+        .filter(KnowledgeFileModel.kb_key == name_key(kb_name))
+        .all()
+    )
+    return {file_name: file_hash or "" for file_name, file_hash in rows}
+
+
+if __name__ == "__main__":
+    # 写入/删除文件文档记录的耗时：逐个 ORM 对象添加 vs 批量 INSERT，使用临时 SQLite 数据库
+    import os
+    import tempfile
+    import time
+    from types import SimpleNamespace
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from chatchat.server.db.base import Base
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+
+        for n in [1_000, 10_000, 100_000]:
+            doc_infos = [
+                {"id": f"doc-{i}", "metadata": {"source": "bench.txt", "i": i}, "chunk_hash": f"{i:064x}"}
+                for i in range(n)
+            ]
+            kb_file = SimpleNamespace(kb_name="bench", filename="bench.txt")
+
+            with Session() as session:
+                start = time.perf_counter()
+                for d in doc_infos:
+                    session.add(
+                        FileDocModel(
+                            kb_name="bench",
+                            file_name="bench.txt",
+                            doc_id=d["id"],
+                            meta_data=d["metadata"],
+                            chunk_hash=d["chunk_hash"],
+                        )
+                    )
+                session.commit()
+                orm_add = time.perf_counter() - start
+                _file_docs_query(session, "bench", "bench.txt").delete(synchronize_session=False)
+                session.commit()
+
+            with Session() as session:
+                start = time.perf_counter()
+                session.add(KnowledgeFileModel(kb_name="bench", file_name="bench.txt", docs_count=n))
+                add_docs_to_db(kb_name="bench", file_name="bench.txt", doc_infos=doc_infos, session=session)
+                session.commit()
+                bulk_add = time.perf_counter() - start
+
+                start = time.perf_counter()
+                delete_file_from_db(kb_file, session=session)
+                session.commit()
+                delete = time.perf_counter() - start
+
+            print(
+                f"{n:>7} chunks: orm add={orm_add:.2f}s  bulk add={bulk_add:.2f}s  delete={delete:.2f}s"
+            )
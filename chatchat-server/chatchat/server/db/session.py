@@ -21,8 +21,15 @@ def session_scope() -> Session:
 
 
 def with_session(f):
+    """
+    为函数提供 Session。调用时传入 session=xxx 则复用调用方的 Session，不单独提交，
+    多个数据库操作可以在同一个事务中完成
+    """
+
     @wraps(f)
-    def wrapper(*args, **kwargs):
+    def wrapper(*args, session: Session = None, **kwargs):
+        if session is not None:
+            return f(session, *args, **kwargs)
         with session_scope() as session:
             try:
                 result = f(session, *args, **kwargs)
@@ -0,0 +1,431 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+from chatchat.settings import Settings
+from chatchat.utils import build_logger
+
+
+logger = build_logger()
+
+
+def text_hash(text: str) -> str:
+    """
+    对文本做 unicode 规范化后计算 sha256，作为嵌入缓存的内容地址。
+    不去除首尾空白：嵌入模型收到的是原文，空白不同的文本向量也可能不同
+    """
+    text = unicodedata.normalize("NFC", text or "")
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def embedding_model_key(embed_model: str, platform_name: str = None, api_base_url: str = None) -> str:
+    """
+    嵌入缓存中模型的标识。同名模型部署在不同平台或地址时可能是不同的模型（版本、量化方式不同），
+    因此平台名称和 api 地址也作为键的一部分，模型迁移到其它平台后不会复用旧平台的向量
+    """
+    return "|".join([platform_name or "", (api_base_url or "").rstrip("/"), embed_model])
+
+
+class EmbeddingStore:
+    """
+    以 (模型标识, sha256(文本)) 为键的持久化嵌入向量缓存，使用 SQLite 存储 float32 向量。
+    所有知识库共用，重建向量库、重复上传相同文件时，未变化的文本块无需再次调用嵌入模型。
+    条目数超过 max_items 时按最近访问时间淘汰（LRU）。
+    """
+
+    _SQL_BATCH = 500  # SQLite 单条语句参数数量有限制，分批查询
+
+    def __init__(self, path: str, max_items: int = 0):
+        self.path = path
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, hash)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_embeddings_last_access ON embeddings (last_access)"
+        )
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        """
+        返回已缓存的 {hash: vector}，并刷新命中条目的访问时间
+        """
+        result = {}
+        keys = list(dict.fromkeys(hashes))
+        with self._lock:
+            for i in range(0, len(keys), self._SQL_BATCH):
+                batch = keys[i: i + self._SQL_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? "
+                    f"AND hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                for h, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    result[h] = vector.tolist()
+            if result:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND hash = ?",
+                    [(now, model, h) for h in result],
+                )
+                self._conn.commit()
+            self._stats["hits"] += len(result)
+            self._stats["misses"] += len(keys) - len(result)
+        return result
+
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (model, h, array("f", vector).tobytes(), now) for h, vector in items.items()
+        ]
+        with self._lock:
+            cursor = self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            self._stats["writes"] += len(rows)
+            # INSERT OR REPLACE 无法区分新增和替换，这里是估计值，超出上限时再精确计数
+            self._count += max(cursor.rowcount, 0)
+            if 0 < self.max_items < self._count:
+                self._evict()
+
+    def _evict(self):
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = self._count - self.max_items
+        if overflow <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_access LIMIT ?)",
+            (overflow,),
+        )
+        self._conn.commit()
+        self._count -= overflow
+        self._stats["evictions"] += overflow
+        logger.info(f"嵌入缓存超出上限 {self.max_items}，已淘汰 {overflow} 条")
+
+    def clear(self, model: str = None):
+        with self._lock:
+            if model is None:
+                self._conn.execute("DELETE FROM embeddings")
+            else:
+                self._conn.execute("DELETE FROM embeddings WHERE model = ?", (model,))
+            self._conn.commit()
+            self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": self._stats["hits"] / total if total else 0.0,
+                "items": self._count,
+                "max_items": self.max_items,
+                "path": self.path,
+            }
+
+
+_embedding_store: Optional[EmbeddingStore] = None
+_embedding_store_lock = threading.Lock()
+
+
+def get_embedding_store() -> Optional[EmbeddingStore]:
+    """
+    获取全局共享的嵌入缓存，未启用时返回 None
+    """
+    global _embedding_store
+    if not Settings.kb_settings.EMBEDDING_CACHE_ENABLED:
+        return None
+    if _embedding_store is None:
+        with _embedding_store_lock:
+            if _embedding_store is None:
+                _embedding_store = EmbeddingStore(
+                    path=Settings.basic_settings.EMBEDDING_CACHE_PATH,
+                    max_items=Settings.kb_settings.EMBEDDING_CACHE_MAX_ITEMS,
+                )
+    return _embedding_store
+
+
+class QueryEmbeddingCache:
+    """
+    进程内的查询向量缓存（LRU + TTL），以 (模型标识, sha256(文本)) 为键，按向量占用字节数限制容量。
+    高频重复的问题、RAG 改写后重复检索时无需再次请求嵌入模型。
+
+    backend 为可选的远端缓存，只需实现 redis-py 兼容的 get(key) 和 set(key, value, ex=秒) 接口，
+    本地未命中时再查询 backend，多个进程可以借此共享查询向量。
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = 0, backend: Any = None, prefix: str = "chatchat:qemb:"):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        self.prefix = prefix
+        self._cache: OrderedDict[Tuple[str, str], Tuple[array, float]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "backend_hits": 0}
+
+    @staticmethod
+    def _sizeof(vector: array) -> int:
+        return vector.itemsize * len(vector)
+
+    def _get_local(self, key: Tuple[str, str]) -> Optional[List[float]]:
+        with self._lock:
+            item = self._cache.get(key)
+            if item is not None:
+                vector, expire_at = item
+                if expire_at and expire_at < time.time():
+                    self._pop(key)
+                    self._stats["expired"] += 1
+                else:
+                    self._cache.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return vector.tolist()
+            self._stats["misses"] += 1
+            return None
+
+    def _pop(self, key: Tuple[str, str]):
+        vector, _ = self._cache.pop(key)
+        self._bytes -= self._sizeof(vector)
+
+    def _set_local(self, key: Tuple[str, str], vector: List[float]):
+        value = array("f", vector)
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        expire_at = time.time() + self.ttl if self.ttl > 0 else 0
+        with self._lock:
+            if key in self._cache:
+                self._pop(key)
+            self._cache[key] = (value, expire_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._cache)))
+                self._stats["evictions"] += 1
+
+    def _backend_key(self, key: Tuple[str, str]) -> str:
+        return f"{self.prefix}{key[0]}:{key[1]}"
+
+    def _get_backend(self, key: Tuple[str, str]) -> Optional[List[float]]:
+        try:
+            data = self.backend.get(self._backend_key(key))
+        except Exception as e:
+            logger.warning(f"读取远端查询向量缓存失败：{e}")
+            return None
+        if not data:
+            return None
+        vector = array("f")
+        vector.frombytes(data)
+        with self._lock:
+            self._stats["backend_hits"] += 1
+        return vector.tolist()
+
+    def _set_backend(self, key: Tuple[str, str], vector: List[float]):
+        try:
+            self.backend.set(
+                self._backend_key(key),
+                array("f", vector).tobytes(),
+                ex=int(self.ttl) if self.ttl > 0 else None,
+            )
+        except Exception as e:
+            logger.warning(f"写入远端查询向量缓存失败：{e}")
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = (model, text_hash(text))
+        vector = self._get_local(key)
+        if vector is None and self.backend is not None:
+            vector = self._get_backend(key)
+            if vector is not None:
+                self._set_local(key, vector)
+        return vector
+
+    def set(self, model: str, text: str, vector: List[float]):
+        key = (model, text_hash(text))
+        self._set_local(key, vector)
+        if self.backend is not None:
+            self._set_backend(key, vector)
+
+    async def aget(self, model: str, text: str) -> Optional[List[float]]:
+        key = (model, text_hash(text))
+        vector = self._get_local(key)
+        if vector is None and self.backend is not None:
+            vector = await asyncio.to_thread(self._get_backend, key)
+            if vector is not None:
+                self._set_local(key, vector)
+        return vector
+
+    async def aset(self, model: str, text: str, vector: List[float]):
+        key = (model, text_hash(text))
+        self._set_local(key, vector)
+        if self.backend is not None:
+            await asyncio.to_thread(self._set_backend, key, vector)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": self._stats["hits"] / total if total else 0.0,
+                "items": len(self._cache),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "backend": type(self.backend).__name__ if self.backend is not None else None,
+            }
+
+
+_query_cache: Optional[QueryEmbeddingCache] = None
+_query_cache_lock = threading.Lock()
+
+
+def _create_query_cache_backend(url: str) -> Any:
+    try:
+        import redis
+    except ImportError:
+        logger.warning("未安装 redis，查询向量缓存仅使用进程内缓存。请使用 pip install redis 安装")
+        return None
+    return redis.Redis.from_url(url)
+
+
+def get_query_embedding_cache() -> Optional[QueryEmbeddingCache]:
+    """
+    获取全局共享的查询向量缓存，未启用时返回 None
+    """
+    global _query_cache
+    kb_settings = Settings.kb_settings
+    if not kb_settings.QUERY_EMBEDDING_CACHE_ENABLED:
+        return None
+    if _query_cache is None:
+        with _query_cache_lock:
+            if _query_cache is None:
+                backend = None
+                if kb_settings.QUERY_EMBEDDING_CACHE_REDIS_URL:
+                    backend = _create_query_cache_backend(kb_settings.QUERY_EMBEDDING_CACHE_REDIS_URL)
+                _query_cache = QueryEmbeddingCache(
+                    max_bytes=kb_settings.QUERY_EMBEDDING_CACHE_MAX_BYTES,
+                    ttl=kb_settings.QUERY_EMBEDDING_CACHE_TTL,
+                    backend=backend,
+                )
+    return _query_cache
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    为 Embeddings 增加嵌入缓存：
+    - embed_documents 只对持久化缓存（store）中不存在的文本调用嵌入模型
+    - embed_query 优先使用查询向量缓存（query_cache）
+    其它属性和方法透传给被包装的 Embeddings 对象。
+    缓存以 model_key（见 embedding_model_key）区分模型，默认为 embed_model。
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        embed_model: str,
+        store: Optional[EmbeddingStore] = None,
+        query_cache: Optional[QueryEmbeddingCache] = None,
+        model_key: str = None,
+    ):
+        self.embeddings = embeddings
+        self.embed_model = embed_model
+        self.model_key = model_key or embed_model
+        self.store = store
+        self.query_cache = query_cache
+
+    def __getattr__(self, name: str) -> Any:
+        # 仅在实例属性中找不到时调用
+        if name in ("embeddings", "embed_model", "model_key", "store", "query_cache"):
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def _lookup(self, texts: List[str]):
+        hashes = [text_hash(t) for t in texts]
+        try:
+            cached = self.store.get_many(self.model_key, hashes)
+        except Exception as e:
+            logger.warning(f"读取嵌入缓存失败：{e}")
+            cached = {}
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = t
+        return hashes, cached, missing
+
+    def _save(self, cached: Dict, missing: Dict, vectors: List[List[float]]):
+        new_items = dict(zip(missing, vectors))
+        cached.update(new_items)
+        try:
+            self.store.put_many(self.model_key, new_items)
+        except Exception as e:
+            logger.warning(f"写入嵌入缓存失败：{e}")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.store is None:
+            return self.embeddings.embed_documents(texts)
+        hashes, cached, missing = self._lookup(texts)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self._save(cached, missing, vectors)
+        return [cached[h] for h in hashes]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.store is None:
+            return await self.embeddings.aembed_documents(texts)
+        hashes, cached, missing = self._lookup(texts)
+        if missing:
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            self._save(cached, missing, vectors)
+        return [cached[h] for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.query_cache is None:
+            return self.embeddings.embed_query(text)
+        vector = self.query_cache.get(self.model_key, text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.query_cache.set(self.model_key, text, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.query_cache is None:
+            return await self.embeddings.aembed_query(text)
+        vector = await self.query_cache.aget(self.model_key, text)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await self.query_cache.aset(self.model_key, text, vector)
+        return vector
@@ -3,6 +3,8 @@ from typing import List
 import tqdm
 from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
 
+from chatchat.server.file_rag.document_loaders.ocr import OCRBatch
+
 
 class RapidOCRDocLoader(UnstructuredFileLoader):
     def _get_elements(self) -> List:
@@ -16,11 +18,11 @@ class RapidOCRDocLoader(UnstructuredFileLoader):
             from docx.table import Table, _Cell
             from docx.text.paragraph import Paragraph
             from PIL import Image
-            from rapidocr_onnxruntime import RapidOCR
 
-            ocr = RapidOCR()
             doc = Document(filepath)
-            resp = ""
+            # 文本段落与图片按顺序记录，图片分批 OCR 后释放，最后按原顺序拼接
+            parts = []
+            batch = OCRBatch()
 
             def iter_block_items(parent):
                 from docx.document import Document
@@ -46,26 +48,27 @@ class RapidOCRDocLoader(UnstructuredFileLoader):
                 b_unit.set_description("RapidOCRDocLoader  block index: {}".format(i))
                 b_unit.refresh()
                 if isinstance(block, Paragraph):
-                    resp += block.text.strip() + "\n"
-                    images = block._element.xpath(".//pic:pic")  # 获取所有图片
-                    for image in images:
-                        for img_id in image.xpath(".//a:blip/@r:embed"):  # 获取图片id
+                    parts.append(block.text.strip() + "\n")
+                    pics = block._element.xpath(".//pic:pic")  # 获取所有图片
+                    for pic in pics:
+                        for img_id in pic.xpath(".//a:blip/@r:embed"):  # 获取图片id
                             part = doc.part.related_parts[
                                 img_id
                             ]  # 根据图片id获取对应的图片
                             if isinstance(part, ImagePart):
                                 image = Image.open(BytesIO(part._blob))
-                                result, _ = ocr(np.array(image))
-                                if result:
-                                    ocr_result = [line[1] for line in result]
-                                    resp += "\n".join(ocr_result)
+                                key = len(parts)
+                                parts.append(key)
+                                batch.add(key, np.array(image))
                 elif isinstance(block, Table):
                     for row in block.rows:
                         for cell in row.cells:
                             for paragraph in cell.paragraphs:
-                                resp += paragraph.text.strip() + "\n"
+                                parts.append(paragraph.text.strip() + "\n")
                 b_unit.update(1)
-            return resp
+
+            batch.flush()
+            return "".join(batch.get(x) if isinstance(x, int) else x for x in parts)
 
         text = doc2text(self.file_path)
         from unstructured.partition.text import partition_text
@@ -1,99 +1,163 @@
-from typing import List
+import multiprocessing as mp
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
 
 import cv2
 import numpy as np
 import tqdm
 from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
-from PIL import Image
 
 from chatchat.settings import Settings
-from chatchat.server.file_rag.document_loaders.ocr import get_ocr
+from chatchat.server.file_rag.document_loaders.ocr import OCRBatch
+
+
+PAGES_PER_TASK = 8
+"""按页并行解析时每个任务包含的页数"""
+
+
+def rotate_img(img, angle):
+    """
+    img   --image
+    angle --rotation angle
+    return--rotated img
+    """
+
+    h, w = img.shape[:2]
+    rotate_center = (w / 2, h / 2)
+    # 获取旋转矩阵
+    # 参数1为旋转中心点;
+    # 参数2为旋转角度,正值-逆时针旋转;负值-顺时针旋转
+    # 参数3为各向同性的比例因子,1.0原图，2.0变成原来的2倍，0.5变成原来的0.5倍
+    M = cv2.getRotationMatrix2D(rotate_center, angle, 1.0)
+    # 计算图像新边界
+    new_w = int(h * np.abs(M[0, 1]) + w * np.abs(M[0, 0]))
+    new_h = int(h * np.abs(M[0, 0]) + w * np.abs(M[0, 1]))
+    # 调整旋转矩阵以考虑平移
+    M[0, 2] += (new_w - w) / 2
+    M[1, 2] += (new_h - h) / 2
+
+    rotated_img = cv2.warpAffine(img, M, (new_w, new_h))
+    return rotated_img
+
+
+def pdf_pages2text(filepath: str, page_numbers: List[int]) -> List[Tuple[int, str]]:
+    """
+    提取 PDF 指定页的文字，并对超过阈值的图片进行 OCR。返回 [(页码（从 0 开始）, 文本), ...]
+    同一图片（xref）在多页中重复出现时只识别一次；图片按 OCR_BATCH_MAX_MB 分批识别后即释放，结果按图片哈希持久化缓存。
+    作为模块级函数，可以提交到进程池中执行。
+    """
+    import fitz  # pyMuPDF里面的fitz包，不要与pip install fitz混淆
+
+    threshold = Settings.kb_settings.PDF_OCR_THRESHOLD
+    batch = OCRBatch()
+    pages = []  # [(页码, 页面文字, [图片键, ...]), ...]
+    with fitz.open(filepath) as doc:
+        for i in page_numbers:
+            page = doc[i]
+            image_keys = []
+            for img in page.get_image_info(xrefs=True):
+                if not (xref := img.get("xref")):
+                    continue
+                bbox = img["bbox"]
+                # 检查图片尺寸是否超过设定的阈值
+                if (bbox[2] - bbox[0]) / page.rect.width < threshold[0] or (
+                    bbox[3] - bbox[1]
+                ) / page.rect.height < threshold[1]:
+                    continue
+                key = (xref, int(page.rotation))
+                if key not in batch:
+                    pix = fitz.Pixmap(doc, xref)
+                    img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(
+                        pix.height, pix.width, -1
+                    )
+                    if int(page.rotation) != 0:  # 如果Page有旋转角度，则旋转图片
+                        ori_img = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+                        rot_img = rotate_img(img=ori_img, angle=360 - page.rotation)
+                        img_array = cv2.cvtColor(rot_img, cv2.COLOR_RGB2BGR)
+                    batch.add(key, img_array)
+                image_keys.append(key)
+            pages.append((i, page.get_text(""), image_keys))
+    batch.flush()
+
+    results = []
+    for i, text, image_keys in pages:
+        parts = [text] + [batch.get(k) for k in image_keys if batch.get(k)]
+        results.append((i, "\n".join(parts)))
+    return results
+
+
+_page_pool: ProcessPoolExecutor = None
+_page_pool_workers: int = 0
+_page_pool_lock = threading.Lock()
+
+
+def get_page_pool(max_workers: int) -> ProcessPoolExecutor:
+    """PDF 按页解析使用的进程池，在多个文件间复用，子进程中的 OCR 引擎也随之复用"""
+    global _page_pool, _page_pool_workers
+    with _page_pool_lock:
+        if _page_pool is None or _page_pool_workers != max_workers:
+            if _page_pool is not None:
+                _page_pool.shutdown(wait=False)
+            _page_pool = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=mp.get_context("spawn")
+            )
+            _page_pool_workers = max_workers
+        return _page_pool
+
+
+def pdf2text(filepath: str) -> List[Tuple[int, str]]:
+    """
+    按页提取 PDF 文本，页数较多时将页面分段提交到进程池并行处理。返回按页码排序的 [(页码, 文本), ...]
+    """
+    import fitz
+
+    from chatchat.server.knowledge_base.utils import PARSE_WORKER_ENV
+
+    with fitz.open(filepath) as doc:
+        page_count = doc.page_count
+    workers = Settings.kb_settings.PDF_OCR_WORKERS
+    # 已经在解析文件的子进程中时不再嵌套创建进程池
+    if workers <= 1 or page_count <= PAGES_PER_TASK or os.environ.get(PARSE_WORKER_ENV):
+        return pdf_pages2text(filepath, list(range(page_count)))
+
+    # 连续的页面分到同一任务中，重复使用的图片更可能在同一进程中只识别一次
+    pool = get_page_pool(workers)
+    tasks = [
+        pool.submit(pdf_pages2text, filepath, list(range(start, min(start + PAGES_PER_TASK, page_count))))
+        for start in range(0, page_count, PAGES_PER_TASK)
+    ]
+    results = []
+    with tqdm.tqdm(total=page_count, desc="RapidOCRPDFLoader pages") as b_unit:
+        for task in as_completed(tasks):
+            pages = task.result()
+            results.extend(pages)
+            b_unit.update(len(pages))
+    results.sort(key=lambda x: x[0])
+    return results
 
 
 class RapidOCRPDFLoader(UnstructuredFileLoader):
+    """
+    提取 PDF 文本并对其中的图片进行 OCR。默认（mode="single"）将全部页面合并为一个 Document；
+    指定 mode="paged" 时每页生成一个 Document，metadata 中的 page_number 为页码（从 1 开始）。
+    """
+
     def _get_elements(self) -> List:
-        def rotate_img(img, angle):
-            """
-            img   --image
-            angle --rotation angle
-            return--rotated img
-            """
-
-            h, w = img.shape[:2]
-            rotate_center = (w / 2, h / 2)
-            # 获取旋转矩阵
-            # 参数1为旋转中心点;
-            # 参数2为旋转角度,正值-逆时针旋转;负值-顺时针旋转
-            # 参数3为各向同性的比例因子,1.0原图，2.0变成原来的2倍，0.5变成原来的0.5倍
-            M = cv2.getRotationMatrix2D(rotate_center, angle, 1.0)
-            # 计算图像新边界
-            new_w = int(h * np.abs(M[0, 1]) + w * np.abs(M[0, 0]))
-            new_h = int(h * np.abs(M[0, 0]) + w * np.abs(M[0, 1]))
-            # 调整旋转矩阵以考虑平移
-            M[0, 2] += (new_w - w) / 2
-            M[1, 2] += (new_h - h) / 2
-
-            rotated_img = cv2.warpAffine(img, M, (new_w, new_h))
-            return rotated_img
-
-        def pdf2text(filepath):
-            import fitz  # pyMuPDF里面的fitz包，不要与pip install fitz混淆
-            import numpy as np
-
-            ocr = get_ocr()
-            doc = fitz.open(filepath)
-            resp = ""
-
-            b_unit = tqdm.tqdm(
-                total=doc.page_count, desc="RapidOCRPDFLoader context page index: 0"
-            )
-            for i, page in enumerate(doc):
-                b_unit.set_description(
-                    "RapidOCRPDFLoader context page index: {}".format(i)
-                )
-                b_unit.refresh()
-                text = page.get_text("")
-                resp += text + "\n"
-
-                img_list = page.get_image_info(xrefs=True)
-                for img in img_list:
-                    if xref := img.get("xref"):
-                        bbox = img["bbox"]
-                        # 检查图片尺寸是否超过设定的阈值
-                        if (bbox[2] - bbox[0]) / (page.rect.width) < Settings.kb_settings.PDF_OCR_THRESHOLD[
-                            0
-                        ] or (bbox[3] - bbox[1]) / (
-                            page.rect.height
-                        ) < Settings.kb_settings.PDF_OCR_THRESHOLD[1]:
-                            continue
-                        pix = fitz.Pixmap(doc, xref)
-                        samples = pix.samples
-                        if int(page.rotation) != 0:  # 如果Page有旋转角度，则旋转图片
-                            img_array = np.frombuffer(
-                                pix.samples, dtype=np.uint8
-                            ).reshape(pix.height, pix.width, -1)
-                            tmp_img = Image.fromarray(img_array)
-                            ori_img = cv2.cvtColor(np.array(tmp_img), cv2.COLOR_RGB2BGR)
-                            rot_img = rotate_img(img=ori_img, angle=360 - page.rotation)
-                            img_array = cv2.cvtColor(rot_img, cv2.COLOR_RGB2BGR)
-                        else:
-                            img_array = np.frombuffer(
-                                pix.samples, dtype=np.uint8
-                            ).reshape(pix.height, pix.width, -1)
-
-                        result, _ = ocr(img_array)
-                        if result:
-                            ocr_result = [line[1] for line in result]
-                            resp += "\n".join(ocr_result)
-
-                # 更新进度
-                b_unit.update(1)
-            return resp
-
-        text = pdf2text(self.file_path)
         from unstructured.partition.text import partition_text
 
-        return partition_text(text=text, **self.unstructured_kwargs)
+        pages = pdf2text(self.file_path)
+        if self.mode != "paged":
+            text = "\n".join(text for _, text in pages)
+            return partition_text(text=text, **self.unstructured_kwargs)
+
+        elements = []
+        for i, text in pages:
+            for element in partition_text(text=text, **self.unstructured_kwargs):
+                element.metadata.page_number = i + 1
+                elements.append(element)
+        return elements
 
 
 if __name__ == "__main__":
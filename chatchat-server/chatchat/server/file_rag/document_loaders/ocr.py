@@ -1,4 +1,16 @@
-from typing import TYPE_CHECKING
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Generator, Hashable, List, Optional, Union
+
+import numpy as np
+
+from chatchat.settings import Settings
 
 if TYPE_CHECKING:
     try:
@@ -19,3 +31,222 @@ def get_ocr(use_cuda: bool = True) -> "RapidOCR":
 
         ocr = RapidOCR()
     return ocr
+
+
+class OCREnginePool:
+    """
+    进程内共用的 OCR 引擎池。引擎在首次使用时创建，之后在所有文件、所有加载器间复用，
+    避免每个文件都重新加载模型。RapidOCR 实例不保证线程安全，每个引擎同一时间只被一个线程使用，
+    size 个引擎可以同时识别 size 张图片。
+    """
+
+    def __init__(self, size: int = 1):
+        self.size = max(1, size)
+        self._engines: "queue.Queue[RapidOCR]" = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor = None
+
+    @contextmanager
+    def acquire(self) -> Generator["RapidOCR", None, None]:
+        engine = None
+        with self._lock:
+            if self._engines.empty() and self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                engine = get_ocr()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        else:
+            engine = self._engines.get()
+        try:
+            yield engine
+        finally:
+            self._engines.put(engine)
+
+    def recognize(self, img: Union[np.ndarray, str]) -> str:
+        with self.acquire() as engine:
+            result, _ = engine(img)
+        return "\n".join(line[1] for line in result) if result else ""
+
+    def recognize_many(self, imgs: List[Union[np.ndarray, str]]) -> List[str]:
+        """同时使用多个引擎识别一批图片，返回结果与输入顺序一致"""
+        if self.size == 1 or len(imgs) <= 1:
+            return [self.recognize(img) for img in imgs]
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.size, thread_name_prefix="ocr")
+        return list(self._executor.map(self.recognize, imgs))
+
+
+_ocr_pool: OCREnginePool = None
+_ocr_pool_lock = threading.Lock()
+
+
+def get_ocr_pool() -> OCREnginePool:
+    """获取进程内共用的 OCR 引擎池，引擎数量由 OCR_ENGINE_NUM 配置"""
+    global _ocr_pool
+    if _ocr_pool is None:
+        with _ocr_pool_lock:
+            if _ocr_pool is None:
+                _ocr_pool = OCREnginePool(Settings.kb_settings.OCR_ENGINE_NUM)
+    return _ocr_pool
+
+
+def image_hash(img: Union[np.ndarray, str]) -> str:
+    """
+    计算图片的 sha256，作为 OCR 结果缓存的键。
+    数组按尺寸和像素内容计算，图片文件路径按文件内容计算
+    """
+    if isinstance(img, np.ndarray):
+        h = hashlib.sha256(str(img.shape).encode())
+        h.update(np.ascontiguousarray(img).tobytes())
+    else:
+        h = hashlib.sha256(b"file:")
+        with open(img, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+class OCRResultCache:
+    """
+    以图片哈希为键的持久化 OCR 结果缓存，使用 SQLite 存储。
+    重复解析同一文件、不同文件中包含相同图片（如页眉 logo、扫描模板）时无需再次识别。
+    多个解析进程可以共用同一个数据库文件。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ocr_results (
+                hash TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                create_time REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        result = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i: i + 500]
+                rows = self._conn.execute(
+                    f"SELECT hash, text FROM ocr_results WHERE hash IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                result.update(rows)
+            self._stats["hits"] += len(result)
+            self._stats["misses"] += len(keys) - len(result)
+        return result
+
+    def set_many(self, items: Dict[str, str]):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ocr_results (hash, text, create_time) VALUES (?, ?, ?)",
+                [(k, v, now) for k, v in items.items()],
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM ocr_results").fetchone()[0]
+            return {**self._stats, "items": count}
+
+
+_ocr_cache: OCRResultCache = None
+_ocr_cache_lock = threading.Lock()
+
+
+def get_ocr_cache() -> Optional[OCRResultCache]:
+    """获取进程内共用的 OCR 结果缓存，未启用时返回 None"""
+    global _ocr_cache
+    if not Settings.kb_settings.OCR_CACHE_ENABLED:
+        return None
+    if _ocr_cache is None:
+        with _ocr_cache_lock:
+            if _ocr_cache is None:
+                _ocr_cache = OCRResultCache(Settings.basic_settings.OCR_CACHE_PATH)
+    return _ocr_cache
+
+
+def ocr_images(imgs: List[Union[np.ndarray, str]]) -> List[str]:
+    """
+    批量识别图片中的文字，返回每张图片按行拼接的文本，顺序与输入一致。
+    相同的图片只识别一次，结果按图片哈希持久化缓存，未命中的图片由引擎池并发识别。
+    """
+    if not imgs:
+        return []
+    keys = [image_hash(img) for img in imgs]
+    cache = get_ocr_cache()
+    texts = cache.get_many(list(set(keys))) if cache is not None else {}
+
+    pending = {}
+    for key, img in zip(keys, imgs):
+        if key not in texts:
+            pending.setdefault(key, img)
+    if pending:
+        results = dict(zip(pending, get_ocr_pool().recognize_many(list(pending.values()))))
+        if cache is not None:
+            cache.set_many(results)
+        texts.update(results)
+    return [texts[key] for key in keys]
+
+
+class OCRBatch:
+    """
+    分批识别一个文件中的图片。加入的图片暂存到总大小达到 OCR_BATCH_MAX_MB 时批量识别，
+    识别后只保留文本，释放图片数组；同一键（如 PDF 图片的 xref）只识别一次。
+    """
+
+    def __init__(self, max_bytes: int = None):
+        if max_bytes is None:
+            max_bytes = Settings.kb_settings.OCR_BATCH_MAX_MB * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.texts: Dict[Hashable, str] = {}
+        self._pending: Dict[Hashable, np.ndarray] = {}
+        self._pending_bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.texts or key in self._pending
+
+    def add(self, key: Hashable, img: np.ndarray):
+        if key in self:
+            return
+        self._pending[key] = img
+        self._pending_bytes += img.nbytes
+        if self._pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending, self._pending_bytes = self._pending, {}, 0
+        self.texts.update(zip(pending, ocr_images(list(pending.values()))))
+
+    def get(self, key: Hashable) -> str:
+        if key in self._pending:
+            self.flush()
+        return self.texts[key]
+
+
+def ocr_image(img: Union[np.ndarray, str]) -> str:
+    """识别单张图片中的文字，返回按行拼接的文本"""
+    return ocr_images([img])[0]
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import heapq
+import math
+import os
+import pickle
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from langchain.docstore.document import Document
+from langchain_core.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+from chatchat.utils import build_logger
+
+
+logger = build_logger()
+
+BM25_INDEX_FILE = "bm25.pkl"
+
+
+def default_tokenizer(text: str) -> List[str]:
+    """
+    与原 BM25Retriever 保持一致，使用 jieba 搜索引擎模式分词，并去掉空白词
+    """
+    import jieba
+
+    return [t for t in jieba.lcut_for_search(text) if t.strip()]
+
+
+class BM25Index:
+    """
+    可增量更新的 BM25 倒排索引。
+    每个知识库构建一次并与 index.faiss 一同保存到磁盘，
+    新增/删除文档时只处理变化的文档，检索时只需查询倒排表，无需对整个知识库重新分词。
+
+    idf 使用 log(1 + (N - n + 0.5) / (n + 0.5))，保证增量更新时分数非负且无需全量重算。
+    """
+
+    version = 1
+
+    def __init__(
+        self,
+        k1: float = 1.5,
+        b: float = 0.75,
+        tokenizer: Callable[[str], List[str]] = default_tokenizer,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = tokenizer
+        self._postings: Dict[str, Dict[str, int]] = {}  # term -> {doc_id: tf}
+        self._doc_terms: Dict[str, Tuple[str, ...]] = {}  # doc_id -> unique terms, 删除时使用
+        self._doc_len: Dict[str, int] = {}
+        self._total_len = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_len)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._doc_len
+
+    def doc_ids(self) -> List[str]:
+        return list(self._doc_len)
+
+    def add_documents(self, ids: Iterable[str], texts: Iterable[str]):
+        for doc_id, text in zip(ids, texts):
+            if doc_id in self._doc_len:
+                self._remove(doc_id)
+            tokens = self.tokenizer(text or "")
+            tf: Dict[str, int] = {}
+            for token in tokens:
+                tf[token] = tf.get(token, 0) + 1
+            for term, freq in tf.items():
+                self._postings.setdefault(term, {})[doc_id] = freq
+            self._doc_terms[doc_id] = tuple(tf)
+            self._doc_len[doc_id] = len(tokens)
+            self._total_len += len(tokens)
+
+    def delete(self, ids: Iterable[str]):
+        for doc_id in ids:
+            if doc_id in self._doc_len:
+                self._remove(doc_id)
+
+    def clear(self):
+        self._postings.clear()
+        self._doc_terms.clear()
+        self._doc_len.clear()
+        self._total_len = 0
+
+    def _remove(self, doc_id: str):
+        for term in self._doc_terms.pop(doc_id, ()):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_len -= self._doc_len.pop(doc_id, 0)
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[str, float]]:
+        """
+        返回 [(doc_id, score), ...]，按分数从高到低排列
+        """
+        n_docs = len(self._doc_len)
+        if n_docs == 0 or k <= 0:
+            return []
+        avgdl = (self._total_len / n_docs) or 1.0
+        k1, b = self.k1, self.b
+        scores: Dict[str, float] = {}
+        for token in self.tokenizer(query):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            n = len(postings)
+            idf = math.log(1 + (n_docs - n + 0.5) / (n + 0.5))
+            for doc_id, tf in postings.items():
+                dl = self._doc_len[doc_id]
+                score = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+        return heapq.nlargest(k, scores.items(), key=lambda x: x[1])
+
+    def save(self, path: str):
+        data = {
+            "version": self.version,
+            "k1": self.k1,
+            "b": self.b,
+            "postings": self._postings,
+            "doc_terms": self._doc_terms,
+            "doc_len": self._doc_len,
+            "total_len": self._total_len,
+        }
+        # 先写入临时文件再替换，避免写入中断导致索引文件损坏
+        file = os.path.join(path, BM25_INDEX_FILE)
+        with open(file + ".tmp", "wb") as fp:
+            pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file + ".tmp", file)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["BM25Index"]:
+        """
+        从向量库目录加载索引，文件不存在或版本不匹配时返回 None
+        """
+        file = os.path.join(path, BM25_INDEX_FILE)
+        if not os.path.isfile(file):
+            return None
+        try:
+            with open(file, "rb") as fp:
+                data = pickle.load(fp)
+            if data.get("version") != cls.version:
+                return None
+            index = cls(k1=data["k1"], b=data["b"])
+            index._postings = data["postings"]
+            index._doc_terms = data["doc_terms"]
+            index._doc_len = data["doc_len"]
+            index._total_len = data["total_len"]
+            return index
+        except Exception as e:
+            logger.warning(f"加载 BM25 索引 {file} 失败，将重新构建：{e}")
+            return None
+
+    @classmethod
+    def from_docstore(cls, docstore_dict: Dict[str, Document], **kwargs) -> "BM25Index":
+        index = cls(**kwargs)
+        ids, texts = [], []
+        for doc_id, doc in docstore_dict.items():
+            ids.append(doc_id)
+            texts.append(doc.page_content)
+        index.add_documents(ids, texts)
+        return index
+
+
+class BM25IndexRetriever(BaseRetriever):
+    """
+    基于 BM25Index 的检索器，文档内容从向量库的 docstore 中按 id 读取
+    """
+
+    index: Any
+    docstore: Any
+    k: int = 4
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        ids = [doc_id for doc_id, _ in self.index.search(query, k=self.k)]
+        if hasattr(self.docstore, "mget"):  # SQLiteDocstore 支持批量读取
+            docs = self.docstore.mget(ids)
+        else:
+            docs = [self.docstore.search(doc_id) for doc_id in ids]
+        return [doc for doc in docs if isinstance(doc, Document)]
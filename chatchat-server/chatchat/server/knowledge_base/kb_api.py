@@ -4,6 +4,8 @@ from fastapi import Body
 
 from chatchat.settings import Settings
 from chatchat.server.db.repository.knowledge_base_repository import list_kbs_from_db
+from chatchat.server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool, memo_faiss_pool
+from chatchat.server.knowledge_base.kb_jobs import kb_sync_write
 from chatchat.server.knowledge_base.kb_service.base import KBServiceFactory
 from chatchat.server.knowledge_base.utils import validate_kb_name
 from chatchat.server.utils import BaseResponse, ListResponse, get_default_embedding
@@ -54,20 +56,33 @@ def delete_kb(
     if not validate_kb_name(knowledge_base_name):
         return BaseResponse(code=403, msg="Don't attack me")
     knowledge_base_name = urllib.parse.unquote(knowledge_base_name)
-
-    kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
-
-    if kb is None:
-        return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
-
-    try:
-        status = kb.clear_vs()
-        status = kb.drop_kb()
-        if status:
-            return BaseResponse(code=200, msg=f"成功删除知识库 {knowledge_base_name}")
-    except Exception as e:
-        msg = f"删除知识库时出现意外： {e}"
-        logger.error(f"{e.__class__.__name__}: {msg}")
-        return BaseResponse(code=500, msg=msg)
-
-    return BaseResponse(code=500, msg=f"删除知识库失败 {knowledge_base_name}")
+    with kb_sync_write(knowledge_base_name) as msg:
+        if msg:
+            return BaseResponse(code=409, msg=msg)
+
+        kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
+
+        if kb is None:
+            return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
+
+        try:
+            status = kb.clear_vs()
+            status = kb.drop_kb()
+            if status:
+                return BaseResponse(code=200, msg=f"成功删除知识库 {knowledge_base_name}")
+        except Exception as e:
+            msg = f"删除知识库时出现意外： {e}"
+            logger.error(f"{e.__class__.__name__}: {msg}")
+            return BaseResponse(code=500, msg=msg)
+
+        return BaseResponse(code=500, msg=f"删除知识库失败 {knowledge_base_name}")
+
+
+def get_vs_cache_stats():
+    """
+    获取 FAISS 向量库缓存池的驻留、内存占用和命中率统计
+    """
+    return BaseResponse(data={
+        "kb_faiss_pool": kb_faiss_pool.stats(),
+        "memo_faiss_pool": memo_faiss_pool.stats(),
+    })
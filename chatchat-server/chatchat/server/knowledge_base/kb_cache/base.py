@@ -1,7 +1,8 @@
 import threading
+import time
 from collections import OrderedDict
 from contextlib import contextmanager
-from typing import Any, List, Tuple, Union, Generator
+from typing import Any, Dict, List, Optional, Tuple, Union, Generator
 
 from langchain_community.vectorstores.faiss import FAISS
 
@@ -11,6 +12,121 @@ from chatchat.utils import build_logger
 logger = build_logger()
 
 
+class RWLock:
+    """
+    读写锁：读操作（如检索）之间可以并发，写操作（增删、保存、清空）独占。
+    - 写优先：有写操作在等待时，新的读操作需要排队，避免写操作饿死
+    - 写锁可重入；持有写锁的线程可以再获取读锁；持有读锁的线程可以再次获取读锁
+    - 不支持读锁升级为写锁，会直接报错以避免死锁
+    - 记录读/写锁的等待次数、总等待时间和最长等待时间
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers: Dict[int, int] = {}  # thread id -> 重入次数
+        self._writer: int = None
+        self._writer_count = 0
+        self._writers_waiting = 0
+        self._stats = {
+            mode: {"count": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for mode in ("read", "write")
+        }
+
+    def _record(self, mode: str, wait: float):
+        stats = self._stats[mode]
+        stats["count"] += 1
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        start = time.perf_counter()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                # 重入时不等待，否则会被排队中的写操作阻塞而死锁
+                self._readers[me] = self._readers.get(me, 0) + 1
+            else:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                self._readers[me] = 1
+            self._record("read", time.perf_counter() - start)
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            count = self._readers.get(me, 0)
+            if count <= 0:
+                raise RuntimeError("释放未持有的读锁")
+            if count == 1:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+            else:
+                self._readers[me] = count - 1
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        start = time.perf_counter()
+        with self._cond:
+            if self._writer == me:
+                self._writer_count += 1
+            else:
+                if me in self._readers:
+                    raise RuntimeError("不支持将读锁升级为写锁")
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer = me
+                self._writer_count = 1
+            self._record("write", time.perf_counter() - start)
+
+    def release_write(self):
+        with self._cond:
+            if self._writer != threading.get_ident():
+                raise RuntimeError("释放未持有的写锁")
+            self._writer_count -= 1
+            if self._writer_count == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    def locked(self) -> bool:
+        """是否有线程持有读锁或写锁"""
+        with self._cond:
+            return self._writer is not None or bool(self._readers)
+
+    @contextmanager
+    def read_lock(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_lock(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            result = {}
+            for mode, stats in self._stats.items():
+                result[mode] = {
+                    **stats,
+                    "wait_avg": stats["wait_total"] / stats["count"] if stats["count"] else 0.0,
+                }
+            result["readers"] = sum(self._readers.values())
+            result["writer_held"] = self._writer is not None
+            result["writers_waiting"] = self._writers_waiting
+            return result
+
+
 class ThreadSafeObject:
     def __init__(
         self, key: Union[str, Tuple], obj: Any = None, pool: "CachePool" = None
@@ -18,8 +134,16 @@ class ThreadSafeObject:
         self._obj = obj
         self._key = key
         self._pool = pool
-        self._lock = threading.RLock()
+        self._lock = RWLock()
         self._loaded = threading.Event()
+        self._access_count = 0
+        self._last_access = time.time()
+        self._dirty = False
+        self._discarded = False
+        self._dirty_since = 0.0
+        self._last_persisted = 0.0
+        self._size = 0
+        self._size_stale = True
 
     def __repr__(self) -> str:
         cls = type(self).__name__
@@ -30,17 +154,120 @@ class ThreadSafeObject:
         return self._key
 
     @contextmanager
-    def acquire(self, owner: str = "", msg: str = "") -> Generator[None, None, FAISS]:
+    def acquire(
+        self, owner: str = "", msg: str = "", shared: bool = False
+    ) -> Generator[None, None, FAISS]:
+        """
+        获取对象的锁。shared=True 时获取读锁，用于检索等只读操作，可与其它读操作并发；
+        否则获取独占的写锁。
+        """
         owner = owner or f"thread {threading.get_native_id()}"
+        if shared:
+            self._lock.acquire_read()
+        else:
+            self._lock.acquire_write()
         try:
-            self._lock.acquire()
-            if self._pool is not None:
-                self._pool._cache.move_to_end(self.key)
+            if self._pool is not None and self.key in self._pool._cache:
+                try:
+                    self._pool._cache.move_to_end(self.key)
+                except KeyError:  # 对象已被淘汰或丢弃，调用方仍持有引用
+                    pass
+            self._access_count += 1
+            self._last_access = time.time()
+            if not shared:
+                self._size_stale = True
             logger.debug(f"{owner} 开始操作：{self.key}。{msg}")
             yield self._obj
         finally:
             logger.debug(f"{owner} 结束操作：{self.key}。{msg}")
-            self._lock.release()
+            if shared:
+                self._lock.release_read()
+            else:
+                self._lock.release_write()
+
+    def lock_stats(self) -> Dict:
+        return self._lock.stats()
+
+    def is_held(self) -> bool:
+        return self._lock.locked()
+
+    def is_loaded(self) -> bool:
+        return self._loaded.is_set()
+
+    @property
+    def dirty(self) -> bool:
+        """对象是否有尚未保存到磁盘的修改"""
+        return self._dirty
+
+    def mark_dirty(self):
+        if not self._dirty:
+            self._dirty_since = time.time()
+        self._dirty = True
+        if self._pool is not None:
+            self._pool.track_dirty(self)
+
+    def mark_clean(self):
+        self._dirty = False
+        self._last_persisted = time.time()
+        if self._pool is not None:
+            self._pool.untrack_dirty(self)
+
+    @property
+    def discarded(self) -> bool:
+        """对象是否已被丢弃（知识库被清空、删除或在其它进程中重建），丢弃后不再保存"""
+        return self._discarded
+
+    def discard(self):
+        """
+        丢弃对象及其未保存的修改，之后的 flush/save 不再写入磁盘。需要在持有写锁时调用，
+        使已经开始的保存先完成
+        """
+        self._discarded = True
+        self.mark_clean()
+
+    def persist_lag(self) -> float:
+        """最早一次未保存的修改距今的时间（秒），没有未保存的修改时为 0"""
+        return time.time() - self._dirty_since if self._dirty else 0.0
+
+    def flush(self):
+        """将尚未保存的修改写入磁盘，由子类实现"""
+        pass
+
+    def memory_size(self) -> int:
+        """
+        对象占用内存的估计值（字节）。写操作后重新计算，子类通过 _compute_memory_size 实现
+        """
+        # 正在写入的对象沿用上次的估计值，避免遍历时对象被修改
+        if self._size_stale and self._obj is not None and not self.is_held():
+            try:
+                self._size = self._compute_memory_size()
+                self._size_stale = False
+            except RuntimeError:
+                pass
+        return self._size
+
+    def _compute_memory_size(self) -> int:
+        return 0
+
+    def eviction_score(self, now: float, half_life: float) -> float:
+        """
+        LRU/LFU 混合评分：访问次数按距上次访问的时间指数衰减，分数越低越先被淘汰
+        """
+        return self._access_count * 0.5 ** ((now - self._last_access) / half_life)
+
+    def info(self) -> Dict:
+        return {
+            "key": self.key,
+            "loaded": self.is_loaded(),
+            "memory_size": self.memory_size(),
+            "access_count": self._access_count,
+            "last_access": self._last_access,
+            "dirty": self._dirty,
+            "persist_lag": self.persist_lag(),
+            "last_persisted": self._last_persisted,
+            "held": self.is_held(),
+            "lock": self.lock_stats(),
+        }
 
     def start_loading(self):
         self._loaded.clear()
@@ -61,18 +288,114 @@ class ThreadSafeObject:
 
 
 class CachePool:
-    def __init__(self, cache_num: int = -1):
+    """
+    缓存池，可同时按数量（cache_num）和内存预算（memory_budget，字节）限制缓存对象。
+    超出限制时按 LRU/LFU 混合评分淘汰对象，跳过正在使用或加载中的对象。
+    有未保存修改的对象淘汰后仍保留在待保存表中，由后台线程保存，不在持有缓存池锁时写入磁盘。
+    """
+
+    eviction_half_life: float = 600
+    """淘汰评分中访问次数的衰减半衰期（秒）"""
+
+    def __init__(self, cache_num: int = -1, memory_budget: int = 0):
         self._cache_num = cache_num
+        self._memory_budget = memory_budget
         self._cache = OrderedDict()
         self.atomic = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        # 有未保存修改的对象，保存前不会移除：对象被淘汰、丢弃或调用方持有旧引用时修改也不会丢失
+        self._dirty_items: Dict[int, ThreadSafeObject] = {}
+        self._dirty_lock = threading.Lock()
 
     def keys(self) -> List[str]:
         return list(self._cache.keys())
 
-    def _check_count(self):
-        if isinstance(self._cache_num, int) and self._cache_num > 0:
-            while len(self._cache) > self._cache_num:
-                self._cache.popitem(last=False)
+    def track_dirty(self, obj: ThreadSafeObject):
+        with self._dirty_lock:
+            self._dirty_items[id(obj)] = obj
+
+    def untrack_dirty(self, obj: ThreadSafeObject):
+        with self._dirty_lock:
+            self._dirty_items.pop(id(obj), None)
+
+    def dirty_items(self) -> List[ThreadSafeObject]:
+        """所有有未保存修改的对象，包括已不在缓存中的对象"""
+        with self._dirty_lock:
+            return list(self._dirty_items.values())
+
+    def record_access(self, hit: bool):
+        self._stats["hits" if hit else "misses"] += 1
+
+    def dirty_item(self, key: Union[str, Tuple]) -> Optional[ThreadSafeObject]:
+        """已被淘汰、尚未保存的对象，重新加载时直接放回缓存，不从磁盘读取旧版本"""
+        with self._dirty_lock:
+            for obj in self._dirty_items.values():
+                if obj.key == key and not obj.discarded:
+                    return obj
+
+    def memory_size(self) -> int:
+        return sum(x.memory_size() for x in list(self._cache.values()))
+
+    def _over_limit(self, sizes: Dict[int, int]) -> bool:
+        if isinstance(self._cache_num, int) and 0 < self._cache_num < len(self._cache):
+            return True
+        if self._memory_budget <= 0:
+            return False
+        return self._memory_budget < sum(sizes.get(id(x), 0) for x in self._cache.values())
+
+    def _check_count(self, exclude: Union[str, Tuple] = None):
+        """
+        超出限制时淘汰对象。exclude 为即将返回给调用方的对象，不参与淘汰，
+        否则调用方拿到的对象可能已不在缓存中，之后的写入会丢失。
+        对象的内存占用在锁外计算；锁内只从缓存中移除对象，有未保存修改的对象由后台线程保存
+        """
+        # 不能在持有 atomic 时调用：memory_size 可能遍历整个 docstore
+        sizes = {id(x): x.memory_size() for x in list(self._cache.values())}
+        evicted = []
+        with self.atomic:
+            while self._over_limit(sizes):
+                now = time.time()
+                candidates = [
+                    x for x in self._cache.values()
+                    if x.is_loaded() and not x.is_held() and x.key != exclude
+                ]
+                if not candidates:
+                    logger.warning(f"缓存超出限制，但所有对象都在使用中，暂不淘汰：{self.keys()}")
+                    break
+                victim = min(
+                    candidates, key=lambda x: x.eviction_score(now, self.eviction_half_life)
+                )
+                self._cache.pop(victim.key, None)
+                self._stats["evictions"] += 1
+                evicted.append(victim)
+                logger.info(f"缓存超出限制，已释放：{victim.key}")
+        if dirty := [x for x in evicted if x.dirty]:
+            threading.Thread(
+                target=self._flush_evicted, args=(dirty,), name="cache_evict_flush", daemon=True
+            ).start()
+
+    @staticmethod
+    def _flush_evicted(items: List[ThreadSafeObject]):
+        # 保存失败的对象仍在待保存表中，由延迟保存线程或退出前的 flush_all 重试
+        for item in items:
+            try:
+                item.flush()
+            except Exception as e:
+                logger.exception(f"保存已淘汰的 {item.key} 失败：{e}")
+
+    def stats(self) -> Dict:
+        with self.atomic:
+            items = [x.info() for x in self._cache.values()]
+            total = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": self._stats["hits"] / total if total else 0.0,
+                "cache_num": self._cache_num,
+                "memory_budget": self._memory_budget,
+                "memory_size": sum(x["memory_size"] for x in items),
+                "max_persist_lag": max([x["persist_lag"] for x in items], default=0.0),
+                "items": items,
+            }
 
     def get(self, key: str) -> ThreadSafeObject:
         if cache := self._cache.get(key):
@@ -80,8 +403,10 @@ class CachePool:
             return cache
 
     def set(self, key: str, obj: ThreadSafeObject) -> ThreadSafeObject:
+        """
+        加入缓存，不检查是否超出限制：调用方通常持有 atomic，需要在释放后调用 _check_count
+        """
         self._cache[key] = obj
-        self._check_count()
         return obj
 
     def pop(self, key: str = None) -> ThreadSafeObject:
@@ -90,12 +415,42 @@ class CachePool:
         else:
             return self._cache.pop(key, None)
 
-    def acquire(self, key: Union[str, Tuple], owner: str = "", msg: str = ""):
+    def acquire(
+        self, key: Union[str, Tuple], owner: str = "", msg: str = "", shared: bool = False
+    ):
         cache = self.get(key)
         if cache is None:
             raise RuntimeError(f"请求的资源 {key} 不存在")
         elif isinstance(cache, ThreadSafeObject):
             self._cache.move_to_end(key)
-            return cache.acquire(owner=owner, msg=msg)
+            return cache.acquire(owner=owner, msg=msg, shared=shared)
         else:
             return cache
+
+
+if __name__ == "__main__":
+    # 并发检索压测：对比独占锁与读写锁下，检索 QPS 随线程数的变化
+    from concurrent.futures import ThreadPoolExecutor
+
+    import faiss
+    import numpy as np
+
+    dim, n_vectors, n_queries = 768, 100000, 2000
+    index = faiss.IndexFlatIP(dim)
+    index.add(np.random.rand(n_vectors, dim).astype("float32"))
+    queries = np.random.rand(n_queries, dim).astype("float32")
+    item = ThreadSafeObject("bench", obj=index)
+
+    def search(i: int, shared: bool):
+        with item.acquire(shared=shared) as idx:
+            idx.search(queries[i: i + 1], 4)
+
+    faiss.omp_set_num_threads(1)  # 单次检索单线程，由外部线程数决定并发度
+    for threads in (1, 2, 4, 8):
+        for shared in (False, True):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(threads) as pool:
+                list(pool.map(lambda i: search(i, shared), range(n_queries)))
+            qps = n_queries / (time.perf_counter() - start)
+            print(f"threads={threads} {'shared' if shared else 'exclusive':<9}: {qps:8.1f} qps")
+    print(item.lock_stats())
@@ -1,10 +1,20 @@
+import atexit
 import os
+import pickle
+import shutil
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
 
 from langchain.schema import Document
 from langchain_community.docstore.in_memory import InMemoryDocstore
 
 from chatchat.settings import Settings
+from chatchat.server.db.models.base import name_key
+from chatchat.server.file_rag.retrievers.bm25_index import BM25_INDEX_FILE, BM25Index
 from chatchat.server.knowledge_base.kb_cache.base import *
+from chatchat.server.knowledge_base.kb_cache.sqlite_docstore import SQLiteDocstore
 from chatchat.server.knowledge_base.utils import get_vs_path
 from chatchat.server.utils import get_Embeddings, get_default_embedding
 
@@ -23,22 +33,254 @@ def _new_ds_search(self, search: str) -> Union[str, Document]:
 InMemoryDocstore.search = _new_ds_search
 
 
+FAISS_CURRENT_FILE = "CURRENT"
+"""
+向量库目录下记录当前版本的文件。每次保存时 index.faiss、index.pkl、bm25.pkl、source_index.pkl 写入一个新的版本目录，
+全部写完后再原子地替换 CURRENT，中途崩溃时 CURRENT 仍指向上一个完整版本，不会出现来自不同版本的文件。
+"""
+_FAISS_DATA_FILES = ["index.faiss", "index.pkl", BM25_INDEX_FILE, "source_index.pkl"]
+
+
+def get_vs_data_path(vs_path: str) -> str:
+    """
+    向量库当前版本的文件所在目录。没有 CURRENT 的旧版本向量库直接使用 vs_path
+    """
+    file = os.path.join(vs_path, FAISS_CURRENT_FILE)
+    if os.path.isfile(file):
+        with open(file, "r", encoding="utf-8") as fp:
+            version = fp.read().strip()
+        if version and os.path.isdir(os.path.join(vs_path, version)):
+            return os.path.join(vs_path, version)
+        logger.warning(f"向量库 {vs_path} 的 CURRENT 指向不存在的版本 {version}")
+    return vs_path
+
+
+def _fsync_write(file: str, content: str):
+    with open(file, "w", encoding="utf-8") as fp:
+        fp.write(content)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # Windows 不支持打开目录
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class SourceIndex:
+    """
+    文件（metadata["source"]，不区分大小写）到文档 id 的映射，与 InMemoryDocstore 同步维护并保存到磁盘，
+    删除文件时无需遍历整个 docstore。SQLiteDocstore 自带 source 索引，不需要此映射。
+    """
+
+    FILE = "source_index.pkl"
+    version = 1
+
+    def __init__(self):
+        self._ids: Dict[str, Dict[str, None]] = {}  # source -> {id: None}，保持插入顺序
+        self._sources: Dict[str, str] = {}  # id -> source
+
+    def __len__(self) -> int:
+        return len(self._sources)
+
+    @staticmethod
+    def _key(source: str) -> str:
+        return str(source or "").lower()
+
+    def add(self, ids: List[str], metadatas: List[Dict]):
+        for doc_id, metadata in zip(ids, metadatas):
+            self.delete([doc_id])
+            source = self._key((metadata or {}).get("source"))
+            self._ids.setdefault(source, {})[doc_id] = None
+            self._sources[doc_id] = source
+
+    def delete(self, ids: List[str]):
+        for doc_id in ids:
+            source = self._sources.pop(doc_id, None)
+            if source is not None:
+                ids_of_source = self._ids[source]
+                ids_of_source.pop(doc_id, None)
+                if not ids_of_source:
+                    del self._ids[source]
+
+    def get(self, source: str) -> List[str]:
+        return list(self._ids.get(self._key(source), {}))
+
+    def clear(self):
+        self._ids.clear()
+        self._sources.clear()
+
+    def save(self, path: str):
+        file = os.path.join(path, self.FILE)
+        with open(file + ".tmp", "wb") as fp:
+            pickle.dump(
+                {"version": self.version, "sources": self._sources},
+                fp,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(file + ".tmp", file)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["SourceIndex"]:
+        file = os.path.join(path, cls.FILE)
+        if not os.path.isfile(file):
+            return None
+        try:
+            with open(file, "rb") as fp:
+                data = pickle.load(fp)
+            if data.get("version") != cls.version:
+                return None
+            index = cls()
+            for doc_id, source in data["sources"].items():
+                index._ids.setdefault(source, {})[doc_id] = None
+            index._sources = data["sources"]
+            return index
+        except Exception as e:
+            logger.warning(f"加载文件索引 {file} 失败，将重新构建：{e}")
+            return None
+
+    @classmethod
+    def from_docstore(cls, docstore_dict: Dict[str, Document]) -> "SourceIndex":
+        index = cls()
+        for doc_id, doc in docstore_dict.items():
+            index.add([doc_id], [doc.metadata])
+        return index
+
+
 class ThreadSafeFaiss(ThreadSafeObject):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._bm25: BM25Index = None
+        self.source_index: SourceIndex = None  # 使用 SQLiteDocstore 时为 None
+        self.vs_path: str = None  # 向量库保存路径，临时向量库为 None
+
     def __repr__(self) -> str:
         cls = type(self).__name__
         return f"<{cls}: key: {self.key}, obj: {self._obj}, docs_count: {self.docs_count()}>"
 
+    @property
+    def bm25(self) -> BM25Index:
+        """
+        与向量库同步维护的 BM25 倒排索引，临时向量库为 None
+        """
+        return self._bm25
+
+    @bm25.setter
+    def bm25(self, val: BM25Index):
+        self._bm25 = val
+
     def docs_count(self) -> int:
         return len(self._obj.docstore._dict)
 
+    def ids_by_source(self, source: str) -> List[str]:
+        """
+        获取某个文件对应的所有文档 id
+        """
+        docstore = self._obj.docstore
+        if isinstance(docstore, SQLiteDocstore):
+            return docstore.ids_by_source(source)
+        if self.source_index is not None:
+            return self.source_index.get(source)
+        source = str(source or "").lower()
+        return [
+            k for k, v in docstore._dict.items()
+            if str(v.metadata.get("source") or "").lower() == source
+        ]
+
+    def docs_added(self, ids: List[str], docs: List[Document]):
+        """
+        文档加入向量库后调用，同步更新 BM25 索引和文件索引。需要在持有写锁时调用
+        """
+        if self._bm25 is not None:
+            self._bm25.add_documents(ids, [doc.page_content for doc in docs])
+        if self.source_index is not None:
+            self.source_index.add(ids, [doc.metadata for doc in docs])
+
+    def docs_deleted(self, ids: List[str]):
+        """
+        文档从向量库删除后调用，同步更新 BM25 索引和文件索引。需要在持有写锁时调用
+        """
+        if self._bm25 is not None:
+            self._bm25.delete(ids)
+        if self.source_index is not None:
+            self.source_index.delete(ids)
+
+    def _compute_memory_size(self) -> int:
+        index = self._obj.index
+        size = index.ntotal * index.d * 4  # float32 向量
+        if isinstance(self._obj.docstore, InMemoryDocstore):  # SQLiteDocstore 的文档不常驻内存
+            for doc in list(self._obj.docstore._dict.values()):
+                size += sys.getsizeof(doc.page_content) + 256  # 256: Document 及 metadata 的粗略估计
+        return size
+
+    def flush(self):
+        # 在写锁内检查，避免在向量库被丢弃（如清空知识库）之后仍写入磁盘
+        with self.acquire(msg="保存"):
+            if self.dirty and self.vs_path:
+                self.save(self.vs_path)
+
     def save(self, path: str, create_path: bool = True):
+        """
+        将向量库保存到 path 下的新版本目录，写完后切换 CURRENT，旧版本随后删除。
+        保存中断时 CURRENT 仍指向上一个完整的版本
+        """
         with self.acquire():
+            if self.discarded:
+                logger.info(f"向量库 {self.key} 已被丢弃，不再保存")
+                return None
             if not os.path.isdir(path) and create_path:
                 os.makedirs(path)
-            ret = self._obj.save_local(path)
+            version = f"v-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+            data_path = os.path.join(path, version)
+            # 先提交 docstore 再写入向量索引：中途崩溃时 docstore 中最多多出索引未引用的文档，加载时清理，
+            # 而不会出现索引引用了 docstore 中不存在的文档
+            if isinstance(self._obj.docstore, SQLiteDocstore):
+                self._obj.docstore.commit()
+            os.makedirs(data_path)
+            try:
+                ret = self._obj.save_local(data_path)
+                if self._bm25 is not None:
+                    self._bm25.save(data_path)
+                if self.source_index is not None:
+                    self.source_index.save(data_path)
+                for name in os.listdir(data_path):
+                    with open(os.path.join(data_path, name), "rb+") as fp:
+                        os.fsync(fp.fileno())
+                _fsync_dir(data_path)
+                current = os.path.join(path, FAISS_CURRENT_FILE)
+                _fsync_write(current + ".tmp", version)
+                os.replace(current + ".tmp", current)
+                _fsync_dir(path)
+            except Exception:
+                shutil.rmtree(data_path, ignore_errors=True)
+                raise
+            self._remove_old_versions(path, version)
+            self.mark_clean()
             logger.info(f"已将向量库 {self.key} 保存到磁盘")
         return ret
 
+    @staticmethod
+    def _remove_old_versions(path: str, version: str):
+        """
+        删除 CURRENT 之外的版本目录，以及旧版本直接保存在 path 下的文件
+        """
+        for name in os.listdir(path):
+            file = os.path.join(path, name)
+            if name == version:
+                continue
+            if os.path.isdir(file) and (name.startswith("v-") or name.startswith(".saving-")):
+                shutil.rmtree(file, ignore_errors=True)
+            elif name in _FAISS_DATA_FILES:
+                os.remove(file)
+
     def clear(self):
         ret = []
         with self.acquire():
@@ -46,6 +288,10 @@ class ThreadSafeFaiss(ThreadSafeObject):
             if ids:
                 ret = self._obj.delete(ids)
                 assert len(self._obj.docstore._dict) == 0
+            if self._bm25 is not None:
+                self._bm25.clear()
+            if self.source_index is not None:
+                self.source_index.clear()
             logger.info(f"已将向量库 {self.key} 清空")
         return ret
 
@@ -87,6 +333,133 @@ class _FaissPool(CachePool):
 
 
 class KBFaissPool(_FaissPool):
+    def __init__(self, *args, persist_interval: float = 0, **kwargs):
+        """
+        persist_interval: 延迟保存间隔（秒）。向量库修改后只标记为待保存，由后台线程合并一段时间内的修改后统一写入磁盘。
+        小于等于 0 时每次修改后立即保存。
+        """
+        super().__init__(*args, **kwargs)
+        self.persist_interval = persist_interval
+        self._persist_thread: threading.Thread = None
+        self._persist_stop = threading.Event()
+
+    def schedule_save(self, cache: ThreadSafeFaiss):
+        """
+        将向量库标记为待保存，由后台线程延迟写入磁盘
+        """
+        cache.mark_dirty()
+        if self.persist_interval <= 0:
+            cache.flush()
+            return
+        if self._persist_thread is None:
+            with self.atomic:
+                if self._persist_thread is None:
+                    self._persist_thread = threading.Thread(
+                        target=self._persist_worker, name="faiss_persist", daemon=True
+                    )
+                    self._persist_thread.start()
+                    atexit.register(self.flush_all)
+
+    def _persist_worker(self):
+        while not self._persist_stop.wait(self.persist_interval / 2):
+            for cache in self.dirty_items():
+                if cache.persist_lag() >= self.persist_interval:
+                    try:
+                        cache.flush()
+                    except Exception as e:
+                        logger.exception(f"保存向量库 {cache.key} 失败：{e}")
+
+    def flush_all(self):
+        """
+        立即保存所有待保存的向量库，在服务退出时调用
+        """
+        for cache in self.dirty_items():
+            if cache.dirty:
+                try:
+                    cache.flush()
+                except Exception as e:
+                    logger.exception(f"保存向量库 {cache.key} 失败：{e}")
+
+    def flush_kb(self, kb_name: str):
+        """
+        立即保存某知识库（名称不区分大小写）所有待保存的向量库，在其它进程（后台任务 worker）读取该知识库之前调用
+        """
+        for cache in self.dirty_items():
+            if isinstance(cache.key, tuple) and name_key(cache.key[0]) == name_key(kb_name) and cache.dirty:
+                cache.flush()
+
+    def drop_kb(self, kb_name: str):
+        """
+        丢弃某知识库（名称不区分大小写）在本进程中缓存的所有向量库（不保存），在其它进程重建该知识库之后调用，下次使用时从磁盘重新加载。
+        SQLiteDocstore 中未提交的修改回滚后关闭连接
+        """
+        with self.atomic:
+            caches = [
+                self.pop(key) for key in self.keys()
+                if isinstance(key, tuple) and name_key(key[0]) == name_key(kb_name)
+            ]
+        for cache in caches:
+            if cache is None:
+                continue
+            # 等待正在进行的检索、写入结束
+            with cache.acquire(msg="释放"):
+                if cache.dirty:
+                    logger.warning(f"向量库 {cache.key} 有未保存的修改，已丢弃")
+                cache.discard()
+                docstore = getattr(cache.obj, "docstore", None)
+                if isinstance(docstore, SQLiteDocstore):
+                    docstore.rollback()
+                    docstore.close()
+            logger.info(f"向量库 {cache.key} 已在其它进程中更新，释放本进程中的缓存")
+
+    def stats(self) -> Dict:
+        return {**super().stats(), "persist_interval": self.persist_interval}
+
+    @staticmethod
+    def reconcile_sqlite_docstore(vector_store: FAISS):
+        """
+        使 SQLiteDocstore 与向量索引一致：删除索引未引用的文档（保存中断时已提交的新增文档），
+        从索引中删除 docstore 中不存在的文档（保存中断时已提交的删除），避免检索时找不到文档
+        """
+        docstore = vector_store.docstore
+        referenced = set(vector_store.index_to_docstore_id.values())
+        stored = set(docstore.ids())
+        if orphans := stored - referenced:
+            logger.warning(f"docstore 中有 {len(orphans)} 条文档未被向量索引引用，已删除")
+            docstore.delete(list(orphans))
+            docstore.commit()
+        if missing := referenced - stored:
+            logger.warning(f"向量索引中有 {len(missing)} 条文档在 docstore 中不存在，已从索引中删除")
+            vector_store.delete(list(missing))
+        return bool(missing)
+
+    @staticmethod
+    def load_bm25_index(vs_path: str, vector_store: FAISS) -> BM25Index:
+        """
+        加载与向量库对应的 BM25 索引。索引不存在或与 docstore 不一致时（如旧版本知识库）重新构建并保存。
+        """
+        docstore = vector_store.docstore._dict
+        bm25 = BM25Index.load(vs_path)
+        if bm25 is None or len(bm25) != len(docstore) or set(bm25.doc_ids()) != set(docstore):
+            logger.info(f"正在为 '{vs_path}' 构建 BM25 索引，共 {len(docstore)} 条文档")
+            bm25 = BM25Index.from_docstore(docstore)
+            bm25.save(vs_path)
+        return bm25
+
+    @staticmethod
+    def load_source_index(vs_path: str, vector_store: FAISS) -> Optional[SourceIndex]:
+        """
+        加载文件到文档 id 的索引，索引不存在或与 docstore 不一致时重新构建并保存。SQLiteDocstore 无需此索引
+        """
+        if not isinstance(vector_store.docstore, InMemoryDocstore):
+            return None
+        docstore = vector_store.docstore._dict
+        index = SourceIndex.load(vs_path)
+        if index is None or len(index) != len(docstore) or not all(i in docstore for i in index._sources):
+            index = SourceIndex.from_docstore(docstore)
+            index.save(vs_path)
+        return index
+
     def load_vector_store(
         self,
         kb_name: str,
@@ -98,6 +471,10 @@ class KBFaissPool(_FaissPool):
         locked = True
         vector_name = vector_name or embed_model.replace(":", "_")
         cache = self.get((kb_name, vector_name))  # 用元组比拼接字符串好一些
+        self.record_access(cache is not None)
+        if cache is None and (cache := self.dirty_item((kb_name, vector_name))) is not None:
+            # 已被淘汰、尚未保存的向量库直接放回缓存，磁盘上还是旧版本
+            self._cache[(kb_name, vector_name)] = cache
         try:
             if cache is None:
                 item = ThreadSafeFaiss((kb_name, vector_name), pool=self)
@@ -109,15 +486,22 @@ class KBFaissPool(_FaissPool):
                         f"loading vector store in '{kb_name}/vector_store/{vector_name}' from disk."
                     )
                     vs_path = get_vs_path(kb_name, vector_name)
+                    data_path = get_vs_data_path(vs_path)
 
-                    if os.path.isfile(os.path.join(vs_path, "index.faiss")):
+                    if os.path.isfile(os.path.join(data_path, "index.faiss")):
                         embeddings = get_Embeddings(embed_model=embed_model)
                         vector_store = FAISS.load_local(
-                            vs_path,
+                            data_path,
                             embeddings,
                             normalize_L2=True,
                             allow_dangerous_deserialization=True,
                         )
+                        index_changed = False
+                        if isinstance(vector_store.docstore, SQLiteDocstore):
+                            vector_store.docstore.bind(vs_path)
+                            index_changed = self.reconcile_sqlite_docstore(vector_store)
+                        bm25 = self.load_bm25_index(data_path, vector_store)
+                        source_index = self.load_source_index(data_path, vector_store)
                     elif create:
                         # create an empty vector store
                         if not os.path.exists(vs_path):
@@ -125,11 +509,26 @@ class KBFaissPool(_FaissPool):
                         vector_store = self.new_vector_store(
                             kb_name=kb_name, embed_model=embed_model
                         )
-                        vector_store.save_local(vs_path)
+                        if Settings.kb_settings.FAISS_DOCSTORE == "sqlite":
+                            vector_store.docstore = SQLiteDocstore(vs_path)
+                        bm25 = BM25Index()
+                        source_index = SourceIndex() if isinstance(vector_store.docstore, InMemoryDocstore) else None
+                        item.obj = vector_store
+                        item.bm25 = bm25
+                        item.source_index = source_index
+                        item.save(vs_path)
+                        index_changed = False
                     else:
                         raise RuntimeError(f"knowledge base {kb_name} not exist.")
                     item.obj = vector_store
+                    item.bm25 = bm25
+                    item.source_index = source_index
+                    item.vs_path = vs_path
+                    if index_changed:
+                        self.schedule_save(item)
                     item.finish_loading()
+                cache = item
+                self._check_count(exclude=item.key)
             else:
                 self.atomic.release()
                 locked = False
@@ -138,7 +537,7 @@ class KBFaissPool(_FaissPool):
                 self.atomic.release()
             logger.exception(e)
             raise RuntimeError(f"向量库 {kb_name} 加载失败。")
-        return self.get((kb_name, vector_name))
+        return cache
 
 
 class MemoFaissPool(_FaissPool):
@@ -153,6 +552,7 @@ class MemoFaissPool(_FaissPool):
     ) -> ThreadSafeFaiss:
         self.atomic.acquire()
         cache = self.get(kb_name)
+        self.record_access(cache is not None)
         if cache is None:
             item = ThreadSafeFaiss(kb_name, pool=self)
             self.set(kb_name, item)
@@ -163,10 +563,19 @@ class MemoFaissPool(_FaissPool):
                 vector_store = self.new_temp_vector_store(embed_model=embed_model)
                 item.obj = vector_store
                 item.finish_loading()
+            cache = item
+            self._check_count(exclude=item.key)
         else:
             self.atomic.release()
-        return self.get(kb_name)
+        return cache
 
 
-kb_faiss_pool = KBFaissPool(cache_num=Settings.kb_settings.CACHED_VS_NUM)
-memo_faiss_pool = MemoFaissPool(cache_num=Settings.kb_settings.CACHED_MEMO_VS_NUM)
+kb_faiss_pool = KBFaissPool(
+    cache_num=Settings.kb_settings.CACHED_VS_NUM,
+    memory_budget=Settings.kb_settings.CACHED_VS_MEMORY_MB * 1024 * 1024,
+    persist_interval=Settings.kb_settings.FAISS_PERSIST_INTERVAL,
+)
+memo_faiss_pool = MemoFaissPool(
+    cache_num=Settings.kb_settings.CACHED_MEMO_VS_NUM,
+    memory_budget=Settings.kb_settings.CACHED_MEMO_VS_MEMORY_MB * 1024 * 1024,
+)
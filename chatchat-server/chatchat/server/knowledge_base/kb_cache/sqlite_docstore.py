@@ -0,0 +1,208 @@
+import os
+import pickle
+import sqlite3
+import threading
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from langchain.docstore.document import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+
+SQLITE_DOCSTORE_FILE = "docstore.db"
+
+
+class _SQLiteDocDict(Mapping):
+    """
+    兼容 InMemoryDocstore._dict 的只读视图，按需从 SQLite 读取文档
+    """
+
+    def __init__(self, docstore: "SQLiteDocstore"):
+        self._docstore = docstore
+
+    def __getitem__(self, key: str) -> Document:
+        doc = self._docstore.search(key)
+        if not isinstance(doc, Document):
+            raise KeyError(key)
+        return doc
+
+    def get(self, key: str, default=None) -> Optional[Document]:
+        doc = self._docstore.search(key)
+        return doc if isinstance(doc, Document) else default
+
+    def __contains__(self, key: str) -> bool:
+        return self._docstore.exists(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._docstore.ids())
+
+    def __len__(self) -> int:
+        return len(self._docstore)
+
+    def items(self) -> Iterator[Tuple[str, Document]]:
+        return self._docstore.iter_documents()
+
+    def values(self) -> Iterator[Document]:
+        return (doc for _, doc in self._docstore.iter_documents())
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """
+    保存在向量库目录下 docstore.db 中的 docstore，用于替代大型 FAISS 知识库的 InMemoryDocstore：
+    - 文档按 id 从磁盘读取，加载向量库时无需反序列化全部文档
+    - source 列（小写）建有索引，可以按文件快速查找文档 id
+    - 修改在 commit() 前不会落盘，由 ThreadSafeFaiss.save 与 index.faiss 一同提交，
+      避免进程异常退出后 docstore 与向量索引不一致
+
+    index.pkl 中只保存文件名，加载后需要调用 bind(vs_path) 打开数据库。
+    """
+
+    def __init__(self, path: str = None):
+        self._path: str = None
+        self._conn: sqlite3.Connection = None
+        self._lock = threading.RLock()
+        if path:
+            self.bind(path)
+
+    def bind(self, path: str):
+        """打开 path 目录下的 docstore.db"""
+        self.close()
+        os.makedirs(path, exist_ok=True)
+        self._path = os.path.join(path, SQLITE_DOCSTORE_FILE)
+        self._conn = sqlite3.connect(self._path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                id TEXT PRIMARY KEY,
+                source TEXT,
+                page_content TEXT NOT NULL,
+                metadata BLOB
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_documents_source ON documents (source)")
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __getstate__(self) -> Dict:
+        return {"file": SQLITE_DOCSTORE_FILE}
+
+    def __setstate__(self, state: Dict):
+        self.__init__()
+
+    def _execute(self, sql: str, params=()) -> List[Tuple]:
+        if self._conn is None:
+            raise RuntimeError("SQLiteDocstore 尚未打开，请先调用 bind(vs_path)")
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _to_document(doc_id: str, page_content: str, metadata: bytes) -> Document:
+        metadata = pickle.loads(metadata) if metadata else {}
+        metadata["id"] = doc_id
+        return Document(page_content=page_content, metadata=metadata)
+
+    @property
+    def _dict(self) -> _SQLiteDocDict:
+        return _SQLiteDocDict(self)
+
+    def __len__(self) -> int:
+        return self._execute("SELECT COUNT(*) FROM documents")[0][0]
+
+    def exists(self, doc_id: str) -> bool:
+        return bool(self._execute("SELECT 1 FROM documents WHERE id = ?", (doc_id,)))
+
+    def ids(self) -> List[str]:
+        return [r[0] for r in self._execute("SELECT id FROM documents")]
+
+    def search(self, search: str) -> Union[str, Document]:
+        rows = self._execute(
+            "SELECT id, page_content, metadata FROM documents WHERE id = ?", (search,)
+        )
+        if not rows:
+            return f"ID {search} not found."
+        return self._to_document(*rows[0])
+
+    def mget(self, ids: List[str]) -> List[Optional[Document]]:
+        """批量读取文档，返回结果与 ids 顺序一致，不存在的 id 对应 None"""
+        docs = {}
+        for i in range(0, len(ids), 500):
+            batch = ids[i: i + 500]
+            rows = self._execute(
+                f"SELECT id, page_content, metadata FROM documents "
+                f"WHERE id IN ({','.join('?' * len(batch))})",
+                batch,
+            )
+            for row in rows:
+                docs[row[0]] = self._to_document(*row)
+        return [docs.get(i) for i in ids]
+
+    def iter_documents(self, batch_size: int = 1000) -> Iterator[Tuple[str, Document]]:
+        last_rowid = 0
+        while True:
+            rows = self._execute(
+                "SELECT rowid, id, page_content, metadata FROM documents "
+                "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size),
+            )
+            if not rows:
+                break
+            for rowid, doc_id, page_content, metadata in rows:
+                yield doc_id, self._to_document(doc_id, page_content, metadata)
+            last_rowid = rows[-1][0]
+
+    def ids_by_source(self, source: str) -> List[str]:
+        return [
+            r[0]
+            for r in self._execute(
+                "SELECT id FROM documents WHERE source = ?", ((source or "").lower(),)
+            )
+        ]
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        if not texts:
+            return
+        ids = list(texts)
+        overlapping = [i for i, doc in zip(ids, self.mget(ids)) if doc is not None]
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {set(overlapping)}")
+        rows = []
+        for doc_id, doc in texts.items():
+            metadata = {k: v for k, v in doc.metadata.items() if k != "id"}
+            rows.append((
+                doc_id,
+                str(metadata.get("source") or "").lower(),
+                doc.page_content,
+                pickle.dumps(metadata, protocol=pickle.HIGHEST_PROTOCOL),
+            ))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO documents (id, source, page_content, metadata) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def delete(self, ids: List) -> None:
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                batch = ids[i: i + 500]
+                self._conn.execute(
+                    f"DELETE FROM documents WHERE id IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+
+    def commit(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+
+    def rollback(self):
+        """放弃尚未提交的修改"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.rollback()
@@ -1,6 +1,8 @@
 import asyncio
+import hashlib
 import json
 import os
+import tempfile
 import urllib
 from typing import Dict, List
 
@@ -12,13 +14,19 @@ from sse_starlette import EventSourceResponse
 
 from chatchat.settings import Settings
 from chatchat.server.db.repository.knowledge_file_repository import get_file_detail
+from chatchat.server.knowledge_base.kb_executor import (
+    iterate_in_kb_executor,
+    run_in_kb_executor,
+)
+from chatchat.server.knowledge_base.kb_jobs import kb_job_conflict, kb_sync_write, kb_write_guard
+from chatchat.server.knowledge_base.kb_pipeline import IngestPipeline
 from chatchat.server.knowledge_base.kb_service.base import (
     KBServiceFactory,
     get_kb_file_details,
 )
 from chatchat.server.knowledge_base.utils import (
     KnowledgeFile,
-    files2docs_in_thread,
+    get_file_hash,
     get_file_path,
     list_files_from_folder,
     validate_kb_name,
@@ -27,7 +35,6 @@ from chatchat.server.knowledge_base.kb_cache.faiss_cache import memo_faiss_pool
 from chatchat.server.utils import (
     BaseResponse,
     ListResponse,
-    run_in_thread_pool,
     get_default_embedding,
 )
 from chatchat.utils import build_logger
@@ -40,7 +47,7 @@ def search_temp_docs(knowledge_id: str = Body(..., description="知识库 ID", e
                      top_k: int = Body(..., description="返回的文档数量", examples=[5]),
                      score_threshold: float = Body(..., description="分数阈值", examples=[0.8])) -> List[Dict]:
     '''从临时 FAISS 知识库中检索文档，用于文件对话'''
-    with memo_faiss_pool.acquire(knowledge_id) as vs:
+    with memo_faiss_pool.acquire(knowledge_id, shared=True) as vs:
         docs = vs.similarity_search_with_score(
             query, k=top_k, score_threshold=score_threshold
         )
@@ -104,6 +111,51 @@ def search_docs(
     return [x.dict() for x in data]
 
 
+async def asearch_docs(
+        query: str = Body("", description="用户输入", examples=["你好"]),
+        knowledge_base_name: str = Body(
+            ..., description="知识库名称", examples=["samples"]
+        ),
+        top_k: int = Body(Settings.kb_settings.VECTOR_SEARCH_TOP_K, description="匹配向量数"),
+        score_threshold: float = Body(
+            Settings.kb_settings.SCORE_THRESHOLD,
+            description="知识库匹配相关度阈值，取值范围在0-1之间，"
+                        "SCORE越小，相关度越高，"
+                        "取到2相当于不筛选，建议设置在0.5左右",
+            ge=0.0,
+            le=2.0,
+        ),
+        file_name: str = Body("", description="文件名称，支持 sql 通配符"),
+        metadata: dict = Body({}, description="根据 metadata 进行过滤，仅支持一级键"),
+) -> List[Dict]:
+    """
+    search_docs 的异步版本，供 API 接口使用：查询向量异步获取，检索在知识库查询线程池中执行
+    """
+    if not query:
+        return await run_in_kb_executor(
+            "query",
+            search_docs,
+            query=query,
+            knowledge_base_name=knowledge_base_name,
+            top_k=top_k,
+            score_threshold=score_threshold,
+            file_name=file_name,
+            metadata=metadata,
+        )
+    kb = await run_in_kb_executor("query", KBServiceFactory.get_service_by_name, knowledge_base_name)
+    if kb is None:
+        return []
+    try:
+        data = await kb.asearch_docs(query, top_k, score_threshold)
+    except ValidationError as e:
+        logger.error(f"Validation error: {e}")
+        raise ValidationError(f"Validation error: {e}")
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {e}")
+        raise Exception(f"An unexpected error occurred: {e}")
+    return [x.dict() for x in data]
+
+
 def list_files(knowledge_base_name: str) -> ListResponse:
     if not validate_kb_name(knowledge_base_name):
         return ListResponse(code=403, msg="Don't attack me", data=[])
@@ -119,54 +171,79 @@ def list_files(knowledge_base_name: str) -> ListResponse:
         return ListResponse(data=all_docs)
 
 
-def _save_files_in_thread(
+async def _save_files(
         files: List[UploadFile], knowledge_base_name: str, override: bool
-):
+) -> List[Dict]:
     """
-    通过多线程将上传的文件保存到对应知识库目录内。
-    生成器返回保存结果：{"code":200, "msg": "xxx", "data": {"knowledge_base_name":"xxx", "file_name": "xxx"}}
+    以流式方式将上传的文件保存到对应知识库目录内。
+    文件分块写入同目录下的临时文件并同时计算 sha256，完成后原子替换为目标文件，
+    已存在内容相同（哈希一致）的文件时不覆盖。
+    UPLOAD_MAX_REQUEST_SIZE_MB 限制的是写入知识库目录的总大小：此时请求体已由 Starlette 接收并缓存到临时文件，
+    无法用它拒绝过大的请求，接收阶段的大小限制需要在反向代理（如 nginx 的 client_max_body_size）中配置。
+    返回保存结果：[{"code":200, "msg": "xxx", "data": {"knowledge_base_name":"xxx", "file_name": "xxx"}}, ...]
     """
+    chunk_size = Settings.kb_settings.UPLOAD_CHUNK_SIZE
+    max_request_size = Settings.kb_settings.UPLOAD_MAX_REQUEST_SIZE_MB * 1024 * 1024
+    semaphore = asyncio.Semaphore(max(1, Settings.kb_settings.UPLOAD_MAX_CONCURRENCY))
+    received = 0
 
-    def save_file(file: UploadFile, knowledge_base_name: str, override: bool) -> dict:
+    async def save_file(file: UploadFile) -> dict:
         """
         保存单个文件。
         """
+        nonlocal received
+        filename = file.filename
+        data = {"knowledge_base_name": knowledge_base_name, "file_name": filename}
+        tmp_path = None
         try:
-            filename = file.filename
             file_path = get_file_path(
                 knowledge_base_name=knowledge_base_name, doc_name=filename
             )
-            data = {"knowledge_base_name": knowledge_base_name, "file_name": filename}
+            file_dir = os.path.dirname(file_path)
+            os.makedirs(file_dir, exist_ok=True)
+            hasher = hashlib.sha256()
+
+            async with semaphore:
+                fd, tmp_path = tempfile.mkstemp(dir=file_dir, prefix=".uploading-")
+                with os.fdopen(fd, "wb") as f:
+
+                    def write(chunk: bytes):
+                        hasher.update(chunk)
+                        f.write(chunk)
+
+                    while chunk := await file.read(chunk_size):
+                        received += len(chunk)
+                        if max_request_size and received > max_request_size:
+                            raise ValueError(
+                                f"上传文件总大小超过 {Settings.kb_settings.UPLOAD_MAX_REQUEST_SIZE_MB}MB"
+                            )
+                        await asyncio.to_thread(write, chunk)
 
-            file_content = file.file.read()  # 读取上传文件的内容
             if (
                     os.path.isfile(file_path)
                     and not override
-                    and os.path.getsize(file_path) == len(file_content)
+                    and await asyncio.to_thread(get_file_hash, file_path) == hasher.hexdigest()
             ):
                 file_status = f"文件 {filename} 已存在。"
                 logger.warn(file_status)
                 return dict(code=404, msg=file_status, data=data)
 
-            if not os.path.isdir(os.path.dirname(file_path)):
-                os.makedirs(os.path.dirname(file_path))
-            with open(file_path, "wb") as f:
-                f.write(file_content)
+            os.replace(tmp_path, file_path)
+            tmp_path = None
             return dict(code=200, msg=f"成功上传文件 {filename}", data=data)
         except Exception as e:
             msg = f"{filename} 文件上传失败，报错信息为: {e}"
             logger.error(f"{e.__class__.__name__}: {msg}")
             return dict(code=500, msg=msg, data=data)
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            await file.close()
 
-    params = [
-        {"file": file, "knowledge_base_name": knowledge_base_name, "override": override}
-        for file in files
-    ]
-    for result in run_in_thread_pool(save_file, params=params):
-        yield result
+    return await asyncio.gather(*[save_file(file) for file in files])
 
 
-def upload_docs(
+async def upload_docs(
         files: List[UploadFile] = File(..., description="上传文件，支持多文件"),
         knowledge_base_name: str = Form(
             ..., description="知识库名称", examples=["samples"]
@@ -185,46 +262,51 @@ def upload_docs(
     """
     if not validate_kb_name(knowledge_base_name):
         return BaseResponse(code=403, msg="Don't attack me")
+    with kb_write_guard.write(knowledge_base_name):
+        if msg := await run_in_kb_executor("query", kb_job_conflict, knowledge_base_name):
+            return BaseResponse(code=409, msg=msg)
+
+        kb = await run_in_kb_executor("query", KBServiceFactory.get_service_by_name, knowledge_base_name)
+        if kb is None:
+            return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
+
+        docs = json.loads(docs) if docs else {}
+        failed_files = {}
+        file_names = list(docs.keys())
+
+        # 先将上传的文件保存到磁盘
+        for result in await _save_files(
+                files, knowledge_base_name=knowledge_base_name, override=override
+        ):
+            filename = result["data"]["file_name"]
+            if result["code"] != 200:
+                failed_files[filename] = result["msg"]
+
+            if filename not in file_names:
+                file_names.append(filename)
+
+        # 对保存的文件进行向量化
+        if to_vector_store:
+            result = await run_in_kb_executor(
+                "ingest",
+                update_docs,
+                knowledge_base_name=knowledge_base_name,
+                file_names=file_names,
+                override_custom_docs=True,
+                text_splitter_name=text_splitter_name,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+                zh_title_enhance=zh_title_enhance,
+                docs=docs,
+                not_refresh_vs_cache=True,
+            )
+            failed_files.update(result.data["failed_files"])
+            if not not_refresh_vs_cache:
+                await run_in_kb_executor("ingest", kb.save_vector_store)
 
-    kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
-    if kb is None:
-        return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
-
-    docs = json.loads(docs) if docs else {}
-    failed_files = {}
-    file_names = list(docs.keys())
-
-    # 先将上传的文件保存到磁盘
-    for result in _save_files_in_thread(
-            files, knowledge_base_name=knowledge_base_name, override=override
-    ):
-        filename = result["data"]["file_name"]
-        if result["code"] != 200:
-            failed_files[filename] = result["msg"]
-
-        if filename not in file_names:
-            file_names.append(filename)
-
-    # 对保存的文件进行向量化
-    if to_vector_store:
-        result = update_docs(
-            knowledge_base_name=knowledge_base_name,
-            file_names=file_names,
-            override_custom_docs=True,
-            text_splitter_name=text_splitter_name,
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            zh_title_enhance=zh_title_enhance,
-            docs=docs,
-            not_refresh_vs_cache=True,
+        return BaseResponse(
+            code=200, msg="文件上传与向量化完成", data={"failed_files": failed_files}
         )
-        failed_files.update(result.data["failed_files"])
-        if not not_refresh_vs_cache:
-            kb.save_vector_store()
-
-    return BaseResponse(
-        code=200, msg="文件上传与向量化完成", data={"failed_files": failed_files}
-    )
 
 
 def delete_docs(
@@ -237,31 +319,47 @@ def delete_docs(
         return BaseResponse(code=403, msg="Don't attack me")
 
     knowledge_base_name = urllib.parse.unquote(knowledge_base_name)
-    kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
-    if kb is None:
-        return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
+    with kb_sync_write(knowledge_base_name) as msg:
+        if msg:
+            return BaseResponse(code=409, msg=msg)
+        kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
+        if kb is None:
+            return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
+
+        failed_files = {}
+        kb_files = []
+        for file_name in dict.fromkeys(file_names):
+            if not kb.exist_doc(file_name):
+                failed_files[file_name] = f"未找到文件 {file_name}"
 
-    failed_files = {}
-    for file_name in file_names:
-        if not kb.exist_doc(file_name):
-            failed_files[file_name] = f"未找到文件 {file_name}"
+            try:
+                kb_files.append(KnowledgeFile(
+                    filename=file_name, knowledge_base_name=knowledge_base_name
+                ))
+            except Exception as e:
+                msg = f"{file_name} 文件删除失败，错误信息：{e}"
+                logger.error(f"{e.__class__.__name__}: {msg}")
+                failed_files[file_name] = msg
 
+        # 所有文件一次性从向量库删除
         try:
-            kb_file = KnowledgeFile(
-                filename=file_name, knowledge_base_name=knowledge_base_name
-            )
-            kb.delete_doc(kb_file, delete_content, not_refresh_vs_cache=True)
+            kb.delete_docs(kb_files, delete_content, not_refresh_vs_cache=True)
         except Exception as e:
-            msg = f"{file_name} 文件删除失败，错误信息：{e}"
-            logger.error(f"{e.__class__.__name__}: {msg}")
-            failed_files[file_name] = msg
+            logger.error(f"{e.__class__.__name__}: 批量删除文件失败，将逐个删除：{e}")
+            for kb_file in kb_files:
+                try:
+                    kb.delete_doc(kb_file, delete_content, not_refresh_vs_cache=True)
+                except Exception as e:
+                    msg = f"{kb_file.filename} 文件删除失败，错误信息：{e}"
+                    logger.error(f"{e.__class__.__name__}: {msg}")
+                    failed_files[kb_file.filename] = msg
 
-    if not not_refresh_vs_cache:
-        kb.save_vector_store()
+        if not not_refresh_vs_cache:
+            kb.save_vector_store()
 
-    return BaseResponse(
-        code=200, msg=f"文件删除完成", data={"failed_files": failed_files}
-    )
+        return BaseResponse(
+            code=200, msg=f"文件删除完成", data={"failed_files": failed_files}
+        )
 
 
 def update_info(
@@ -297,72 +395,72 @@ def update_docs(
     """
     if not validate_kb_name(knowledge_base_name):
         return BaseResponse(code=403, msg="Don't attack me")
+    with kb_sync_write(knowledge_base_name) as msg:
+        if msg:
+            return BaseResponse(code=409, msg=msg)
+
+        kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
+        if kb is None:
+            return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
+
+        failed_files = {}
+        kb_files = []
+        docs = json.loads(docs) if docs else {}
+
+        # 生成需要加载docs的文件列表
+        for file_name in file_names:
+            file_detail = get_file_detail(kb_name=knowledge_base_name, filename=file_name)
+            # 如果该文件之前使用了自定义docs，则根据参数决定略过或覆盖
+            if file_detail.get("custom_docs") and not override_custom_docs:
+                continue
+            if file_name not in docs:
+                try:
+                    kb_files.append(
+                        KnowledgeFile(
+                            filename=file_name, knowledge_base_name=knowledge_base_name
+                        )
+                    )
+                except Exception as e:
+                    msg = f"加载文档 {file_name} 时出错：{e}"
+                    logger.error(f"{e.__class__.__name__}: {msg}")
+                    failed_files[file_name] = msg
+
+        # 从文件生成docs，并进行向量化。
+        # 解析、向量化、写入向量库以流水线方式同时进行
+        pipeline = IngestPipeline(
+            kb,
+            update=True,
+            text_splitter_name=text_splitter_name,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            zh_title_enhance=zh_title_enhance,
+        )
+        for status, result in pipeline.run(kb_files):
+            if not status:
+                kb_name, file_name, error = result
+                failed_files[file_name] = error
 
-    kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
-    if kb is None:
-        return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
-
-    failed_files = {}
-    kb_files = []
-    docs = json.loads(docs) if docs else {}
-
-    # 生成需要加载docs的文件列表
-    for file_name in file_names:
-        file_detail = get_file_detail(kb_name=knowledge_base_name, filename=file_name)
-        # 如果该文件之前使用了自定义docs，则根据参数决定略过或覆盖
-        if file_detail.get("custom_docs") and not override_custom_docs:
-            continue
-        if file_name not in docs:
+        # 将自定义的docs进行向量化
+        for file_name, v in docs.items():
             try:
-                kb_files.append(
-                    KnowledgeFile(
-                        filename=file_name, knowledge_base_name=knowledge_base_name
-                    )
+                v = [x if isinstance(x, Document) else Document(**x) for x in v]
+                kb_file = KnowledgeFile(
+                    filename=file_name, knowledge_base_name=knowledge_base_name
                 )
+                kb.update_doc(kb_file, text_splitter_name=text_splitter_name, docs=v, not_refresh_vs_cache=True)
             except Exception as e:
-                msg = f"加载文档 {file_name} 时出错：{e}"
+                msg = f"为 {file_name} 添加自定义docs时出错：{e}"
                 logger.error(f"{e.__class__.__name__}: {msg}")
                 failed_files[file_name] = msg
 
-    # 从文件生成docs，并进行向量化。
-    # 这里利用了KnowledgeFile的缓存功能，在多线程中加载Document，然后传给KnowledgeFile
-    for status, result in files2docs_in_thread(
-            kb_files,
-            text_splitter_name=text_splitter_name,
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            zh_title_enhance=zh_title_enhance,
-    ):
-        if status:
-            kb_name, file_name, new_docs = result
-            kb_file = KnowledgeFile(
-                filename=file_name, knowledge_base_name=knowledge_base_name
-            )
-            kb_file.splited_docs = new_docs
-            kb.update_doc(kb_file, text_splitter_name=text_splitter_name, not_refresh_vs_cache=True)
-        else:
-            kb_name, file_name, error = result
-            failed_files[file_name] = error
-
-    # 将自定义的docs进行向量化
-    for file_name, v in docs.items():
-        try:
-            v = [x if isinstance(x, Document) else Document(**x) for x in v]
-            kb_file = KnowledgeFile(
-                filename=file_name, knowledge_base_name=knowledge_base_name
-            )
-            kb.update_doc(kb_file, text_splitter_name=text_splitter_name, docs=v, not_refresh_vs_cache=True)
-        except Exception as e:
-            msg = f"为 {file_name} 添加自定义docs时出错：{e}"
-            logger.error(f"{e.__class__.__name__}: {msg}")
-            failed_files[file_name] = msg
-
-    if not not_refresh_vs_cache:
-        kb.save_vector_store()
+        if not not_refresh_vs_cache:
+            kb.save_vector_store()
 
-    return BaseResponse(
-        code=200, msg=f"更新文档完成", data={"failed_files": failed_files}
-    )
+        return BaseResponse(
+            code=200,
+            msg=f"更新文档完成",
+            data={"failed_files": failed_files, "pipeline": pipeline.stats()},
+        )
 
 
 def download_doc(
@@ -426,7 +524,10 @@ def recreate_vector_store(
     """
 
     def output():
-        try:
+        with kb_sync_write(knowledge_base_name) as msg:
+            if msg:
+                yield json.dumps({"code": 409, "msg": msg}, ensure_ascii=False)
+                return
             kb = KBServiceFactory.get_service(knowledge_base_name, vs_type, embed_model)
             if not kb.exists() and not allow_empty_kb:
                 yield {"code": 404, "msg": f"未找到知识库 ‘{knowledge_base_name}’"}
@@ -440,20 +541,17 @@ def recreate_vector_store(
                     kb.create_kb()
                     files = list_files_from_folder(knowledge_base_name)
                     kb_files = [(file, knowledge_base_name) for file in files]
+                    pipeline = IngestPipeline(
+                        kb,
+                        text_splitter_name=text_splitter_name,
+                        chunk_size=chunk_size,
+                        chunk_overlap=chunk_overlap,
+                        zh_title_enhance=zh_title_enhance,
+                    )
                     i = 0
-                    for status, result in files2docs_in_thread(
-                            kb_files,
-                            text_splitter_name=text_splitter_name,
-                            chunk_size=chunk_size,
-                            chunk_overlap=chunk_overlap,
-                            zh_title_enhance=zh_title_enhance,
-                    ):
+                    for status, result in pipeline.run(kb_files):
                         if status:
                             kb_name, file_name, docs = result
-                            kb_file = KnowledgeFile(
-                                filename=file_name, knowledge_base_name=kb_name
-                            )
-                            kb_file.splited_docs = docs
                             yield json.dumps(
                                 {
                                     "code": 200,
@@ -464,11 +562,6 @@ def recreate_vector_store(
                                 },
                                 ensure_ascii=False,
                             )
-                            kb.add_doc(kb_file=kb_file,
-                                       text_splitter_name=text_splitter_name,
-                                       chunk_size=chunk_size,
-                                       chunk_overlap=chunk_overlap,
-                                       not_refresh_vs_cache=True)
                         else:
                             kb_name, file_name, error = result
                             msg = f"添加文件‘{file_name}’到知识库‘{knowledge_base_name}’时出错：{error}。已跳过。"
@@ -482,8 +575,5 @@ def recreate_vector_store(
                         i += 1
                     if not not_refresh_vs_cache:
                         kb.save_vector_store()
-        except asyncio.exceptions.CancelledError:
-            logger.warning("streaming progress has been interrupted by user.")
-            return
 
-    return EventSourceResponse(output())
+    return EventSourceResponse(iterate_in_kb_executor("ingest", output()))
@@ -0,0 +1,168 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Callable, Dict, Generator, Literal
+
+from chatchat.settings import Settings
+from chatchat.utils import build_logger
+
+
+logger = build_logger()
+
+
+KBExecutorKind = Literal["query", "ingest"]
+
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_kb_executor(kind: KBExecutorKind) -> ThreadPoolExecutor:
+    """
+    知识库接口使用的线程池。检索（query）与入库（ingest）使用各自的线程池，
+    耗时较长的上传、重建不会占满检索所需的线程，也不占用 FastAPI 默认的线程池。
+    """
+    if kind not in _executors:
+        with _executors_lock:
+            if kind not in _executors:
+                workers = (
+                    Settings.kb_settings.KB_QUERY_WORKERS
+                    if kind == "query"
+                    else Settings.kb_settings.KB_INGEST_WORKERS
+                )
+                _executors[kind] = ThreadPoolExecutor(
+                    max_workers=max(1, workers), thread_name_prefix=f"kb_{kind}"
+                )
+    return _executors[kind]
+
+
+async def run_in_kb_executor(kind: KBExecutorKind, func: Callable, *args, **kwargs):
+    """在指定的知识库线程池中运行同步函数"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_kb_executor(kind), functools.partial(func, *args, **kwargs)
+    )
+
+
+async def iterate_in_kb_executor(
+    kind: KBExecutorKind, iterator: Generator
+) -> AsyncGenerator:
+    """
+    在指定的知识库线程池中逐个获取同步生成器的结果，用于流式输出进度的接口。
+    客户端断开时设置停止标志，由线程池在正在执行的 next() 返回后关闭生成器，
+    不会在其它线程仍在执行生成器时调用 close()。
+    """
+    sentinel = object()
+    stop = threading.Event()
+    lock = threading.Lock()
+
+    def step():
+        with lock:
+            if stop.is_set():
+                return sentinel
+            return next(iterator, sentinel)
+
+    def close():
+        with lock:
+            try:
+                iterator.close()
+            except Exception as e:
+                logger.error(f"关闭流式输出的生成器失败: {e}")
+
+    try:
+        while True:
+            item = await run_in_kb_executor(kind, step)
+            if item is sentinel:
+                break
+            yield item
+    except (asyncio.CancelledError, GeneratorExit):
+        logger.warning("streaming progress has been interrupted by user.")
+        raise
+    finally:
+        stop.set()
+        try:
+            get_kb_executor(kind).submit(close)
+        except RuntimeError:
+            # 线程池已关闭（服务退出），在单独的线程中等待 next() 返回后关闭，不阻塞事件循环
+            threading.Thread(target=close, daemon=True).start()
+
+
+def kb_endpoint(kind: KBExecutorKind):
+    """
+    将同步接口函数包装为异步接口，请求在指定的知识库线程池中处理。
+    保留原函数签名，FastAPI 仍按原函数的参数定义解析请求。
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await run_in_kb_executor(kind, func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+if __name__ == "__main__":
+    # 压测：在不断上传文件的同时测量检索延迟，对比检索 p50/p99 是否受上传影响
+    # 用法：python kb_executor.py <知识库名称> <用于上传的文件> [检索次数]
+    import io
+    import os
+    import sys
+    import time
+
+    import httpx
+
+    from chatchat.server.utils import api_address
+
+    kb_name, upload_file = sys.argv[1], sys.argv[2]
+    n_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    base_url = f"{api_address()}/knowledge_base"
+    with open(upload_file, "rb") as f:
+        content = f.read()
+
+    async def search(client: httpx.AsyncClient, latencies: list):
+        start = time.perf_counter()
+        r = await client.post(
+            f"{base_url}/search_docs",
+            json={"query": f"测试问题 {len(latencies) % 20}", "knowledge_base_name": kb_name},
+        )
+        r.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+    async def upload_forever(client: httpx.AsyncClient, stop: asyncio.Event, i: int):
+        name, ext = os.path.splitext(os.path.basename(upload_file))
+        while not stop.is_set():
+            files = [("files", (f"{name}_load_{i}{ext}", io.BytesIO(content)))]
+            await client.post(
+                f"{base_url}/upload_docs",
+                data={"knowledge_base_name": kb_name, "override": "true"},
+                files=files,
+            )
+
+    def percentile(values: list, p: float) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+    async def run_searches(client: httpx.AsyncClient) -> list:
+        latencies = []
+        for _ in range(n_queries // 10):
+            await asyncio.gather(*[search(client, latencies) for _ in range(10)])
+        return latencies
+
+    async def main():
+        async with httpx.AsyncClient(timeout=600) as client:
+            idle = await run_searches(client)
+            stop = asyncio.Event()
+            uploads = [asyncio.create_task(upload_forever(client, stop, i)) for i in range(8)]
+            await asyncio.sleep(2)
+            busy = await run_searches(client)
+            stop.set()
+            await asyncio.gather(*uploads)
+        for label, latencies in [("idle", idle), ("during uploads", busy)]:
+            print(
+                f"{label:<15}: p50={percentile(latencies, 0.5):.1f}ms "
+                f"p99={percentile(latencies, 0.99):.1f}ms n={len(latencies)}"
+            )
+
+    asyncio.run(main())
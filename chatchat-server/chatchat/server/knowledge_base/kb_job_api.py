@@ -0,0 +1,218 @@
+import asyncio
+import json
+from typing import List, Optional
+
+from fastapi import Body, File, Form, Query, UploadFile
+from sse_starlette import EventSourceResponse
+
+from chatchat.settings import Settings
+from chatchat.server.db.repository.kb_job_repository import (
+    KB_JOB_FINAL_STATUS,
+    cancel_kb_job_in_db,
+    get_kb_job_from_db,
+    list_kb_jobs_from_db,
+)
+from chatchat.server.knowledge_base.kb_doc_api import _save_files
+from chatchat.server.knowledge_base.kb_executor import run_in_kb_executor
+from chatchat.server.knowledge_base.kb_jobs import KBWriteConflict, submit_kb_job
+from chatchat.server.knowledge_base.kb_service.base import KBServiceFactory
+from chatchat.server.knowledge_base.utils import validate_kb_name
+from chatchat.server.utils import BaseResponse, ListResponse, get_default_embedding
+from chatchat.utils import build_logger
+
+
+logger = build_logger()
+
+
+async def submit_recreate_vector_store(
+        knowledge_base_name: str = Body(..., examples=["samples"]),
+        allow_empty_kb: bool = Body(True),
+        vs_type: str = Body(Settings.kb_settings.DEFAULT_VS_TYPE),
+        embed_model: str = Body(get_default_embedding()),
+        text_splitter_name: str = Body(Settings.kb_settings.TEXT_SPLITTER_NAME, description="文本分割器名称"),
+        chunk_size: int = Body(Settings.kb_settings.CHUNK_SIZE, description="知识库中单段文本最大长度"),
+        chunk_overlap: int = Body(Settings.kb_settings.OVERLAP_SIZE, description="知识库中相邻文本重合长度"),
+        zh_title_enhance: bool = Body(Settings.kb_settings.ZH_TITLE_ENHANCE, description="是否开启中文标题加强"),
+) -> BaseResponse:
+    """
+    提交后台重建向量库任务，参数与 recreate_vector_store 相同，立即返回任务信息
+    """
+    if not validate_kb_name(knowledge_base_name):
+        return BaseResponse(code=403, msg="Don't attack me")
+
+    params = dict(
+        allow_empty_kb=allow_empty_kb,
+        vs_type=vs_type,
+        embed_model=embed_model,
+        text_splitter_name=text_splitter_name,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        zh_title_enhance=zh_title_enhance,
+    )
+    try:
+        job = await run_in_kb_executor(
+            "ingest", submit_kb_job, knowledge_base_name, "recreate_vector_store", params
+        )
+    except KBWriteConflict as e:
+        return BaseResponse(code=409, msg=str(e))
+    return BaseResponse(code=200, msg=f"已提交任务 {job['id']}", data=job)
+
+
+async def submit_recreate_summary_vector_store(
+        knowledge_base_name: str = Body(..., examples=["samples"]),
+        allow_empty_kb: bool = Body(True),
+        vs_type: str = Body(Settings.kb_settings.DEFAULT_VS_TYPE),
+        embed_model: str = Body(get_default_embedding()),
+        file_description: str = Body(""),
+        model_name: str = Body(None, description="LLM 模型名称。"),
+        temperature: float = Body(0.01, description="LLM 采样温度", ge=0.0, le=1.0),
+        max_tokens: Optional[int] = Body(
+            None, description="限制LLM生成Token数量，默认None代表模型最大值"
+        ),
+) -> BaseResponse:
+    """
+    提交后台重建知识库摘要任务，参数与 recreate_summary_vector_store 相同，立即返回任务信息
+    """
+    if not validate_kb_name(knowledge_base_name):
+        return BaseResponse(code=403, msg="Don't attack me")
+    if max_tokens in [None, 0]:
+        max_tokens = Settings.model_settings.MAX_TOKENS
+
+    params = dict(
+        allow_empty_kb=allow_empty_kb,
+        vs_type=vs_type,
+        embed_model=embed_model,
+        file_description=file_description,
+        model_name=model_name,
+        temperature=temperature,
+        max_tokens=max_tokens,
+    )
+    try:
+        job = await run_in_kb_executor(
+            "ingest", submit_kb_job, knowledge_base_name, "recreate_summary_vector_store", params
+        )
+    except KBWriteConflict as e:
+        return BaseResponse(code=409, msg=str(e))
+    return BaseResponse(code=200, msg=f"已提交任务 {job['id']}", data=job)
+
+
+async def submit_upload_docs(
+        files: List[UploadFile] = File(..., description="上传文件，支持多文件"),
+        knowledge_base_name: str = Form(
+            ..., description="知识库名称", examples=["samples"]
+        ),
+        override: bool = Form(False, description="覆盖已有文件"),
+        text_splitter_name: str = Form(Settings.kb_settings.TEXT_SPLITTER_NAME, description="文本分割器名称"),
+        chunk_size: int = Form(Settings.kb_settings.CHUNK_SIZE, description="知识库中单段文本最大长度"),
+        chunk_overlap: int = Form(Settings.kb_settings.OVERLAP_SIZE, description="知识库中相邻文本重合长度"),
+        zh_title_enhance: bool = Form(Settings.kb_settings.ZH_TITLE_ENHANCE, description="是否开启中文标题加强"),
+) -> BaseResponse:
+    """
+    上传文件并提交后台向量化任务：文件保存到知识库目录后立即返回，向量化由后台 worker 执行
+    """
+    if not validate_kb_name(knowledge_base_name):
+        return BaseResponse(code=403, msg="Don't attack me")
+
+    kb = await run_in_kb_executor("query", KBServiceFactory.get_service_by_name, knowledge_base_name)
+    if kb is None:
+        return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
+
+    failed_files = {}
+    file_names = []
+    for result in await _save_files(files, knowledge_base_name=knowledge_base_name, override=override):
+        filename = result["data"]["file_name"]
+        if result["code"] != 200:
+            failed_files[filename] = result["msg"]
+        else:
+            file_names.append(filename)
+
+    job = None
+    if file_names:
+        params = dict(
+            file_names=file_names,
+            text_splitter_name=text_splitter_name,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            zh_title_enhance=zh_title_enhance,
+        )
+        try:
+            job = await run_in_kb_executor(
+                "ingest", submit_kb_job, knowledge_base_name, "update_docs", params
+            )
+        except KBWriteConflict as e:
+            return BaseResponse(code=409, msg=str(e), data={"failed_files": failed_files, "job": None})
+    return BaseResponse(
+        code=200,
+        msg="文件上传完成" + (f"，已提交任务 {job['id']}" if job else ""),
+        data={"failed_files": failed_files, "job": job},
+    )
+
+
+def list_kb_jobs(
+        knowledge_base_name: str = Query(None, description="知识库名称，为空时列出所有知识库的任务"),
+        status: str = Query(None, description="任务状态：pending, running, succeeded, failed, cancelled"),
+        limit: int = Query(100, description="返回的最大任务数量"),
+) -> ListResponse:
+    """
+    列出后台任务，按提交时间倒序
+    """
+    return ListResponse(
+        data=list_kb_jobs_from_db(kb_name=knowledge_base_name, status=status, limit=limit)
+    )
+
+
+def get_kb_job(job_id: str = Query(..., description="任务ID")) -> BaseResponse:
+    """
+    获取后台任务的状态和进度
+    """
+    job = get_kb_job_from_db(job_id)
+    if job is None:
+        return BaseResponse(code=404, msg=f"未找到任务 {job_id}")
+    return BaseResponse(data=job)
+
+
+def cancel_kb_job(job_id: str = Body(..., embed=True, description="任务ID")) -> BaseResponse:
+    """
+    取消后台任务。执行中的任务在处理完当前文件、保存检查点后停止
+    """
+    status = cancel_kb_job_in_db(job_id)
+    if status is None:
+        return BaseResponse(code=404, msg=f"未找到任务 {job_id}")
+    if status in KB_JOB_FINAL_STATUS:
+        return BaseResponse(code=200, msg=f"任务 {job_id} 已结束：{status}")
+    return BaseResponse(code=200, msg=f"已请求取消任务 {job_id}")
+
+
+async def kb_job_events(job_id: str = Query(..., description="任务ID")):
+    """
+    以 SSE 方式推送后台任务的状态和进度，任务结束后关闭连接。客户端断开不影响任务执行，可随时重新订阅
+    """
+
+    async def output():
+        last = None
+        try:
+            while True:
+                job = await run_in_kb_executor("query", get_kb_job_from_db, job_id)
+                if job is None:
+                    yield json.dumps({"code": 404, "msg": f"未找到任务 {job_id}"}, ensure_ascii=False)
+                    return
+                progress = {
+                    "code": 200,
+                    "msg": job["msg"],
+                    "job_id": job_id,
+                    "status": job["status"],
+                    "total": job["total"],
+                    "finished": job["finished"],
+                    "failed_files": job["checkpoint"].get("failed", {}),
+                }
+                if progress != last:
+                    yield json.dumps(progress, ensure_ascii=False)
+                    last = progress
+                if job["status"] in KB_JOB_FINAL_STATUS:
+                    return
+                await asyncio.sleep(Settings.kb_settings.KB_JOB_POLL_INTERVAL)
+        except asyncio.exceptions.CancelledError:
+            logger.warning("streaming progress has been interrupted by user.")
+            return
+
+    return EventSourceResponse(output())
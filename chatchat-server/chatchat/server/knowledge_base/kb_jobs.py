@@ -0,0 +1,428 @@
+import asyncio
+import functools
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Generator, List, Optional
+
+from chatchat.settings import Settings
+from chatchat.server.db.models.base import name_key
+from chatchat.server.db.repository.kb_job_repository import (
+    add_kb_job_to_db,
+    claim_kb_job,
+    count_active_kb_jobs,
+    finish_kb_job,
+    list_kb_jobs_finished_since,
+    requeue_stale_kb_jobs,
+    touch_kb_job,
+    update_kb_job_progress,
+)
+from chatchat.server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool
+from chatchat.server.knowledge_base.kb_executor import run_in_kb_executor
+from chatchat.server.knowledge_base.kb_pipeline import IngestPipeline
+from chatchat.server.knowledge_base.kb_service.base import KBService, KBServiceFactory
+from chatchat.server.knowledge_base.utils import list_files_from_folder
+from chatchat.utils import build_logger
+
+
+logger = build_logger()
+
+
+class KBJobContext:
+    """
+    单个后台任务的执行状态。
+    checkpoint 中记录已经持久化的进度：
+    - cleared：重建任务是否已清空原有向量库
+    - done：已写入并保存到磁盘的文件
+    - failed：处理失败的文件及错误信息
+    任务中断后重新执行时跳过 done 和 failed 中的文件。
+    """
+
+    def __init__(self, job: Dict):
+        self.job_id = job["id"]
+        self.kb_name = job["kb_name"]
+        self.params = job["params"]
+        self.checkpoint = dict(job["checkpoint"])
+        self.checkpoint.setdefault("done", [])
+        self.checkpoint.setdefault("failed", {})
+        self.total = job["total"]
+        self.cancelled = False
+        self._unsaved: List[str] = []
+
+    @property
+    def finished(self) -> int:
+        return len(self.checkpoint["done"]) + len(self.checkpoint["failed"]) + len(self._unsaved)
+
+    def is_processed(self, file_name: str) -> bool:
+        return file_name in self.checkpoint["done"] or file_name in self.checkpoint["failed"]
+
+    def set_total(self, total: int):
+        self.total = total
+        self._report(msg=f"共 {total} 个文件")
+
+    def file_done(self, file_name: str, error: str = None, persist: Callable = None):
+        """
+        记录一个文件处理完成。成功的文件在下一次保存检查点（save）之后才算作已完成
+        """
+        if error is None:
+            self._unsaved.append(file_name)
+            msg = f"({self.finished} / {self.total}): {file_name}"
+        else:
+            self.checkpoint["failed"][file_name] = error
+            msg = error
+        if len(self._unsaved) >= Settings.kb_settings.KB_JOB_CHECKPOINT_FILES:
+            self.save(persist, msg=msg)
+        else:
+            self._report(msg=msg)
+
+    def save(self, persist: Callable = None, msg: str = None):
+        """
+        先保存向量库，再记录检查点，保证检查点中的文件已经写入磁盘
+        """
+        if persist is not None:
+            persist()
+        self.checkpoint["done"].extend(self._unsaved)
+        self._unsaved = []
+        self._report(msg=msg, checkpoint=self.checkpoint)
+
+    def _report(self, msg: str = None, checkpoint: Dict = None):
+        if update_kb_job_progress(
+            self.job_id,
+            total=self.total,
+            finished=self.finished,
+            checkpoint=checkpoint,
+            msg=msg,
+        ):
+            self.cancelled = True
+
+
+def _persist_vector_store(kb: KBService):
+    kb.save_vector_store()
+    kb_faiss_pool.flush_kb(kb.kb_name)
+
+
+def _ingest_files(ctx: KBJobContext, kb: KBService, pipeline: IngestPipeline, files: List[str]):
+    """
+    以流水线方式将文件写入知识库，定期保存检查点，收到取消请求后在当前文件完成后停止
+    """
+    persist = functools.partial(_persist_vector_store, kb)
+    results = pipeline.run([(f, ctx.kb_name) for f in files if not ctx.is_processed(f)])
+    try:
+        for status, (kb_name, file_name, result) in results:
+            ctx.file_done(file_name, error=None if status else result, persist=persist)
+            if ctx.cancelled:
+                break
+    finally:
+        results.close()
+        ctx.save(persist)
+
+
+def recreate_vector_store_job(ctx: KBJobContext):
+    """
+    后台重建向量库，参数与 recreate_vector_store 接口相同
+    """
+    params = ctx.params
+    kb = KBServiceFactory.get_service(ctx.kb_name, params["vs_type"], params["embed_model"])
+    if not kb.exists() and not params.get("allow_empty_kb", True):
+        raise ValueError(f"未找到知识库 ‘{ctx.kb_name}’")
+    ok, msg = kb.check_embed_model()
+    if not ok:
+        raise ValueError(msg)
+
+    if not ctx.checkpoint.get("cleared"):
+        if kb.exists():
+            kb.clear_vs()
+        kb.create_kb()
+        ctx.checkpoint["cleared"] = True
+        ctx.save()
+    else:
+        logger.info(f"知识库 {ctx.kb_name} 重建任务 {ctx.job_id} 从检查点继续执行")
+        kb.create_kb()
+
+    files = list_files_from_folder(ctx.kb_name)
+    ctx.set_total(len(files))
+    # 中断时正在写入的文件可能已部分写入，add_doc 写入前会先删除同名文件的旧数据
+    pipeline = IngestPipeline(
+        kb,
+        text_splitter_name=params["text_splitter_name"],
+        chunk_size=params["chunk_size"],
+        chunk_overlap=params["chunk_overlap"],
+        zh_title_enhance=params["zh_title_enhance"],
+    )
+    _ingest_files(ctx, kb, pipeline, files)
+
+
+def update_docs_job(ctx: KBJobContext):
+    """
+    后台向量化已上传到知识库目录的文件，用于后台上传接口
+    """
+    params = ctx.params
+    kb = KBServiceFactory.get_service_by_name(ctx.kb_name)
+    if kb is None:
+        raise ValueError(f"未找到知识库 {ctx.kb_name}")
+
+    files = params["file_names"]
+    ctx.set_total(len(files))
+    pipeline = IngestPipeline(
+        kb,
+        update=True,
+        text_splitter_name=params["text_splitter_name"],
+        chunk_size=params["chunk_size"],
+        chunk_overlap=params["chunk_overlap"],
+        zh_title_enhance=params["zh_title_enhance"],
+    )
+    _ingest_files(ctx, kb, pipeline, files)
+
+
+def recreate_summary_vector_store_job(ctx: KBJobContext):
+    """
+    后台重建知识库文件摘要，参数与 recreate_summary_vector_store 接口相同。
+    每个文件的摘要写入后立即保存，检查点按文件记录
+    """
+    from chatchat.server.knowledge_base.kb_summary.base import KBSummaryService
+    from chatchat.server.knowledge_base.kb_summary.summary_chunk import SummaryAdapter
+    from chatchat.server.utils import get_ChatOpenAI
+
+    params = ctx.params
+    kb = KBServiceFactory.get_service(ctx.kb_name, params["vs_type"], params["embed_model"])
+    if not kb.exists() and not params.get("allow_empty_kb", True):
+        raise ValueError(f"未找到知识库 ‘{ctx.kb_name}’")
+    ok, msg = kb.check_embed_model()
+    if not ok:
+        raise ValueError(msg)
+
+    kb_summary = KBSummaryService(ctx.kb_name, params["embed_model"])
+    if not ctx.checkpoint.get("cleared"):
+        kb_summary.drop_kb_summary()
+        kb_summary.create_kb_summary()
+        ctx.checkpoint["cleared"] = True
+        ctx.save()
+
+    llm = get_ChatOpenAI(
+        model_name=params["model_name"],
+        temperature=params["temperature"],
+        max_tokens=params["max_tokens"],
+        local_wrap=True,
+    )
+    reduce_llm = get_ChatOpenAI(
+        model_name=params["model_name"],
+        temperature=params["temperature"],
+        max_tokens=params["max_tokens"],
+        local_wrap=True,
+    )
+    summary = SummaryAdapter.form_summary(
+        llm=llm, reduce_llm=reduce_llm, overlap_size=Settings.kb_settings.OVERLAP_SIZE
+    )
+
+    files = list_files_from_folder(ctx.kb_name)
+    ctx.set_total(len(files))
+    for file_name in files:
+        if ctx.cancelled:
+            break
+        if ctx.is_processed(file_name):
+            continue
+        doc_infos = kb.list_docs(file_name=file_name)
+        docs = summary.summarize(file_description=params["file_description"], docs=doc_infos)
+        if kb_summary.add_kb_summary(summary_combine_docs=docs):
+            ctx.file_done(file_name)
+        else:
+            ctx.file_done(
+                file_name,
+                error=f"知识库'{ctx.kb_name}'总结文件‘{file_name}’时出错。已跳过。",
+            )
+    ctx.save()
+
+
+KB_JOB_HANDLERS: Dict[str, Callable[[KBJobContext], None]] = {
+    "recreate_vector_store": recreate_vector_store_job,
+    "recreate_summary_vector_store": recreate_summary_vector_store_job,
+    "update_docs": update_docs_job,
+}
+
+
+class KBWriteConflict(Exception):
+    """提交后台任务时，本进程中该知识库有进行中的同步修改"""
+
+
+class KBWriteGuard:
+    """
+    记录本进程中进行中的同步修改（上传、更新、删除文件等），按知识库名称（不区分大小写）计数。
+    同步修改先登记再检查后台任务；提交后台任务时在锁内确认没有同步修改后才写入任务，
+    因此不会出现任务执行期间 API 进程仍在修改同一知识库、随后覆盖任务结果的情况。只在单个 API 进程内有效
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._writers: Dict[str, int] = {}
+
+    @contextmanager
+    def write(self, kb_name: str):
+        key = name_key(kb_name)
+        with self._lock:
+            self._writers[key] = self._writers.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._writers[key] -= 1
+                if not self._writers[key]:
+                    del self._writers[key]
+
+    @contextmanager
+    def exclusive(self, kb_name: str):
+        """
+        确认没有进行中的同步修改，并在执行期间阻止新的同步修改登记，否则抛出 KBWriteConflict
+        """
+        with self._lock:
+            if count := self._writers.get(name_key(kb_name)):
+                raise KBWriteConflict(f"知识库 {kb_name} 有 {count} 个进行中的修改，请在修改完成后再提交后台任务")
+            yield
+
+
+kb_write_guard = KBWriteGuard()
+
+
+def submit_kb_job(kb_name: str, job_type: str, params: Dict) -> Dict:
+    """
+    提交后台任务，返回任务信息。提交前保存本进程中该知识库尚未写入磁盘的修改，worker 进程从磁盘读取最新的向量库。
+    本进程中该知识库有进行中的同步修改时抛出 KBWriteConflict
+    """
+    if job_type not in KB_JOB_HANDLERS:
+        raise ValueError(f"不支持的任务类型：{job_type}")
+    # 先在锁外保存，锁内只需保存期间新产生的修改，减少阻塞同步修改的时间
+    kb_faiss_pool.flush_kb(kb_name)
+    with kb_write_guard.exclusive(kb_name):
+        kb_faiss_pool.flush_kb(kb_name)
+        return add_kb_job_to_db(
+            job_id=uuid.uuid4().hex, kb_name=kb_name, job_type=job_type, params=params
+        )
+
+
+def kb_job_conflict(kb_name: str) -> Optional[str]:
+    """
+    知识库有等待或执行中的后台任务时返回提示信息，同步修改知识库的接口据此拒绝请求：
+    任务结束后 API 进程会丢弃该知识库的向量库缓存，任务期间的同步修改会丢失或被任务结果覆盖
+    """
+    if count_active_kb_jobs(kb_name):
+        return f"知识库 {kb_name} 有等待或执行中的后台任务，请在任务结束后再修改"
+
+
+@contextmanager
+def kb_sync_write(kb_name: str) -> Generator[Optional[str], None, None]:
+    """
+    同步修改知识库的接口在此上下文中执行：先登记为进行中的修改，再检查后台任务。
+    有等待或执行中的后台任务时得到提示信息，接口据此拒绝请求
+    """
+    with kb_write_guard.write(kb_name):
+        yield kb_job_conflict(kb_name)
+
+
+class KBJobWorker:
+    """
+    后台任务 worker：从 info.db 中领取任务并执行，每次执行一个任务。
+    执行期间定期写入心跳，worker 崩溃后任务在心跳超时后被其它 worker（或重启后的 worker）重新领取，从检查点继续执行。
+    """
+
+    def __init__(self, name: str = None):
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.heartbeat_interval = Settings.kb_settings.KB_JOB_HEARTBEAT_SECONDS
+        self.poll_interval = Settings.kb_settings.KB_JOB_POLL_INTERVAL
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def _heartbeat(self, ctx: KBJobContext, done: threading.Event):
+        while not done.wait(self.heartbeat_interval):
+            try:
+                if touch_kb_job(ctx.job_id):
+                    ctx.cancelled = True
+            except Exception as e:
+                logger.warning(f"更新任务 {ctx.job_id} 心跳失败：{e}")
+
+    def execute(self, job: Dict):
+        ctx = KBJobContext(job)
+        logger.info(f"worker {self.name} 开始执行任务 {job['id']}（{job['job_type']}，知识库 {job['kb_name']}）")
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(ctx, done), daemon=True)
+        heartbeat.start()
+        try:
+            # 上一个任务之后 API 进程可能修改了该知识库，丢弃本进程中的旧缓存，从磁盘重新加载
+            kb_faiss_pool.drop_kb(ctx.kb_name)
+            KBServiceFactory.invalidate(ctx.kb_name)
+            KB_JOB_HANDLERS[job["job_type"]](ctx)
+            if ctx.cancelled:
+                status, msg = "cancelled", "任务已取消"
+            else:
+                failed = ctx.checkpoint["failed"]
+                status = "succeeded"
+                msg = f"任务完成，共处理 {ctx.finished} 个文件" + (f"，{len(failed)} 个文件失败" if failed else "")
+        except Exception as e:
+            logger.exception(f"执行任务 {job['id']} 时出错：{e}")
+            status, msg = "failed", f"{e.__class__.__name__}: {e}"
+        finally:
+            done.set()
+        finish_kb_job(job["id"], status=status, msg=msg)
+        logger.info(f"任务 {job['id']} 结束：{status}，{msg}")
+
+    def run_once(self) -> bool:
+        """
+        领取并执行一个任务，没有可执行的任务时返回 False
+        """
+        job = claim_kb_job(self.name, max_per_kb=Settings.kb_settings.KB_JOB_MAX_PER_KB)
+        if job is None:
+            return False
+        self.execute(job)
+        return True
+
+    def run_forever(self):
+        logger.info(f"知识库后台任务 worker {self.name} 已启动")
+        while not self._stop.is_set():
+            try:
+                if requeued := requeue_stale_kb_jobs(self.heartbeat_interval * 6):
+                    logger.warning(f"任务 {requeued} 心跳超时，已重新放回队列")
+                if self.run_once():
+                    continue
+            except Exception as e:
+                logger.exception(f"知识库后台任务 worker 出错：{e}")
+            self._stop.wait(self.poll_interval)
+
+
+def run_kb_job_worker(index: int = 0):
+    """
+    worker 进程入口
+    """
+    worker = KBJobWorker(name=f"{socket.gethostname()}:{os.getpid()}:{index}")
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        kb_faiss_pool.flush_all()
+
+
+async def watch_kb_jobs():
+    """
+    在 API 进程中运行：后台任务结束后丢弃本进程中对应知识库的向量库缓存和 KBService 实例，之后的请求从磁盘加载 worker 写入的结果
+    """
+    since = datetime.now()
+    while True:
+        await asyncio.sleep(Settings.kb_settings.KB_JOB_POLL_INTERVAL)
+        now = datetime.now()
+        try:
+            jobs = await run_in_kb_executor("query", list_kb_jobs_finished_since, since)
+        except Exception as e:
+            logger.warning(f"查询已完成的后台任务失败：{e}")
+            continue
+        since = now
+        for kb_name in {job["kb_name"] for job in jobs}:
+            kb_faiss_pool.drop_kb(kb_name)
+            KBServiceFactory.invalidate(kb_name)
+
+
+if __name__ == "__main__":
+    # 单独启动一个 worker 进程：python kb_jobs.py
+    run_kb_job_worker()
@@ -0,0 +1,341 @@
+import queue
+import threading
+import time
+from typing import Dict, Generator, List, Literal, Tuple, Union
+
+from langchain.docstore.document import Document
+
+from chatchat.settings import Settings
+from chatchat.server.db.repository.knowledge_file_repository import (
+    list_doc_hashes_from_db,
+)
+from chatchat.server.embedding_cache import text_hash
+from chatchat.server.knowledge_base.kb_service.base import KBService
+from chatchat.server.knowledge_base.utils import KnowledgeFile, files2docs_in_thread
+from chatchat.server.utils import embed_model_health, get_Embeddings
+from chatchat.utils import build_logger
+
+
+logger = build_logger()
+
+
+_STOP = object()
+
+STAGE_JOIN_TIMEOUT = 10
+"""流水线结束时等待解析、向量化线程退出的最长时间（秒），正在解析或向量化的文件完成后线程才会退出"""
+
+
+class StageStats:
+    """
+    流水线单个阶段的统计：处理的文件数、文本块数，工作耗时，以及因下游队列已满而阻塞的时间
+    """
+
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.files = 0
+        self.chunks = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, chunks: int, busy: float, ok: bool = True):
+        with self._lock:
+            self.files += 1
+            self.chunks += chunks
+            self.busy += busy
+            if not ok:
+                self.errors += 1
+
+    def record_blocked(self, seconds: float):
+        with self._lock:
+            self.blocked += seconds
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "files": self.files,
+                "chunks": self.chunks,
+                "errors": self.errors,
+                "busy_seconds": round(self.busy, 3),
+                "blocked_seconds": round(self.blocked, 3),
+                # 单个 worker 每秒处理的文本块数
+                "chunks_per_second": round(self.chunks / self.busy, 2) if self.busy else 0.0,
+            }
+
+
+class IngestPipeline:
+    """
+    流水线式文件入库：解析切分 → 分批向量化 → 写入向量库，三个阶段同时运行。
+    - parse：使用 files2docs_in_thread 多线程/多进程解析文件
+    - embed：INGEST_EMBED_WORKERS 个线程并发请求嵌入模型，每次最多提交 INGEST_EMBED_BATCH_SIZE 个文本块
+    - write：在调用方线程中逐个文件写入向量库和数据库
+    阶段之间使用容量为 INGEST_QUEUE_SIZE 的队列连接，下游处理不过来时上游阻塞，
+    这样嵌入模型在文件仍在解析时就开始工作，内存中缓冲的文件数也有上限。
+
+    向量库不支持传入预先计算的向量（supports_precomputed_embeddings=False）时，
+    embed 阶段的结果写入嵌入向量缓存，写入阶段直接命中缓存；未开启缓存时 embed 阶段只做转发。
+    更新文件（update=True）时写入阶段按文本块哈希增量更新（KBService.sync_doc），
+    embed 阶段只预先向量化数据库中不存在的文本块并写入缓存。
+
+    run() 的返回值与 files2docs_in_thread 相同：status, (kb_name, file_name, docs | error)，
+    不同的是每个结果都已经写入知识库。
+    """
+
+    def __init__(
+        self,
+        kb: KBService,
+        update: bool = False,
+        text_splitter_name: str = Settings.kb_settings.TEXT_SPLITTER_NAME,
+        chunk_size: int = Settings.kb_settings.CHUNK_SIZE,
+        chunk_overlap: int = Settings.kb_settings.OVERLAP_SIZE,
+        zh_title_enhance: bool = Settings.kb_settings.ZH_TITLE_ENHANCE,
+        parse_executor: Literal["thread", "process"] = None,
+        parse_workers: int = 0,
+        embed_workers: int = 0,
+        embed_batch_size: int = 0,
+        queue_size: int = 0,
+    ):
+        """
+        update=True 时调用 kb.update_doc 更新已有文件，否则调用 kb.add_doc
+        """
+        self.kb = kb
+        self.update = update
+        self.text_splitter_name = text_splitter_name
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.zh_title_enhance = zh_title_enhance
+        self.parse_executor = parse_executor or Settings.kb_settings.FILE_PARSE_EXECUTOR
+        self.parse_workers = parse_workers
+        self.embed_workers = max(1, embed_workers or Settings.kb_settings.INGEST_EMBED_WORKERS)
+        self.embed_batch_size = embed_batch_size or Settings.kb_settings.INGEST_EMBED_BATCH_SIZE
+        self.queue_size = max(1, queue_size or Settings.kb_settings.INGEST_QUEUE_SIZE)
+
+        if kb.supports_precomputed_embeddings and not update:
+            self.embed_mode = "precompute"
+        elif Settings.kb_settings.EMBEDDING_CACHE_ENABLED:
+            self.embed_mode = "warm_cache"
+        else:
+            self.embed_mode = "passthrough"
+
+        self._stages = {
+            "parse": StageStats("parse", parse_workers or 0),
+            "embed": StageStats("embed", self.embed_workers),
+            "write": StageStats("write", 1),
+        }
+        self._elapsed = 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "embed_mode": self.embed_mode,
+            "queue_size": self.queue_size,
+            "elapsed_seconds": round(self._elapsed, 3),
+            "stages": {k: v.to_dict() for k, v in self._stages.items()},
+        }
+
+    def _put(self, q: queue.Queue, item, stage: StageStats, stop: threading.Event) -> bool:
+        """放入下游队列，队列已满时阻塞等待（背压）。流水线被终止时返回 False"""
+        start = time.perf_counter()
+        try:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stage.record_blocked(time.perf_counter() - start)
+
+    def _get(self, q: queue.Queue, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def _parse_worker(self, files: List, out_q: queue.Queue, stop: threading.Event):
+        stage = self._stages["parse"]
+        results = files2docs_in_thread(
+            files,
+            text_splitter_name=self.text_splitter_name,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            zh_title_enhance=self.zh_title_enhance,
+            executor=self.parse_executor,
+            max_workers=self.parse_workers,
+            max_pending=self.queue_size,
+        )
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    status, result = next(results)
+                except StopIteration:
+                    break
+                chunks = len(result[2]) if status else 0
+                stage.record(chunks, time.perf_counter() - start, ok=status)
+                if not self._put(out_q, (status, result), stage, stop):
+                    break
+        except Exception as e:
+            logger.exception(f"入库流水线解析文件时出错：{e}")
+        finally:
+            results.close()
+            for _ in range(self.embed_workers):
+                if not self._put(out_q, _STOP, stage, stop):
+                    break
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        embeddings = get_Embeddings(self.kb.embed_model)
+        vectors = []
+        for i in range(0, len(texts), self.embed_batch_size):
+            vectors.extend(embeddings.embed_documents(texts[i: i + self.embed_batch_size]))
+        return vectors
+
+    def _embed_worker(self, in_q: queue.Queue, out_q: queue.Queue, stop: threading.Event):
+        stage = self._stages["embed"]
+        try:
+            while True:
+                item = self._get(in_q, stop)
+                if item is _STOP:
+                    break
+                status, result = item
+                vectors = None
+                if status and result[2] and self.embed_mode != "passthrough":
+                    kb_name, file_name, docs = result
+                    start = time.perf_counter()
+                    try:
+                        texts = [doc.page_content for doc in docs]
+                        if self.update:
+                            known = {
+                                h for _, h in list_doc_hashes_from_db(
+                                    kb_name=kb_name, file_name=file_name
+                                )
+                            }
+                            texts = [t for t in texts if text_hash(t) not in known]
+                        vectors = self._embed(texts)
+                        stage.record(len(docs), time.perf_counter() - start)
+                    except Exception as e:
+                        msg = f"向量化文件 {kb_name}/{file_name} 时出错：{e}"
+                        logger.error(f"{e.__class__.__name__}: {msg}")
+                        embed_model_health.report_failure(self.kb.embed_model, e)
+                        stage.record(len(docs), time.perf_counter() - start, ok=False)
+                        status, result = False, (kb_name, file_name, msg)
+                if self.embed_mode != "precompute":
+                    vectors = None
+                if not self._put(out_q, (status, result, vectors), stage, stop):
+                    break
+        finally:
+            self._put(out_q, _STOP, stage, stop)
+
+    def _write(
+        self, kb_name: str, file_name: str, docs: List[Document], vectors: List[List[float]]
+    ) -> Union[bool, None]:
+        kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=kb_name)
+        kb_file.splited_docs = docs
+        kwargs = {"not_refresh_vs_cache": True}
+        if vectors:
+            kwargs["embeddings"] = vectors
+        if self.update:
+            return self.kb.update_doc(
+                kb_file, text_splitter_name=self.text_splitter_name, **kwargs
+            )
+        return self.kb.add_doc(
+            kb_file,
+            text_splitter_name=self.text_splitter_name,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            **kwargs,
+        )
+
+    def run(
+        self, files: List[Union[KnowledgeFile, Tuple[str, str], Dict]]
+    ) -> Generator[Tuple[bool, Tuple[str, str, Union[List[Document], str]]], None, None]:
+        """
+        运行流水线，每写入（或失败）一个文件返回一个结果。
+        写入阶段在调用方线程中执行；提前关闭生成器会终止流水线，已入队但未写入的文件被丢弃。
+        向量库的保存（save_vector_store）由调用方在结束后执行。
+        每次运行使用独立的停止标志和队列，结束时等待本次运行的线程退出，同一实例可以再次运行。
+        """
+        stop = threading.Event()
+        start = time.perf_counter()
+        parsed_q = queue.Queue(maxsize=self.queue_size)
+        embedded_q = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(
+                target=self._parse_worker, args=(files, parsed_q, stop), daemon=True
+            )
+        ] + [
+            threading.Thread(
+                target=self._embed_worker, args=(parsed_q, embedded_q, stop), daemon=True
+            )
+            for _ in range(self.embed_workers)
+        ]
+        for t in threads:
+            t.start()
+
+        stage = self._stages["write"]
+        running = self.embed_workers
+        try:
+            while running:
+                item = self._get(embedded_q, stop)
+                if item is _STOP:
+                    running -= 1
+                    continue
+                status, result, vectors = item
+                if not status:
+                    yield status, result
+                    continue
+                kb_name, file_name, docs = result
+                write_start = time.perf_counter()
+                try:
+                    self._write(kb_name, file_name, docs, vectors)
+                    stage.record(len(docs), time.perf_counter() - write_start)
+                except Exception as e:
+                    msg = f"将文件 {kb_name}/{file_name} 写入知识库时出错：{e}"
+                    logger.error(f"{e.__class__.__name__}: {msg}")
+                    stage.record(len(docs), time.perf_counter() - write_start, ok=False)
+                    yield False, (kb_name, file_name, msg)
+                    continue
+                yield True, (kb_name, file_name, docs)
+        finally:
+            stop.set()
+            deadline = time.monotonic() + STAGE_JOIN_TIMEOUT
+            for t in threads:
+                t.join(max(0.0, deadline - time.monotonic()))
+            if alive := [t.name for t in threads if t.is_alive()]:
+                logger.warning(f"知识库 {self.kb.kb_name} 入库流水线已结束，线程 {alive} 仍在处理当前文件，完成后退出")
+            self._elapsed = time.perf_counter() - start
+            logger.info(f"知识库 {self.kb.kb_name} 入库流水线结束：{self.stats()}")
+
+
+if __name__ == "__main__":
+    # 入库耗时对比：逐个文件解析后串行向量化写入 vs 流水线
+    import sys
+
+    from chatchat.server.knowledge_base.kb_service.base import KBServiceFactory
+    from chatchat.server.knowledge_base.utils import list_files_from_folder
+
+    kb_name = sys.argv[1] if len(sys.argv) > 1 else "samples"
+    kb = KBServiceFactory.get_service_by_name(kb_name)
+    files = [(f, kb_name) for f in list_files_from_folder(kb_name)]
+    Settings.kb_settings.EMBEDDING_CACHE_ENABLED = False  # 避免第二轮直接命中缓存
+
+    start = time.perf_counter()
+    for status, result in files2docs_in_thread(files):
+        if status:
+            kb_file = KnowledgeFile(filename=result[1], knowledge_base_name=kb_name)
+            kb_file.splited_docs = result[2]
+            kb.update_doc(kb_file, not_refresh_vs_cache=True)
+    print(f"serial  : {time.perf_counter() - start:.1f}s")
+
+    pipeline = IngestPipeline(kb, update=True)
+    start = time.perf_counter()
+    for _ in pipeline.run(files):
+        pass
+    print(f"pipeline: {time.perf_counter() - start:.1f}s")
+    print(pipeline.stats())
+    kb.save_vector_store()
@@ -1,13 +1,15 @@
 import operator
 import os
+import threading
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from langchain.docstore.document import Document
 
 from chatchat.settings import Settings
 from chatchat.utils import build_logger
+from chatchat.server.db.models.base import name_key
 from chatchat.server.db.models.knowledge_base_model import KnowledgeBaseSchema
 from chatchat.server.db.repository.knowledge_base_repository import (
     add_kb_to_db,
@@ -23,9 +25,12 @@ from chatchat.server.db.repository.knowledge_file_repository import (
     delete_files_from_db,
     file_exists_in_db,
     get_file_detail,
+    list_doc_hashes_from_db,
     list_docs_from_db,
     list_files_from_db,
+    update_file_docs_in_db,
 )
+from chatchat.server.embedding_cache import text_hash
 from chatchat.server.knowledge_base.model.kb_document_model import DocumentWithVSId
 from chatchat.server.knowledge_base.utils import (
     KnowledgeFile,
@@ -35,9 +40,14 @@ from chatchat.server.knowledge_base.utils import (
     list_kbs_from_folder,
     make_text_splitter,
 )
+from chatchat.server.knowledge_base.kb_executor import run_in_kb_executor
 from chatchat.server.utils import (
+    KBListWatcher,
     check_embed_model as _check_embed_model,
+    embed_model_health,
     get_default_embedding,
+    get_Embeddings,
+    refresh_tools,
 )
 
 
@@ -56,6 +66,9 @@ class SupportedVSType:
 
 
 class KBService(ABC):
+    supports_precomputed_embeddings: bool = False
+    """do_add_doc 是否支持通过 embeddings 参数传入预先计算好的向量，供入库流水线跳过重复向量化"""
+
     def __init__(
         self,
         knowledge_base_name: str,
@@ -96,6 +109,8 @@ class KBService(ABC):
 
         if status:
             self.do_create_kb()
+        KBServiceFactory.invalidate(self.kb_name)
+        refresh_tools()
         return status
 
     def clear_vs(self):
@@ -112,6 +127,8 @@ class KBService(ABC):
         """
         self.do_drop_kb()
         status = delete_kb_from_db(self.kb_name)
+        KBServiceFactory.invalidate(self.kb_name)
+        refresh_tools()
         return status
 
     def add_doc(self,
@@ -141,22 +158,12 @@ class KBService(ABC):
             custom_docs = False
 
         if docs:
-            # 将 metadata["source"] 改为相对路径
-            for doc in docs:
-                try:
-                    doc.metadata.setdefault("source", kb_file.filename)
-                    source = doc.metadata.get("source", "")
-                    if os.path.isabs(source):
-                        rel_path = Path(source).relative_to(self.doc_path)
-                        doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
-                except Exception as e:
-                    print(
-                        f"cannot convert absolute path ({source}) to relative path. error is : {e}"
-                    )
+            self._normalize_docs_source(kb_file, docs)
             self.delete_doc(kb_file)
 
             # embedding docs
-            doc_infos = self.do_add_doc(docs, **kwargs)
+            doc_infos = self._do_add_doc_with_health(docs, **kwargs)
+            self._set_chunk_hashes(doc_infos, docs)
 
             status = add_file_to_db(
                 kb_file,
@@ -180,6 +187,20 @@ class KBService(ABC):
             os.remove(kb_file.filepath)
         return status
 
+    def delete_docs(
+        self, kb_files: List[KnowledgeFile], delete_content: bool = False, **kwargs
+    ):
+        """
+        从知识库批量删除文件，向量库只需删除、保存一次
+        """
+        kb_files = list({kb_file.filename: kb_file for kb_file in kb_files}.values())
+        self.do_delete_docs(kb_files, **kwargs)
+        for kb_file in kb_files:
+            delete_file_from_db(kb_file)
+            if delete_content and os.path.exists(kb_file.filepath):
+                os.remove(kb_file.filepath)
+        return True
+
     def update_info(self, kb_info: str):
         """
         更新知识库介绍
@@ -188,6 +209,8 @@ class KBService(ABC):
         status = add_kb_to_db(
             self.kb_name, self.kb_info, self.vs_type(), self.embed_model
         )
+        KBServiceFactory.invalidate(self.kb_name)
+        refresh_tools()
         return status
 
     def update_doc(self,
@@ -203,9 +226,101 @@ class KBService(ABC):
             return False
 
         if os.path.exists(kb_file.filepath):
+            if not docs:
+                status = self.sync_doc(kb_file, text_splitter_name=text_splitter_name, **kwargs)
+                if status is not None:
+                    return status
             self.delete_doc(kb_file, **kwargs)
             return self.add_doc(kb_file, text_splitter_name=text_splitter_name, docs=docs, **kwargs)
 
+    def sync_doc(
+        self,
+        kb_file: KnowledgeFile,
+        text_splitter_name: str = Settings.kb_settings.TEXT_SPLITTER_NAME,
+        chunk_size: int = Settings.kb_settings.CHUNK_SIZE,
+        chunk_overlap: int = Settings.kb_settings.OVERLAP_SIZE,
+        **kwargs,
+    ) -> Optional[bool]:
+        """
+        按文本块内容哈希增量更新文件：重新切分文件后，只向量化、写入内容变化的文本块，并删除已不存在的文本块。
+        内容未变化的文本块保留原有的向量和 metadata。
+        文件不在数据库中、使用了自定义 docs、旧数据没有哈希或向量库不支持按 id 删除时返回 None，由调用方全量更新。
+        """
+        file_detail = get_file_detail(kb_name=self.kb_name, filename=kb_file.filename)
+        if not file_detail or file_detail.get("custom_docs"):
+            return None
+        existing = list_doc_hashes_from_db(kb_name=self.kb_name, file_name=kb_file.filename)
+        if not existing or not all(h for _, h in existing):
+            return None
+
+        text_splitter = make_text_splitter(
+            splitter_name=text_splitter_name,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+        docs = kb_file.file2text(text_splitter=text_splitter)
+        if not docs:
+            return None
+        self._normalize_docs_source(kb_file, docs)
+
+        # 相同内容的文本块可能出现多次，按哈希逐个配对
+        ids_by_hash: Dict[str, List[str]] = {}
+        for doc_id, chunk_hash in existing:
+            ids_by_hash.setdefault(chunk_hash, []).append(doc_id)
+        new_docs = []
+        for doc in docs:
+            chunk_hash = text_hash(doc.page_content)
+            if ids_by_hash.get(chunk_hash):
+                ids_by_hash[chunk_hash].pop()
+            else:
+                new_docs.append(doc)
+        delete_ids = [doc_id for ids in ids_by_hash.values() for doc_id in ids]
+
+        if delete_ids:
+            try:
+                self.del_doc_by_ids(delete_ids)
+            except Exception as e:
+                logger.warning(f"{self.kb_name}/{kb_file.filename} 无法按 id 删除文档，改为全量更新：{e}")
+                return None
+        doc_infos = []
+        if new_docs:
+            kwargs.pop("embeddings", None)
+            doc_infos = self._do_add_doc_with_health(new_docs, **kwargs)
+            self._set_chunk_hashes(doc_infos, new_docs)
+        elif delete_ids and not kwargs.get("not_refresh_vs_cache"):
+            self.save_vector_store()
+        logger.info(
+            f"增量更新 {self.kb_name}/{kb_file.filename}：共 {len(docs)} 个文本块，"
+            f"新增 {len(new_docs)} 个，删除 {len(delete_ids)} 个"
+        )
+        return update_file_docs_in_db(
+            kb_file,
+            docs_count=len(docs),
+            add_doc_infos=doc_infos,
+            delete_doc_ids=delete_ids,
+        )
+
+    def _normalize_docs_source(self, kb_file: KnowledgeFile, docs: List[Document]):
+        """将 metadata["source"] 改为相对路径"""
+        for doc in docs:
+            try:
+                doc.metadata.setdefault("source", kb_file.filename)
+                source = doc.metadata.get("source", "")
+                if os.path.isabs(source):
+                    rel_path = Path(source).relative_to(self.doc_path)
+                    doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
+            except Exception as e:
+                print(
+                    f"cannot convert absolute path ({source}) to relative path. error is : {e}"
+                )
+
+    @staticmethod
+    def _set_chunk_hashes(doc_infos: List[Dict], docs: List[Document]):
+        """为 do_add_doc 返回的文档信息添加内容哈希，用于之后的增量更新"""
+        if doc_infos and len(doc_infos) == len(docs):
+            for info, doc in zip(doc_infos, docs):
+                info["chunk_hash"] = text_hash(doc.page_content)
+
     def exist_doc(self, file_name: str):
         return file_exists_in_db(
             KnowledgeFile(knowledge_base_name=self.kb_name, filename=file_name)
@@ -226,9 +341,34 @@ class KBService(ABC):
         if not self.check_embed_model()[0]:
             return []
 
-        docs = self.do_search(query, top_k, score_threshold)
+        try:
+            docs = self.do_search(query, top_k, score_threshold)
+        except Exception as e:
+            embed_model_health.report_failure(self.embed_model, e)
+            raise
+        embed_model_health.report_success(self.embed_model)
         return docs
 
+    async def asearch_docs(
+        self,
+        query: str,
+        top_k: int = Settings.kb_settings.VECTOR_SEARCH_TOP_K,
+        score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
+    ) -> List[Document]:
+        """
+        异步检索。查询向量先通过 aembed_query 异步获取并写入查询向量缓存，请求嵌入模型时不占用线程；
+        向量检索、BM25 等计算在知识库查询线程池中执行，届时查询向量直接命中缓存。
+        """
+        if query and Settings.kb_settings.QUERY_EMBEDDING_CACHE_ENABLED:
+            try:
+                await get_Embeddings(self.embed_model).aembed_query(query)
+            except Exception as e:
+                # 由 search_docs 重试并记录嵌入模型状态
+                logger.warning(f"异步获取查询向量失败：{e}")
+        return await run_in_kb_executor(
+            "query", self.search_docs, query, top_k, score_threshold
+        )
+
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
         return []
 
@@ -251,9 +391,21 @@ class KBService(ABC):
                 continue
             ids.append(_id)
             pending_docs.append(doc)
-        self.do_add_doc(docs=pending_docs, ids=ids)
+        self._do_add_doc_with_health(docs=pending_docs, ids=ids)
         return True
 
+    def _do_add_doc_with_health(self, docs: List[Document], **kwargs) -> List[Dict]:
+        """
+        调用 do_add_doc，并将实际调用结果同步到嵌入模型状态表
+        """
+        try:
+            doc_infos = self.do_add_doc(docs, **kwargs)
+        except Exception as e:
+            embed_model_health.report_failure(self.embed_model, e)
+            raise
+        embed_model_health.report_success(self.embed_model)
+        return doc_infos
+
     def list_docs(
         self, file_name: str = None, metadata: Dict = {}
     ) -> List[DocumentWithVSId]:
@@ -356,6 +508,13 @@ class KBService(ABC):
         """
         pass
 
+    def do_delete_docs(self, kb_files: List[KnowledgeFile], **kwargs):
+        """
+        从知识库批量删除文档，默认逐个文件调用 do_delete_doc，子类可以实现批量删除
+        """
+        for kb_file in kb_files:
+            self.do_delete_doc(kb_file, **kwargs)
+
     @abstractmethod
     def do_clear_vs(self):
         """
@@ -365,6 +524,14 @@ class KBService(ABC):
 
 
 class KBServiceFactory:
+    # 按知识库名称（name_key，不区分大小写）缓存的 KBService 实例, 值为 ((kb_name, vs_type, embed_model), service)
+    # 实例中的向量库客户端、数据库连接在请求之间复用, 不再每次检索都重新创建
+    _services: Dict[str, Tuple[Tuple[str, str, str], "KBService"]] = {}
+    _services_lock = threading.Lock()
+    _services_generation = 0
+    # 其它进程新建、删除或重建知识库后丢弃全部缓存的实例
+    _kb_watcher = KBListWatcher()
+
     @staticmethod
     def get_service(
         kb_name: str,
@@ -431,10 +598,48 @@ class KBServiceFactory:
 
     @staticmethod
     def get_service_by_name(kb_name: str) -> KBService:
-        _, vs_type, embed_model = load_kb_from_db(kb_name)
-        if _ is None:  # kb not in db, just return None
+        if KBServiceFactory._kb_watcher.check():
+            logger.info("知识库列表已被其它进程修改，丢弃缓存的 KBService 实例")
+            KBServiceFactory.invalidate()
+        key = name_key(kb_name)
+        with KBServiceFactory._services_lock:
+            cached = KBServiceFactory._services.get(key)
+        if cached is not None:
+            return cached[1]
+        generation = KBServiceFactory._services_generation
+
+        kb_name, vs_type, embed_model = load_kb_from_db(kb_name)
+        if kb_name is None:  # kb not in db, just return None
             return None
-        return KBServiceFactory.get_service(kb_name, vs_type, embed_model)
+        # 使用数据库中的知识库名称创建实例，不同大小写的请求共用同一个实例
+        service = KBServiceFactory.get_service(kb_name, vs_type, embed_model)
+        with KBServiceFactory._services_lock:
+            # 加载期间缓存被清除过时不写入, 避免缓存旧的知识库信息
+            if service is not None and generation == KBServiceFactory._services_generation:
+                # 并发创建时保留先写入的实例, 保证同一知识库只有一个实例
+                cached = KBServiceFactory._services.setdefault(
+                    key, ((kb_name, vs_type, embed_model), service)
+                )
+                service = cached[1]
+        return service
+
+    @staticmethod
+    def invalidate(kb_name: str = None):
+        """
+        丢弃缓存的 KBService 实例, kb_name 为 None 时丢弃全部.
+        新建、删除知识库或修改知识库信息后调用, 下次获取时重新从数据库加载.
+        """
+        with KBServiceFactory._services_lock:
+            KBServiceFactory._services_generation += 1
+            if kb_name is None:
+                KBServiceFactory._services.clear()
+            else:
+                KBServiceFactory._services.pop(name_key(kb_name), None)
+
+    @staticmethod
+    def cached_services() -> List[Tuple[str, str, str]]:
+        with KBServiceFactory._services_lock:
+            return [ident for ident, _ in KBServiceFactory._services.values()]
 
     @staticmethod
     def get_default():
@@ -526,3 +731,35 @@ def score_threshold_process(score_threshold, k, docs):
             if cmp(similarity, score_threshold)
         ]
     return docs[:k]
+
+
+if __name__ == "__main__":
+    # 单次检索中获取 KBService 的开销: 每次从数据库加载并创建实例 vs 使用缓存的实例
+    import sys
+    import time
+
+    kb_name = sys.argv[1] if len(sys.argv) > 1 else "samples"
+    n = 200
+    if KBServiceFactory.get_service_by_name(kb_name) is None:
+        sys.exit(f"知识库 {kb_name} 不存在")
+
+    start = time.perf_counter()
+    for _ in range(n):
+        KBServiceFactory.invalidate(kb_name)
+        KBServiceFactory.get_service_by_name(kb_name)
+    uncached = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    for _ in range(n):
+        KBServiceFactory.get_service_by_name(kb_name)
+    cached = (time.perf_counter() - start) / n
+
+    kb = KBServiceFactory.get_service_by_name(kb_name)
+    kb.search_docs("test")
+    start = time.perf_counter()
+    for _ in range(20):
+        kb.search_docs("test")
+    search = (time.perf_counter() - start) / 20
+
+    print(f"{kb_name} ({kb.vs_type()}): get_service_by_name uncached={uncached * 1000:.2f}ms "
+          f"cached={cached * 1000:.4f}ms  search_docs={search * 1000:.2f}ms")
@@ -51,6 +51,7 @@ class ChromaKBService(KBService):
     vs_path: str
     kb_path: str
     chroma: Chroma
+    supports_precomputed_embeddings = True
 
     client = None
 
@@ -101,10 +102,12 @@ class ChromaKBService(KBService):
 
     def do_add_doc(self, docs: List[Document], **kwargs) -> List[Dict]:
         doc_infos = []
-        embed_func = get_Embeddings(self.embed_model)
         texts = [doc.page_content for doc in docs]
         metadatas = [doc.metadata for doc in docs]
-        embeddings = embed_func.embed_documents(texts=texts)
+        embeddings = kwargs.get("embeddings")
+        if not embeddings:
+            embed_func = get_Embeddings(self.embed_model)
+            embeddings = embed_func.embed_documents(texts=texts)
         ids = [str(uuid.uuid1()) for _ in range(len(texts))]
         for _id, text, embedding, metadata in zip(ids, texts, embeddings, metadatas):
             self.chroma._collection.add(
@@ -1,5 +1,6 @@
 import os
 import shutil
+from contextlib import nullcontext
 from typing import Dict, List, Tuple
 
 from langchain.docstore.document import Document
@@ -10,6 +11,7 @@ from chatchat.server.knowledge_base.kb_cache.faiss_cache import (
     ThreadSafeFaiss,
     kb_faiss_pool,
 )
+from chatchat.server.knowledge_base.kb_cache.sqlite_docstore import SQLiteDocstore
 from chatchat.server.knowledge_base.kb_service.base import KBService, SupportedVSType
 from chatchat.server.knowledge_base.utils import KnowledgeFile, get_kb_path, get_vs_path
 
@@ -18,6 +20,7 @@ class FaissKBService(KBService):
     vs_path: str
     kb_path: str
     vector_name: str = None
+    supports_precomputed_embeddings = True
 
     def vs_type(self) -> str:
         return SupportedVSType.FAISS
@@ -36,15 +39,23 @@ class FaissKBService(KBService):
         )
 
     def save_vector_store(self):
-        self.load_vector_store().save(self.vs_path)
+        kb_faiss_pool.schedule_save(self.load_vector_store())
 
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
-        with self.load_vector_store().acquire() as vs:
+        with self.load_vector_store().acquire(shared=True) as vs:
+            if isinstance(vs.docstore, SQLiteDocstore):
+                return vs.docstore.mget(ids)
             return [vs.docstore._dict.get(id) for id in ids]
 
     def del_doc_by_ids(self, ids: List[str]) -> bool:
-        with self.load_vector_store().acquire() as vs:
-            vs.delete(ids)
+        cache = self.load_vector_store()
+        with cache.acquire() as vs:
+            ids = [id for id in ids if id in vs.docstore._dict]
+            if ids:
+                vs.delete(ids)
+                cache.docs_deleted(ids)
+                cache.mark_dirty()
+        return True
 
     def do_init(self):
         self.vector_name = self.vector_name or self.embed_model.replace(":", "_")
@@ -69,11 +80,13 @@ class FaissKBService(KBService):
         top_k: int,
         score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
     ) -> List[Tuple[Document, float]]:
-        with self.load_vector_store().acquire() as vs:
+        cache = self.load_vector_store()
+        with cache.acquire(shared=True) as vs:
             retriever = get_Retriever("ensemble").from_vectorstore(
                 vs,
                 top_k=top_k,
                 score_threshold=score_threshold,
+                bm25_index=cache.bm25,
             )
             docs = retriever.get_relevant_documents(query)
         return docs
@@ -85,37 +98,57 @@ class FaissKBService(KBService):
     ) -> List[Dict]:
         texts = [x.page_content for x in docs]
         metadatas = [x.metadata for x in docs]
-        with self.load_vector_store().acquire() as vs:
-            embeddings = vs.embeddings.embed_documents(texts)
+        cache = self.load_vector_store()
+        # 向量化耗时较长，在获取写锁之前完成，避免阻塞检索
+        embeddings = kwargs.get("embeddings") or cache.obj.embeddings.embed_documents(texts)
+        with cache.acquire() as vs:
             ids = vs.add_embeddings(
-                text_embeddings=zip(texts, embeddings), metadatas=metadatas
+                text_embeddings=zip(texts, embeddings),
+                metadatas=metadatas,
+                ids=kwargs.get("ids"),
             )
+            cache.docs_added(ids, docs)
             if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+                kb_faiss_pool.schedule_save(cache)
+            else:
+                cache.mark_dirty()
         doc_infos = [{"id": id, "metadata": doc.metadata} for id, doc in zip(ids, docs)]
         return doc_infos
 
     def do_delete_doc(self, kb_file: KnowledgeFile, **kwargs):
-        with self.load_vector_store().acquire() as vs:
-            ids = [
-                k
-                for k, v in vs.docstore._dict.items()
-                if v.metadata.get("source").lower() == kb_file.filename.lower()
-            ]
+        return self.do_delete_docs([kb_file], **kwargs)
+
+    def do_delete_docs(self, kb_files: List[KnowledgeFile], **kwargs):
+        cache = self.load_vector_store()
+        with cache.acquire() as vs:
+            ids = []
+            for kb_file in kb_files:
+                ids += cache.ids_by_source(kb_file.filename)
+            # 重复的 id 会使 docstore 删除时 KeyError，此时 index 已删除而 index_to_docstore_id 未更新，向量库损坏
+            ids = list(dict.fromkeys(ids))
             if len(ids) > 0:
                 vs.delete(ids)
+                cache.docs_deleted(ids)
             if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+                kb_faiss_pool.schedule_save(cache)
+            else:
+                cache.mark_dirty()
         return ids
 
     def do_clear_vs(self):
         with kb_faiss_pool.atomic:
-            kb_faiss_pool.pop((self.kb_name, self.vector_name))
-        try:
-            shutil.rmtree(self.vs_path)
-        except Exception:
-            ...
-        os.makedirs(self.vs_path, exist_ok=True)
+            cache = kb_faiss_pool.pop((self.kb_name, self.vector_name))
+        # 持有写锁删除目录：等待正在进行的保存完成，之后的保存直接跳过，不会在删除后重新写入旧版本
+        with cache.acquire(msg="清空") if cache else nullcontext():
+            if cache:
+                cache.discard()  # 向量库将被删除，无需再延迟保存
+                if isinstance(getattr(cache.obj, "docstore", None), SQLiteDocstore):
+                    cache.obj.docstore.close()
+            try:
+                shutil.rmtree(self.vs_path)
+            except Exception:
+                ...
+            os.makedirs(self.vs_path, exist_ok=True)
 
     def exist_doc(self, file_name: str):
         if super().exist_doc(file_name):
@@ -132,5 +165,9 @@ if __name__ == "__main__":
     faissService = FaissKBService("test")
     faissService.add_doc(KnowledgeFile("README.md", "test"))
     faissService.delete_doc(KnowledgeFile("README.md", "test"))
+    # 同一文件重复出现时只删除一次，向量库保持完整
+    faissService.add_doc(KnowledgeFile("README.md", "test"))
+    faissService.delete_docs([KnowledgeFile("README.md", "test"), KnowledgeFile("README.md", "test")])
+    assert not faissService.load_vector_store().ids_by_source("README.md")
     faissService.do_drop_kb()
     print(faissService.search_docs("如何启动api服务"))
@@ -50,9 +50,11 @@ class KBSummaryService(ABC):
         )
 
     def add_kb_summary(self, summary_combine_docs: List[Document]):
-        with self.load_vector_store().acquire() as vs:
+        cache = self.load_vector_store()
+        with cache.acquire() as vs:
             ids = vs.add_documents(documents=summary_combine_docs)
-            vs.save_local(self.vs_path)
+            cache.docs_added(ids, summary_combine_docs)
+            cache.save(self.vs_path)
 
         summary_infos = [
             {
@@ -1,4 +1,3 @@
-import asyncio
 import json
 from typing import List, Optional
 
@@ -6,6 +5,8 @@ from fastapi import Body
 from sse_starlette import EventSourceResponse
 
 from chatchat.settings import Settings
+from chatchat.server.knowledge_base.kb_executor import iterate_in_kb_executor
+from chatchat.server.knowledge_base.kb_jobs import kb_sync_write
 from chatchat.server.knowledge_base.kb_service.base import KBServiceFactory
 from chatchat.server.knowledge_base.kb_summary.base import KBSummaryService
 from chatchat.server.knowledge_base.kb_summary.summary_chunk import SummaryAdapter
@@ -45,7 +46,10 @@ def recreate_summary_vector_store(
         max_tokens = Settings.model_settings.MAX_TOKENS
 
     def output():
-        try:
+        with kb_sync_write(knowledge_base_name) as msg:
+            if msg:
+                yield json.dumps({"code": 409, "msg": msg}, ensure_ascii=False)
+                return
             kb = KBServiceFactory.get_service(knowledge_base_name, vs_type, embed_model)
             if not kb.exists() and not allow_empty_kb:
                 yield {"code": 404, "msg": f"未找到知识库 ‘{knowledge_base_name}’"}
@@ -109,11 +113,8 @@ def recreate_summary_vector_store(
                                 }
                             )
                         i += 1
-        except asyncio.exceptions.CancelledError:
-            logger.warning("streaming progress has been interrupted by user.")
-            return
 
-    return EventSourceResponse(output())
+    return EventSourceResponse(iterate_in_kb_executor("ingest", output()))
 
 
 def summary_file_to_vector_store(
@@ -144,7 +145,10 @@ def summary_file_to_vector_store(
     """
 
     def output():
-        try:
+        with kb_sync_write(knowledge_base_name) as msg:
+            if msg:
+                yield json.dumps({"code": 409, "msg": msg}, ensure_ascii=False)
+                return
             kb = KBServiceFactory.get_service(knowledge_base_name, vs_type, embed_model)
             if not kb.exists() and not allow_empty_kb:
                 yield {"code": 404, "msg": f"未找到知识库 ‘{knowledge_base_name}’"}
@@ -193,11 +197,8 @@ def summary_file_to_vector_store(
                             "msg": msg,
                         }
                     )
-        except asyncio.exceptions.CancelledError:
-            logger.warning("streaming progress has been interrupted by user.")
-            return
 
-    return EventSourceResponse(output())
+    return EventSourceResponse(iterate_in_kb_executor("ingest", output()))
 
 
 def summary_doc_ids_to_vector_store(
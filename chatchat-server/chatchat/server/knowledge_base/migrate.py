@@ -3,19 +3,29 @@ from datetime import datetime
 from typing import List, Literal
 
 from dateutil.parser import parse
+from sqlalchemy import inspect, select, text, update
 
 from chatchat.settings import Settings
 from chatchat.server.db.base import Base, engine
+from chatchat.server.db.models.base import name_key
+from chatchat.server.db.models.knowledge_base_model import KnowledgeBaseModel
+from chatchat.server.db.models.knowledge_file_model import (
+    FileDocModel,
+    KnowledgeFileModel,
+)
+from chatchat.server.db.repository.knowledge_file_repository import (
+    list_file_hashes_from_db,
+)
 
 # ensure Models are imported
 from chatchat.server.db.session import session_scope
+from chatchat.server.knowledge_base.kb_pipeline import IngestPipeline
 from chatchat.server.knowledge_base.kb_service.base import (
     KBServiceFactory,
     SupportedVSType,
 )
 from chatchat.server.knowledge_base.utils import (
     KnowledgeFile,
-    files2docs_in_thread,
     get_file_path,
     list_files_from_folder,
     list_kbs_from_folder,
@@ -29,6 +39,69 @@ logger = build_logger()
 
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    backfill_name_keys()
+    add_missing_indexes()
+
+
+def add_missing_columns():
+    """
+    create_all 不会修改已经存在的表，升级后为旧数据库补充新增的列（如 file_hash、chunk_hash）
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                sql = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                if column.default is not None and column.default.is_scalar:
+                    sql += f" DEFAULT {column.default.arg!r}"
+                conn.execute(text(sql))
+                logger.info(f"已为数据表 {table.name} 添加列 {column.name}")
+
+
+def backfill_name_keys():
+    """
+    为旧数据库中 kb_key、file_key 为空的记录补充规范化的名称。
+    SQLite 的 lower() 只转换 ASCII 字符，因此在 Python 中使用与查询时相同的 name_key 计算
+    """
+    targets = [
+        (KnowledgeBaseModel.__table__, [("kb_name", "kb_key")]),
+        (KnowledgeFileModel.__table__, [("kb_name", "kb_key"), ("file_name", "file_key")]),
+        (FileDocModel.__table__, [("kb_name", "kb_key"), ("file_name", "file_key")]),
+    ]
+    with engine.begin() as conn:
+        for table, columns in targets:
+            for name_column, key_column in columns:
+                name_column, key_column = table.c[name_column], table.c[key_column]
+                names = conn.execute(
+                    select(name_column).where(key_column.is_(None)).distinct()
+                ).scalars().all()
+                for name in names:
+                    if name is None:
+                        continue
+                    conn.execute(
+                        update(table)
+                        .where(name_column == name, key_column.is_(None))
+                        .values({key_column.name: name_key(name)})
+                    )
+                if names:
+                    logger.info(f"已为数据表 {table.name} 补充 {key_column.name} 列的数据")
+
+
+def add_missing_indexes():
+    """
+    create_all 不会为已经存在的表创建索引，升级后为旧数据库补充新增的索引
+    """
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
 
 
 def reset_tables():
@@ -94,12 +167,14 @@ def file_to_kbfile(kb_name: str, files: List[str]) -> List[KnowledgeFile]:
 
 def folder2db(
     kb_names: List[str],
-    mode: Literal["recreate_vs", "update_in_db", "increment"],
+    mode: Literal["recreate_vs", "update_in_db", "increment", "sync"],
     vs_type: Literal["faiss", "milvus", "pg", "chromadb"] = Settings.kb_settings.DEFAULT_VS_TYPE,
     embed_model: str = get_default_embedding(),
     chunk_size: int = Settings.kb_settings.CHUNK_SIZE,
     chunk_overlap: int = Settings.kb_settings.OVERLAP_SIZE,
     zh_title_enhance: bool = Settings.kb_settings.ZH_TITLE_ENHANCE,
+    parse_executor: Literal["thread", "process"] = None,
+    parse_workers: int = 0,
 ):
     """
     use existed files in local folder to populate database and/or vector store.
@@ -108,27 +183,34 @@ def folder2db(
         fill_info_only(disabled): do not create vector store, fill info to db using existed files only
         update_in_db: update vector store and database info using local files that existed in database only
         increment: create vector store and database info for local files that not existed in database only
+        sync: compare local files with database by content hash. unchanged files are skipped, changed files
+              only re-embed chunks whose content changed, renamed files reuse cached embeddings,
+              and files removed from local folder are deleted from vector store and database.
+    set `parse_executor` to "process" to parse files in `parse_workers` processes.
     """
 
-    def files2vs(kb_name: str, kb_files: List[KnowledgeFile]) -> List:
+    def files2vs(kb_name: str, kb_files: List[KnowledgeFile], update: bool = False) -> List:
         result = []
-        for success, res in files2docs_in_thread(
-            kb_files,
+        pipeline = IngestPipeline(
+            kb,
+            update=update,
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
             zh_title_enhance=zh_title_enhance,
-        ):
+            parse_executor=parse_executor,
+            parse_workers=parse_workers,
+        )
+        for success, res in pipeline.run(kb_files):
             if success:
                 _, filename, docs = res
                 print(
-                    f"正在将 {kb_name}/{filename} 添加到向量库，共包含{len(docs)}条文档"
+                    f"已将 {kb_name}/{filename} 添加到向量库，共包含{len(docs)}条文档"
                 )
-                kb_file = KnowledgeFile(filename=filename, knowledge_base_name=kb_name)
-                kb_file.splited_docs = docs
-                kb.add_doc(kb_file=kb_file, not_refresh_vs_cache=True)
                 result.append({"kb_name": kb_name, "file": filename, "docs": docs})
             else:
                 print(res)
+        for name, stage in pipeline.stats()["stages"].items():
+            print(f"{name}\t：{stage}")
         return result
 
     kb_names = kb_names or list_kbs_from_folder()
@@ -157,7 +239,7 @@ def folder2db(
         elif mode == "update_in_db":
             files = kb.list_files()
             kb_files = file_to_kbfile(kb_name, files)
-            result = files2vs(kb_name, kb_files)
+            result = files2vs(kb_name, kb_files, update=True)
             kb.save_vector_store()
         # 对比本地目录与数据库中的文件列表，进行增量向量化
         elif mode == "increment":
@@ -167,6 +249,34 @@ def folder2db(
             kb_files = file_to_kbfile(kb_name, files)
             result = files2vs(kb_name, kb_files)
             kb.save_vector_store()
+        # 按文件内容哈希对比本地目录与数据库，只处理新增、修改、重命名和删除的文件
+        elif mode == "sync":
+            db_hashes = list_file_hashes_from_db(kb_name)
+            kb_files = file_to_kbfile(kb_name, list_files_from_folder(kb_name))
+            folder_hashes = {}
+            for kb_file in kb_files:
+                try:
+                    folder_hashes[kb_file.filename] = kb_file.get_hash()
+                except Exception as e:
+                    logger.error(f"计算文件 {kb_name}/{kb_file.filename} 哈希时出错：{e}")
+            new_files = [f for f in kb_files if f.filename not in db_hashes]
+            changed_files = [
+                f for f in kb_files
+                if f.filename in db_hashes and db_hashes[f.filename] != folder_hashes.get(f.filename)
+            ]
+            vanished = {name: h for name, h in db_hashes.items() if name not in folder_hashes}
+            # 新文件的内容与已删除的文件相同时视为重命名，其文本块直接命中嵌入向量缓存
+            vanished_hashes = set(h for h in vanished.values() if h)
+            renamed = [f.filename for f in new_files if folder_hashes.get(f.filename) in vanished_hashes]
+            print(
+                f"{kb_name}：新增 {len(new_files) - len(renamed)} 个文件，修改 {len(changed_files)} 个，"
+                f"重命名 {len(renamed)} 个，删除 {len(vanished) - len(renamed)} 个，"
+                f"未变化 {len(kb_files) - len(new_files) - len(changed_files)} 个"
+            )
+            if vanished:
+                kb.delete_docs(file_to_kbfile(kb_name, list(vanished)), not_refresh_vs_cache=True)
+            result = files2vs(kb_name, new_files) + files2vs(kb_name, changed_files, update=True)
+            kb.save_vector_store()
         else:
             print(f"unsupported migrate mode: {mode}")
         end = datetime.now()
@@ -208,8 +318,8 @@ def prune_db_docs(kb_names: List[str]):
             files_in_folder = list_files_from_folder(kb_name)
             files = list(set(files_in_db) - set(files_in_folder))
             kb_files = file_to_kbfile(kb_name, files)
+            kb.delete_docs(kb_files, not_refresh_vs_cache=True)
             for kb_file in kb_files:
-                kb.delete_doc(kb_file, not_refresh_vs_cache=True)
                 print(f"success to delete docs for file: {kb_name}/{kb_file.filename}")
             kb.save_vector_store()
 
@@ -228,3 +338,48 @@ def prune_folder_files(kb_names: List[str]):
             for file in files:
                 os.remove(get_file_path(kb_name, file))
                 print(f"success to delete file: {kb_name}/{file}")
+
+
+def convert_faiss_docstore(
+    kb_names: List[str],
+    docstore: Literal["sqlite", "memory"] = "sqlite",
+):
+    """
+    转换已有 FAISS 向量库的 docstore 类型，无需重新向量化：
+        sqlite: 将 index.pkl 中的 InMemoryDocstore 转换为向量库目录下的 docstore.db
+        memory: 将 docstore.db 转换回 InMemoryDocstore
+    """
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    from chatchat.server.knowledge_base.kb_cache.sqlite_docstore import (
+        SQLITE_DOCSTORE_FILE,
+        SQLiteDocstore,
+    )
+
+    kb_names = kb_names or list_kbs_from_folder()
+    for kb_name in kb_names:
+        kb = KBServiceFactory.get_service_by_name(kb_name)
+        if kb is None or kb.vs_type() != SupportedVSType.FAISS:
+            print(f"知识库 {kb_name} 不存在或不是 FAISS 知识库，已跳过")
+            continue
+        cache = kb.load_vector_store()
+        with cache.acquire(msg="转换 docstore") as vs:
+            if docstore == "sqlite" and isinstance(vs.docstore, InMemoryDocstore):
+                new_docstore = SQLiteDocstore(kb.vs_path)
+                new_docstore.delete(new_docstore.ids())  # 清除之前转换失败留下的数据
+                new_docstore.add(vs.docstore._dict)
+                vs.docstore = new_docstore
+            elif docstore == "memory" and isinstance(vs.docstore, SQLiteDocstore):
+                old_docstore = vs.docstore
+                vs.docstore = InMemoryDocstore(dict(old_docstore.iter_documents()))
+                old_docstore.close()
+            else:
+                print(f"知识库 {kb_name} 的 docstore 已经是 {docstore}，已跳过")
+                continue
+            cache.save(kb.vs_path)
+        if docstore == "memory":
+            for suffix in ["", "-wal", "-shm"]:
+                file = os.path.join(kb.vs_path, SQLITE_DOCSTORE_FILE + suffix)
+                if os.path.isfile(file):
+                    os.remove(file)
+        print(f"已将知识库 {kb_name} 的 docstore 转换为 {docstore}，共 {cache.docs_count()} 条文档")
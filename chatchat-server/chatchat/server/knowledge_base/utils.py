@@ -1,9 +1,20 @@
+import hashlib
 import importlib
 import json
+import multiprocessing as mp
 import os
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
 from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Generator, List, Tuple, Union
+from typing import Callable, Dict, Generator, List, Literal, Tuple, Union
 
 import chardet
 import langchain_community.document_loaders
@@ -15,7 +26,6 @@ from chatchat.settings import Settings
 from chatchat.server.file_rag.text_splitter import (
     zh_title_enhance as func_zh_title_enhance,
 )
-from chatchat.server.utils import run_in_thread_pool
 from chatchat.utils import build_logger
 
 
@@ -56,6 +66,15 @@ def list_kbs_from_folder():
     ]
 
 
+def get_file_hash(file_path: str) -> str:
+    """分块读取文件并计算 sha256"""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
 def list_files_from_folder(kb_name: str):
     doc_path = get_doc_path(kb_name)
     result = []
@@ -398,6 +417,10 @@ class KnowledgeFile:
     def get_size(self):
         return os.path.getsize(self.filepath)
 
+    def get_hash(self) -> str:
+        """文件内容的 sha256，用于判断文件内容是否变化或被重命名"""
+        return get_file_hash(self.filepath)
+
 
 def files2docs_in_thread_file2docs(
     *, file: KnowledgeFile, **kwargs
@@ -410,18 +433,163 @@ def files2docs_in_thread_file2docs(
         return False, (file.kb_name, file.filename, msg)
 
 
+def files2docs_in_process(
+    kb_name: str,
+    filename: str,
+    loader_kwargs: Dict,
+    text_splitter_name: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    zh_title_enhance: bool,
+) -> Tuple[bool, Tuple[str, str, List[Document]]]:
+    """
+    在子进程中加载并切分文件。只传递文件名和参数，分词器在子进程中创建并由 make_text_splitter 缓存，
+    子进程常驻，后续任务可以复用已加载的分词器、OCR 模型等。
+    """
+    try:
+        file = KnowledgeFile(
+            filename=filename, knowledge_base_name=kb_name, loader_kwargs=loader_kwargs
+        )
+    except Exception as e:
+        return False, (kb_name, filename, str(e))
+    text_splitter = make_text_splitter(
+        splitter_name=text_splitter_name,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+    return files2docs_in_thread_file2docs(
+        file=file,
+        text_splitter=text_splitter,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        zh_title_enhance=zh_title_enhance,
+    )
+
+
+PARSE_WORKER_ENV = "CHATCHAT_PARSE_WORKER"
+
+
+def _init_parse_worker():
+    # 文件已经按进程并行解析，标记后加载器不再在子进程中创建进程池（如 PDF 按页并行）
+    os.environ[PARSE_WORKER_ENV] = "1"
+
+
+_parse_process_pool: ProcessPoolExecutor = None
+_parse_process_pool_workers: int = 0
+_parse_process_pool_lock = threading.Lock()
+
+
+def get_parse_process_pool(max_workers: int = 0) -> ProcessPoolExecutor:
+    """
+    获取用于解析文件的进程池。进程池在多次调用间复用，worker 数量变化时重新创建。
+    使用 spawn 方式创建子进程，避免 fork 时复制线程锁等状态。
+    """
+    global _parse_process_pool, _parse_process_pool_workers
+    max_workers = max_workers or Settings.kb_settings.FILE_PARSE_WORKERS or os.cpu_count() or 1
+    with _parse_process_pool_lock:
+        if _parse_process_pool is None or _parse_process_pool_workers != max_workers:
+            if _parse_process_pool is not None:
+                _parse_process_pool.shutdown(wait=False)
+            _parse_process_pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_init_parse_worker,
+            )
+            _parse_process_pool_workers = max_workers
+        return _parse_process_pool
+
+
+def reset_parse_process_pool(pool: ProcessPoolExecutor):
+    """
+    子进程异常退出（如 OCR 崩溃、被 OOM kill）后进程池不可再用，丢弃后下次使用时重新创建
+    """
+    global _parse_process_pool
+    with _parse_process_pool_lock:
+        if _parse_process_pool is not pool:
+            return
+        _parse_process_pool = None
+    pool.shutdown(wait=False)
+    logger.warning("文件解析进程池已损坏，将重新创建")
+
+
+def _run_bounded(
+    get_pool: Callable[[], Executor],
+    func: Callable,
+    params: List[Dict],
+    on_error: Callable[[Dict, Exception], Tuple],
+    max_pending: int = 0,
+) -> Generator:
+    """
+    将任务提交到 get_pool() 返回的 pool 并按完成顺序返回结果。
+    任务抛出异常时返回 on_error(kwargs, error)，调用方可以据此记录失败的文件；进程池损坏时重新获取进程池。
+    max_pending > 0 时，已提交但结果尚未被取走的任务不超过 max_pending 个，
+    调用方消费变慢时不再提交新任务，从而向上游传递背压。
+    """
+    params = iter(params)
+    pending = {}
+    failed = []
+
+    def submit_next() -> bool:
+        kwargs = next(params, None)
+        if kwargs is None:
+            return False
+        pool = get_pool()
+        try:
+            task = pool.submit(func, **kwargs)
+        except BrokenProcessPool:
+            reset_parse_process_pool(pool)
+            try:
+                task = get_pool().submit(func, **kwargs)
+            except Exception as e:
+                failed.append(on_error(kwargs, e))
+                return True
+        except Exception as e:
+            failed.append(on_error(kwargs, e))
+            return True
+        pending[task] = (pool, kwargs)
+        return True
+
+    while (max_pending <= 0 or len(pending) + len(failed) < max_pending) and submit_next():
+        pass
+    while pending or failed:
+        while failed:
+            yield failed.pop(0)
+            submit_next()
+        if not pending:
+            continue
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for task in done:
+            pool, kwargs = pending.pop(task)
+            try:
+                result = task.result()
+            except Exception as e:
+                logger.exception(f"error in sub task: {e}")
+                if isinstance(e, BrokenProcessPool):
+                    reset_parse_process_pool(pool)
+                result = on_error(kwargs, e)
+            yield result
+            submit_next()
+
+
 def files2docs_in_thread(
     files: List[Union[KnowledgeFile, Tuple[str, str], Dict]],
     text_splitter_name: str = Settings.kb_settings.TEXT_SPLITTER_NAME,
     chunk_size: int = Settings.kb_settings.CHUNK_SIZE,
     chunk_overlap: int = Settings.kb_settings.OVERLAP_SIZE,
     zh_title_enhance: bool = Settings.kb_settings.ZH_TITLE_ENHANCE,
+    executor: Literal["thread", "process"] = None,
+    max_workers: int = 0,
+    max_pending: int = 0,
 ) -> Generator:
     """
-    利用多线程批量将磁盘文件转化成langchain Document.
+    利用多线程或多进程批量将磁盘文件转化成langchain Document.
     如果传入参数是Tuple，形式为(filename, kb_name)
+    executor 为 None 时使用配置项 FILE_PARSE_EXECUTOR。文档解析、OCR 等以 CPU 计算为主，
+    使用多进程（process）可以利用多核；文件较少或解析较轻时多线程（thread）开销更小。
+    max_pending > 0 时，正在解析及解析完成但尚未被取走的文件不超过 max_pending 个。
     生成器返回值为 status, (kb_name, file_name, docs | error)
     """
+    executor = executor or Settings.kb_settings.FILE_PARSE_EXECUTOR
     kwargs_list = []
     for i, file in enumerate(files):
         kwargs = {}
@@ -436,23 +604,55 @@ def files2docs_in_thread(
                 kwargs.update(file)
                 file = KnowledgeFile(filename=filename, knowledge_base_name=kb_name)
             kwargs["file"] = file
-            text_splitter = make_text_splitter(
-                splitter_name=text_splitter_name,
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-            )
-            kwargs["text_splitter"] = text_splitter
             kwargs["chunk_size"] = chunk_size
             kwargs["chunk_overlap"] = chunk_overlap
             kwargs["zh_title_enhance"] = zh_title_enhance
+            if executor != "process":
+                kwargs["text_splitter"] = make_text_splitter(
+                    splitter_name=text_splitter_name,
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                )
             kwargs_list.append(kwargs)
         except Exception as e:
             yield False, (kb_name, filename, str(e))
 
-    for result in run_in_thread_pool(
-        func=files2docs_in_thread_file2docs, params=kwargs_list
-    ):
-        yield result
+    if executor == "process":
+        params = []
+        for kwargs in kwargs_list:
+            file = kwargs.pop("file")
+            kwargs.pop("refresh", None)
+            params.append(dict(
+                kb_name=file.kb_name,
+                filename=file.filename,
+                loader_kwargs=file.loader_kwargs,
+                text_splitter_name=text_splitter_name,
+                **kwargs,
+            ))
+        yield from _run_bounded(
+            lambda: get_parse_process_pool(max_workers),
+            files2docs_in_process,
+            params,
+            lambda kwargs, e: (False, (
+                kwargs["kb_name"],
+                kwargs["filename"],
+                f"从文件 {kwargs['kb_name']}/{kwargs['filename']} 加载文档时出错：{e.__class__.__name__}: {e}",
+            )),
+            max_pending,
+        )
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers or None) as pool:
+            yield from _run_bounded(
+                lambda: pool,
+                files2docs_in_thread_file2docs,
+                kwargs_list,
+                lambda kwargs, e: (False, (
+                    kwargs["file"].kb_name,
+                    kwargs["file"].filename,
+                    f"从文件 {kwargs['file'].kb_name}/{kwargs['file'].filename} 加载文档时出错：{e.__class__.__name__}: {e}",
+                )),
+                max_pending,
+            )
 
 
 # def format_reference_kb(kb_name: str, docs: List[Dict], api_base_url: str="") -> List[Dict]:
@@ -509,14 +709,14 @@ def files2docs_in_thread(
 
 
 if __name__ == "__main__":
-    # from pprint import pprint
-    kb_file = KnowledgeFile(
-        filename="E:\\LLM\\Data\\Test.md", knowledge_base_name="samples"
-    )
-    # kb_file.text_splitter_name = "RecursiveCharacterTextSplitter"
-    kb_file.text_splitter_name = "MarkdownHeaderTextSplitter"
-    docs = kb_file.file2docs()
-    # pprint(docs[-1])
-    texts = kb_file.docs2texts(docs)
-    for text in texts:
-        print(text)
+    # 解析吞吐量压测：使用 samples 知识库中的文件，对比多线程与不同进程数下的耗时
+    import time
+
+    files = [(f, "samples") for f in list_files_from_folder("samples")]
+    print(f"共 {len(files)} 个文件")
+    for executor, workers in [("thread", 0), ("process", 1), ("process", 2), ("process", 4), ("process", 8)]:
+        start = time.time()
+        results = list(files2docs_in_thread(files, executor=executor, max_workers=workers))
+        cost = time.time() - start
+        docs = sum(len(r[1][2]) for r in results if r[0])
+        print(f"{executor:<7} workers={workers}: {cost:.1f}s, {len(files) / cost:.2f} files/s, {docs} docs")
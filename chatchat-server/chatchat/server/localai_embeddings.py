@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+import os
+import threading
 import warnings
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import (
     Any,
     Callable,
@@ -28,10 +32,27 @@ from tenacity import (
     wait_exponential,
 )
 
-from chatchat.server.utils import run_in_thread_pool
-
 logger = logging.getLogger(__name__)
 
+_embed_executor: Optional[ThreadPoolExecutor] = None
+_embed_executor_lock = threading.Lock()
+
+
+def _get_embed_executor() -> ThreadPoolExecutor:
+    """
+    shared thread pool for batch embedding requests, so that concurrent callers
+    are bounded together instead of creating a new pool for every call.
+    """
+    global _embed_executor
+    if _embed_executor is None:
+        with _embed_executor_lock:
+            if _embed_executor is None:
+                _embed_executor = ThreadPoolExecutor(
+                    max_workers=min(32, (os.cpu_count() or 1) + 4),
+                    thread_name_prefix="localai_embeddings",
+                )
+    return _embed_executor
+
 
 def _create_retry_decorator(embeddings: LocalAIEmbeddings) -> Callable[[Any], Any]:
     import openai
@@ -87,6 +108,20 @@ def _async_retry_decorator(embeddings: LocalAIEmbeddings) -> Any:
     return wrap
 
 
+def _is_input_error(error: Exception) -> bool:
+    """Whether the error is caused by the input texts (e.g. a text is too long).
+
+    Only such errors may succeed after splitting the batch. Connection errors,
+    timeouts and server errors would fail again for every half, so they are
+    raised immediately instead.
+    """
+    import openai
+
+    if isinstance(error, openai.BadRequestError):
+        return True
+    return getattr(error, "status_code", None) in (400, 413, 422)
+
+
 # https://stackoverflow.com/questions/76469415/getting-embeddings-of-length-1-from-langchain-openaiembeddings
 def _check_response(response: dict) -> dict:
     if any([len(d.embedding) == 1 for d in response.data]):
@@ -154,8 +189,10 @@ class LocalAIEmbeddings(BaseModel, Embeddings):
     openai_organization: Optional[str] = Field(default=None, alias="organization")
     allowed_special: Union[Literal["all"], Set[str]] = set()
     disallowed_special: Union[Literal["all"], Set[str], Sequence[str]] = "all"
-    chunk_size: int = 1000
+    chunk_size: int = 64
     """Maximum number of texts to embed in each batch"""
+    max_concurrency: int = 4
+    """Maximum number of batch requests in flight for one embed_documents call"""
     max_retries: int = 3
     """Maximum number of retries to make when generating."""
     request_timeout: Union[float, Tuple[float, float], Any, None] = Field(
@@ -277,47 +314,81 @@ class LocalAIEmbeddings(BaseModel, Embeddings):
             }  # type: ignore[assignment]  # noqa: E501
         return openai_args
 
-    def _embedding_func(self, text: str, *, engine: str) -> List[float]:
-        """Call out to LocalAI's embedding endpoint."""
+    def _prepare_text(self, text: str) -> str:
         # handle large input text
         if self.model.endswith("001"):
             # See: https://github.com/openai/openai-python/issues/418#issuecomment-1525939500
             # replace newlines, which can negatively affect performance.
             text = text.replace("\n", " ")
-        return (
-            embed_with_retry(
+        return text
+
+    @staticmethod
+    def _response_to_embeddings(response: Any) -> List[List[float]]:
+        # keep the order of input texts, servers may return data out of order
+        data = list(response.data)
+        if all(getattr(d, "index", None) is not None for d in data):
+            data.sort(key=lambda d: d.index)
+        return [d.embedding for d in data]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Call out to LocalAI's embedding endpoint with a batch of texts.
+
+        If the batch is rejected because of its input, it is split in halves and
+        retried, so that one bad text does not fail the whole batch. Other errors
+        are raised as is.
+        """
+        try:
+            response = embed_with_retry(
                 self,
-                input=[text],
+                input=[self._prepare_text(text) for text in texts],
                 **self._invocation_params,
             )
-            .data[0]
-            .embedding
-        )
+            return self._response_to_embeddings(response)
+        except Exception as e:
+            if len(texts) <= 1 or not _is_input_error(e):
+                raise
+            logger.warning(
+                f"failed to embed a batch of {len(texts)} texts: {e}, retrying in halves."
+            )
+            mid = len(texts) // 2
+            return self._embed_batch(texts[:mid]) + self._embed_batch(texts[mid:])
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Async version of _embed_batch."""
+        try:
+            response = await async_embed_with_retry(
+                self,
+                input=[self._prepare_text(text) for text in texts],
+                **self._invocation_params,
+            )
+            return self._response_to_embeddings(response)
+        except Exception as e:
+            if len(texts) <= 1 or not _is_input_error(e):
+                raise
+            logger.warning(
+                f"failed to embed a batch of {len(texts)} texts: {e}, retrying in halves."
+            )
+            mid = len(texts) // 2
+            return (await self._aembed_batch(texts[:mid])) + (
+                await self._aembed_batch(texts[mid:])
+            )
+
+    def _embedding_func(self, text: str, *, engine: str) -> List[float]:
+        """Call out to LocalAI's embedding endpoint."""
+        return self._embed_batch([text])[0]
 
     async def _aembedding_func(self, text: str, *, engine: str) -> List[float]:
         """Call out to LocalAI's embedding endpoint."""
-        # handle large input text
-        if self.model.endswith("001"):
-            # See: https://github.com/openai/openai-python/issues/418#issuecomment-1525939500
-            # replace newlines, which can negatively affect performance.
-            text = text.replace("\n", " ")
-        return (
-            (
-                await async_embed_with_retry(
-                    self,
-                    input=[text],
-                    **self._invocation_params,
-                )
-            )
-            .data[0]
-            .embedding
-        )
+        return (await self._aembed_batch([text]))[0]
 
     def embed_documents(
         self, texts: List[str], chunk_size: Optional[int] = 0
     ) -> List[List[float]]:
         """Call out to LocalAI's embedding endpoint for embedding search docs.
 
+        Texts are sent in batches of `chunk_size`, at most `max_concurrency`
+        batches are in flight at the same time.
+
         Args:
             texts: The list of texts to embed.
             chunk_size: The chunk size of embeddings. If None, will use the chunk size
@@ -326,15 +397,23 @@ class LocalAIEmbeddings(BaseModel, Embeddings):
         Returns:
             List of embeddings, one for each text.
         """
-
-        # call _embedding_func for each text with multithreads
-        def task(seq, text):
-            return (seq, self._embedding_func(text, engine=self.deployment))
-
-        params = [{"seq": i, "text": text} for i, text in enumerate(texts)]
-        result = list(run_in_thread_pool(func=task, params=params))
-        result = sorted(result, key=lambda x: x[0])
-        return [x[1] for x in result]
+        chunk_size = chunk_size or self.chunk_size
+        batches = [texts[i: i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        if len(batches) <= 1:
+            return self._embed_batch(batches[0]) if batches else []
+
+        executor = _get_embed_executor()
+        results: List[Optional[List[List[float]]]] = [None] * len(batches)
+        pending = {}
+        for i, batch in enumerate(batches):
+            if len(pending) >= max(self.max_concurrency, 1):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+            pending[executor.submit(self._embed_batch, batch)] = i
+        for future, i in pending.items():
+            results[i] = future.result()
+        return [embedding for batch in results for embedding in batch]
 
     async def aembed_documents(
         self, texts: List[str], chunk_size: Optional[int] = 0
@@ -349,11 +428,16 @@ class LocalAIEmbeddings(BaseModel, Embeddings):
         Returns:
             List of embeddings, one for each text.
         """
-        embeddings = []
-        for text in texts:
-            response = await self._aembedding_func(text, engine=self.deployment)
-            embeddings.append(response)
-        return embeddings
+        chunk_size = chunk_size or self.chunk_size
+        batches = [texts[i: i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        semaphore = asyncio.Semaphore(max(self.max_concurrency, 1))
+
+        async def task(batch: List[str]) -> List[List[float]]:
+            async with semaphore:
+                return await self._aembed_batch(batch)
+
+        results = await asyncio.gather(*[task(batch) for batch in batches])
+        return [embedding for batch in results for embedding in batch]
 
     def embed_query(self, text: str) -> List[float]:
         """Call out to LocalAI's embedding endpoint for embedding query text.
@@ -378,3 +462,61 @@ class LocalAIEmbeddings(BaseModel, Embeddings):
         """
         embedding = await self._aembedding_func(text, engine=self.deployment)
         return embedding
+
+
+if __name__ == "__main__":
+    # 简单压测：启动一个模拟 OpenAI 兼容接口的本地服务，对比逐条请求与批量并发请求的耗时
+    import json
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    LATENCY = 0.02  # 模拟每次请求的网络及推理延迟
+    request_count = 0
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            global request_count
+            request_count += 1
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            time.sleep(LATENCY)
+            data = [
+                {"object": "embedding", "index": i, "embedding": [float(len(t)), 1.0, 0.5]}
+                for i, t in enumerate(inputs)
+            ]
+            resp = json.dumps(
+                {"object": "list", "data": data, "model": body["model"],
+                 "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(resp)))
+            self.end_headers()
+            self.wfile.write(resp)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    texts = [f"text {i} " * (i % 10 + 1) for i in range(1000)]
+
+    for chunk_size, max_concurrency in [(1, 1), (64, 1), (64, 4)]:
+        request_count = 0
+        embeddings = LocalAIEmbeddings(
+            model="stub", openai_api_base=base_url, openai_api_key="EMPTY",
+            chunk_size=chunk_size, max_concurrency=max_concurrency,
+        )
+        start = time.time()
+        result = embeddings.embed_documents(texts)
+        assert [r[0] for r in result] == [float(len(t)) for t in texts]
+        print(f"chunk_size={chunk_size:<3} max_concurrency={max_concurrency}: "
+              f"{time.time() - start:.2f}s, {request_count} requests")
+
+        request_count = 0
+        start = time.time()
+        result = asyncio.run(embeddings.aembed_documents(texts))
+        assert [r[0] for r in result] == [float(len(t)) for t in texts]
+        print(f"  async: {time.time() - start:.2f}s, {request_count} requests")
+    server.shutdown()
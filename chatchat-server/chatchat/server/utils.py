@@ -1,9 +1,12 @@
 import os
+import threading
+import time
 import requests
 import httpx
 import openai
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from types import MappingProxyType
 from pydantic import BaseModel, Field
 from urllib.parse import urlparse
 from typing import (
@@ -13,6 +16,7 @@ from typing import (
     Generator,
     List,
     Literal,
+    Mapping,
     Optional,
     Tuple,
     Union,
@@ -27,6 +31,7 @@ from langgraph.checkpoint.memory import MemorySaver
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from memoization import cached, CachingAlgorithmFlag
 
+from chatchat.pydantic_settings_file import settings_version
 from chatchat.settings import Settings, XF_MODELS_TYPES
 from chatchat.utils import build_logger
 
@@ -94,6 +99,25 @@ def detect_xf_models(xf_url: str) -> Dict[str, List[str]]:
     return models
 
 
+def _model_settings_version() -> Tuple:
+    """
+    模型配置的版本：model_settings.yaml 修改后改变。
+    有平台开启 auto_detect_model 时加入以分钟计的时间，与 detect_xf_models 的缓存同步失效，以发现新部署的模型
+    """
+    version = settings_version(Settings.model_settings)
+    if any(p.auto_detect_model for p in Settings.model_settings.MODEL_PLATFORMS):
+        version += (int(time.time() // 60),)
+    return version
+
+
+def _config_models_key(
+        model_name: str = None,
+        model_type: str = None,
+        platform_name: str = None,
+) -> Tuple:
+    return model_name, model_type, platform_name, _model_settings_version()
+
+
 def get_config_models(
         model_name: str = None,
         model_type: Optional[Literal[
@@ -112,7 +136,18 @@ def get_config_models(
         "api_key": xx,
         "api_proxy": xx,
     }}
+    结果按模型配置版本缓存，返回副本，调用方可以修改
     """
+    result = _get_config_models(model_name=model_name, model_type=model_type, platform_name=platform_name)
+    return {k: v.copy() for k, v in result.items()}
+
+
+@cached(max_size=256, algorithm=CachingAlgorithmFlag.LRU, thread_safe=True, custom_key_maker=_config_models_key)
+def _get_config_models(
+        model_name: str = None,
+        model_type: str = None,
+        platform_name: str = None,
+) -> Dict[str, Dict]:
     result = {}
     if model_type is None:
         model_types = [
@@ -181,6 +216,11 @@ def get_model_info(
         return {}
 
 
+def _default_model_key() -> Tuple:
+    return _model_settings_version()
+
+
+@cached(max_size=1, algorithm=CachingAlgorithmFlag.LRU, thread_safe=True, custom_key_maker=_default_model_key)
 def get_default_llm():
     available_llms = list(get_config_models(model_type="llm").keys())
     if Settings.model_settings.DEFAULT_LLM_MODEL in available_llms:
@@ -193,6 +233,7 @@ def get_default_llm():
         logger.error("can not find an available llm model")
 
 
+@cached(max_size=1, algorithm=CachingAlgorithmFlag.LRU, thread_safe=True, custom_key_maker=_default_model_key)
 def get_default_embedding():
     available_embeddings = list(get_config_models(model_type="embed").keys())
     if Settings.model_settings.DEFAULT_EMBEDDING_MODEL in available_embeddings:
@@ -263,6 +304,12 @@ def get_Embeddings(
     from langchain_community.embeddings import OllamaEmbeddings
     from langchain_openai import OpenAIEmbeddings
 
+    from chatchat.server.embedding_cache import (
+        CachedEmbeddings,
+        embedding_model_key,
+        get_embedding_store,
+        get_query_embedding_cache,
+    )
     from chatchat.server.localai_embeddings import (
         LocalAIEmbeddings,
     )
@@ -283,31 +330,158 @@ def get_Embeddings(
                 openai_proxy=model_info.get("api_proxy"),
             )
         if model_info.get("platform_type") == "openai":
-            return OpenAIEmbeddings(**params)
+            embeddings = OpenAIEmbeddings(**params)
         elif model_info.get("platform_type") == "ollama":
-            return OllamaEmbeddings(
+            embeddings = OllamaEmbeddings(
                 base_url=model_info.get("api_base_url").replace("/v1", ""),
                 model=embed_model,
             )
         else:
-            return LocalAIEmbeddings(**params)
+            embeddings = LocalAIEmbeddings(**params)
+        store = get_embedding_store()
+        query_cache = get_query_embedding_cache()
+        if store is not None or query_cache is not None:
+            model_key = embedding_model_key(
+                embed_model,
+                platform_name=model_info.get("platform_name"),
+                api_base_url=params.get("openai_api_base"),
+            )
+            embeddings = CachedEmbeddings(
+                embeddings,
+                embed_model=embed_model,
+                store=store,
+                query_cache=query_cache,
+                model_key=model_key,
+            )
+        return embeddings
     except Exception as e:
         logger.exception(f"failed to create Embeddings for model: {embed_model}.")
 
 
-def check_embed_model(embed_model: str = None) -> Tuple[bool, str]:
+class EmbedModelHealthRegistry:
+    """
+    嵌入模型可用性状态表，按模型名称缓存检查结果，避免每次检索/入库都发起一次测试请求：
+    - 检查成功的结果在 EMBED_MODEL_HEALTH_TTL 内直接复用，过期后先返回缓存结果并在后台刷新
+    - 检查失败后在 EMBED_MODEL_HEALTH_COOLDOWN 内直接判定为不可用（熔断）
+    - 实际调用嵌入模型失败时通过 report_failure 将模型标记为不可用，下次检查时重新探测
+    """
+
+    def __init__(self):
+        self._states: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _probe(embed_model: str) -> Tuple[bool, str]:
+        try:
+            from chatchat.server.embedding_cache import CachedEmbeddings
+
+            embeddings = get_Embeddings(embed_model=embed_model)
+            if isinstance(embeddings, CachedEmbeddings):  # 探测时绕过查询向量缓存
+                embeddings = embeddings.embeddings
+            embeddings.embed_query("this is a test")
+            return True, ""
+        except Exception as e:
+            msg = f"failed to access embed model '{embed_model}': {e}"
+            logger.error(msg)
+            return False, msg
+
+    def _update(self, embed_model: str, ok: bool, msg: str = ""):
+        with self._lock:
+            state = self._states.setdefault(embed_model, {"failures": 0})
+            state.update(
+                healthy=ok,
+                msg=msg,
+                checked_at=time.time(),
+                refreshing=False,
+                failures=0 if ok else state["failures"] + 1,
+            )
+
+    def _refresh_in_background(self, embed_model: str):
+        def task():
+            ok, msg = self._probe(embed_model)
+            self._update(embed_model, ok, msg)
+
+        threading.Thread(target=task, daemon=True).start()
+
+    def check(self, embed_model: str, use_cache: bool = True) -> Tuple[bool, str]:
+        ttl = Settings.model_settings.EMBED_MODEL_HEALTH_TTL
+        cooldown = Settings.model_settings.EMBED_MODEL_HEALTH_COOLDOWN
+        now = time.time()
+        with self._lock:
+            state = self._states.get(embed_model)
+            if use_cache and state is not None:
+                age = now - state["checked_at"]
+                if state["healthy"]:
+                    if age > ttl and not state["refreshing"]:
+                        state["refreshing"] = True
+                        self._refresh_in_background(embed_model)
+                    return True, ""
+                elif age < cooldown:
+                    return False, state["msg"]
+
+        ok, msg = self._probe(embed_model)
+        self._update(embed_model, ok, msg)
+        return ok, msg
+
+    def report_success(self, embed_model: str):
+        self._update(embed_model, True)
+
+    @staticmethod
+    def is_embed_error(error: BaseException) -> bool:
+        """
+        是否为请求嵌入模型时的错误（连接失败、超时、接口返回错误等）。
+        向量库、数据库等其它错误不代表嵌入模型不可用
+        """
+        while error is not None:
+            if isinstance(
+                error,
+                (openai.APIError, httpx.HTTPError, requests.RequestException, ConnectionError, TimeoutError),
+            ):
+                return True
+            error = error.__cause__ or error.__context__
+        return False
+
+    def report_failure(self, embed_model: str, error: Exception):
+        """
+        实际调用嵌入模型失败时将模型标记为不可用。非嵌入模型错误（见 is_embed_error）不影响模型状态
+        """
+        if not self.is_embed_error(error):
+            return
+        msg = f"failed to access embed model '{embed_model}': {error}"
+        with self._lock:
+            state = self._states.setdefault(embed_model, {"failures": 0})
+            # checked_at 置 0，使下次检查立即重新探测，而不是直接熔断
+            state.update(
+                healthy=False,
+                msg=msg,
+                checked_at=0,
+                refreshing=False,
+                failures=state["failures"] + 1,
+            )
+
+    def states(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                k: {
+                    "healthy": v["healthy"],
+                    "msg": v["msg"],
+                    "checked_at": v["checked_at"],
+                    "failures": v["failures"],
+                }
+                for k, v in self._states.items()
+            }
+
+
+embed_model_health = EmbedModelHealthRegistry()
+
+
+def check_embed_model(embed_model: str = None, use_cache: bool = True) -> Tuple[bool, str]:
     '''
     check weather embed_model accessable, use default embed model if None
+    result is cached by embed_model_health, set use_cache=False to force a real request
     '''
     embed_model = embed_model or get_default_embedding()
-    embeddings = get_Embeddings(embed_model=embed_model)
-    try:
-        embeddings.embed_query("this is a test")
-        return True, ""
-    except Exception as e:
-        msg = f"failed to access embed model '{embed_model}': {e}"
-        logger.error(msg)
-        return False, msg
+    return embed_model_health.check(embed_model, use_cache=use_cache)
 
 
 # def get_OpenAIClient(
@@ -384,6 +558,27 @@ class ListResponse(BaseResponse):
         }
 
 
+def get_embed_model_health() -> BaseResponse:
+    """
+    获取各嵌入模型的可用性状态
+    """
+    return BaseResponse(data=embed_model_health.states())
+
+
+def get_embedding_cache_stats() -> BaseResponse:
+    """
+    获取嵌入向量缓存与查询向量缓存的命中统计
+    """
+    from chatchat.server.embedding_cache import get_embedding_store, get_query_embedding_cache
+
+    store = get_embedding_store()
+    query_cache = get_query_embedding_cache()
+    return BaseResponse(data={
+        "embedding_cache": store.stats() if store is not None else None,
+        "query_embedding_cache": query_cache.stats() if query_cache is not None else None,
+    })
+
+
 # class ChatMessage(BaseModel):
 #     question: str = Field(..., description="Question text")
 #     response: str = Field(..., description="Response text")
@@ -711,44 +906,142 @@ def get_server_configs() -> Dict:
 
 
 # 动态更新知识库信息
-def update_search_local_knowledgebase_tool():
+def update_search_local_knowledgebase_tool(tools: Dict[str, BaseTool]) -> Dict[str, BaseTool]:
+    """
+    用数据库中的知识库列表更新 search_local_knowledgebase 工具的描述.
+    修改的是工具的副本, 不影响注册表中的原始工具对象.
+    """
     import re
 
-    from chatchat.server.agent.tools_factory import tools_registry
     from chatchat.server.db.repository.knowledge_base_repository import list_kbs_from_db
 
+    tools = dict(tools)
+
     kbs = list_kbs_from_db()
     template = "Use local knowledgebase from one or more of these:\n{KB_info}\n to get information，Only local data on this knowledge use this tool. The 'database' should be one of the above [{key}]."
     KB_info_str = "\n".join([f"{kb.kb_name}: {kb.kb_info}" for kb in kbs])
     KB_name_info_str = "\n".join([f"{kb.kb_name}" for kb in kbs])
     template_knowledge = template.format(KB_info=KB_info_str, key=KB_name_info_str)
 
-    search_local_knowledgebase_tool = tools_registry._TOOLS_REGISTRY.get(
-        "search_local_knowledgebase"
-    )
+    search_local_knowledgebase_tool = tools.get("search_local_knowledgebase")
     if search_local_knowledgebase_tool:
+        search_local_knowledgebase_tool = search_local_knowledgebase_tool.model_copy()
+        tools["search_local_knowledgebase"] = search_local_knowledgebase_tool
         search_local_knowledgebase_tool.description = " ".join(
             re.split(r"\n+\s*", template_knowledge)
         )
         search_local_knowledgebase_tool.args["database"]["choices"] = [
             kb.kb_name for kb in kbs
         ]
+    return tools
 
 
-def get_tool(name: str = None) -> Union[BaseTool, Dict[str, BaseTool]]:
-    import importlib
+class KBListWatcher:
+    """
+    发现其它进程（webui、知识库任务、init_database 等）对知识库列表的修改：
+    每隔 KB_LIST_CHECK_INTERVAL 秒比较一次数据库中的知识库签名，与上次的签名不同时 check 返回 True.
+    每个使用方各自持有一个实例
+    """
 
-    from chatchat.server.agent import tools_factory
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._checked_at = None
 
-    importlib.reload(tools_factory)
+    def _due(self) -> bool:
+        interval = Settings.kb_settings.KB_LIST_CHECK_INTERVAL
+        return self._checked_at is None or time.monotonic() - self._checked_at >= interval
+
+    def check(self) -> bool:
+        from chatchat.server.db.repository.knowledge_base_repository import get_kbs_signature
+
+        if not self._due():
+            return False
+        with self._lock:
+            if not self._due():
+                return False
+            self._checked_at = time.monotonic()
+            try:
+                signature = get_kbs_signature()
+            except Exception as e:
+                logger.warning(f"检查知识库列表失败: {e}")
+                return False
+            changed = self._signature is not None and signature != self._signature
+            self._signature = signature
+            return changed
 
-    from chatchat.server.agent.tools_factory import tools_registry
 
-    update_search_local_knowledgebase_tool()
+class ToolsSnapshotRegistry:
+    """
+    工具注册表的只读快照.
+    工具模块只在首次使用时导入一次; 知识库列表变化 (新建、删除、修改介绍) 或配置文件修改后,
+    递增 generation, 下次获取时重新生成快照. 快照生成后不再修改, 并发请求可以安全共用.
+    本进程内的修改通过 refresh 立即生效; 其它进程的修改由 KBListWatcher 定期检查发现.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._key = None
+        self._tools: Mapping[str, BaseTool] = MappingProxyType({})
+        self._kb_watcher = KBListWatcher()
+
+    @property
+    def generation(self) -> int:
+        self._check_kbs()
+        return self._generation
+
+    def refresh(self):
+        """
+        标记快照过期, 下次获取工具时重新生成
+        """
+        with self._lock:
+            self._generation += 1
+
+    def _check_kbs(self):
+        if self._kb_watcher.check():
+            logger.debug("知识库列表已被修改, 工具快照将重新生成")
+            self.refresh()
+
+    def snapshot(self) -> Mapping[str, BaseTool]:
+        self._check_kbs()
+        key = (self._generation, Settings.version())
+        if self._key == key:
+            return self._tools
+        with self._lock:
+            key = (self._generation, Settings.version())
+            if self._key != key:
+                # 导入 tools_factory 时各工具模块通过 regist_tool 完成注册
+                from chatchat.server.agent import tools_factory  # noqa: F401
+                from chatchat.server.agent.tools_factory import tools_registry
+
+                tools = update_search_local_knowledgebase_tool(tools_registry._TOOLS_REGISTRY)
+                self._tools = MappingProxyType(tools)
+                self._key = key
+                logger.debug(f"已生成工具快照, generation={key[0]}")
+            return self._tools
+
+
+tools_snapshot_registry = ToolsSnapshotRegistry()
+
+
+def refresh_tools():
+    """
+    知识库列表等工具依赖的信息变化后调用, 使工具快照失效
+    """
+    tools_snapshot_registry.refresh()
+
+
+def get_tools_generation() -> int:
+    return tools_snapshot_registry.generation
+
+
+def get_tool(name: str = None) -> Union[BaseTool, Mapping[str, BaseTool]]:
+    tools = tools_snapshot_registry.snapshot()
     if name is None:
-        return tools_registry._TOOLS_REGISTRY
+        return tools
     else:
-        return tools_registry._TOOLS_REGISTRY.get(name)
+        return tools.get(name)
 
 
 def list_tools():
@@ -860,3 +1153,10 @@ if __name__ == "__main__":
     platforms = get_config_platforms()
     models = get_config_models()
     model_info = get_model_info(platform_name="xinference-auto")
+
+    # 模型配置按版本缓存：修改 model_settings.yaml 后 misses 增加，结果随之更新
+    start = time.perf_counter()
+    for _ in range(1000):
+        get_model_info(get_default_llm())
+    print(f"get_model_info: {(time.perf_counter() - start):.3f}ms per call")
+    print(_get_config_models.cache_info())
@@ -42,9 +42,26 @@ logger = build_logger()
 def _set_app_event(app: FastAPI, started_event: mp.Event = None):
     @asynccontextmanager
     async def lifespan(app: FastAPI):
+        from chatchat.server.agent.checkpointer import checkpointer_manager
+        from chatchat.server.knowledge_base.kb_jobs import watch_kb_jobs
+
+        # 对话历史的 checkpointer (及 postgres 连接池) 在启动时创建一次，所有请求共用。
+        # 创建失败（如数据库暂时无法连接）时不影响服务启动，在首次对话时重试
+        try:
+            await checkpointer_manager.start()
+        except Exception:
+            logger.warning("checkpointer 创建失败，将在首次对话时重试")
+        # 后台任务在 worker 进程中修改向量库，任务结束后丢弃本进程中的旧缓存
+        kb_jobs_watcher = asyncio.create_task(watch_kb_jobs())
         if started_event is not None:
             started_event.set()
         yield
+        kb_jobs_watcher.cancel()
+        await checkpointer_manager.close()
+        # 退出前保存尚未写入磁盘的向量库
+        from chatchat.server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool
+
+        kb_faiss_pool.flush_all()
 
     app.router.lifespan_context = lifespan
 
@@ -82,6 +99,24 @@ def run_api_server(
     uvicorn.run(app, host=host, port=port)
 
 
+def run_kb_worker(index: int = 0):
+    from chatchat.settings import Settings
+    from chatchat.server.knowledge_base.kb_jobs import run_kb_job_worker
+    from chatchat.server.utils import set_httpx_config
+    from chatchat.utils import get_config_dict, get_log_file, get_timestamp_ms
+
+    set_httpx_config()
+    logging_conf = get_config_dict(
+        "INFO",
+        get_log_file(log_path=Settings.basic_settings.LOG_PATH, sub_dir=f"run_kb_job_worker_{get_timestamp_ms()}"),
+        1024 * 1024 * 1024 * 3,
+        1024 * 1024 * 1024 * 3,
+    )
+    logging.config.dictConfig(logging_conf)  # type: ignore
+
+    run_kb_job_worker(index)
+
+
 def run_webui(
     started_event: mp.Event = None, run_mode: str = None
 ):
@@ -286,6 +321,15 @@ async def start_main_server(args):
         )
         processes["api"] = process
 
+        for i in range(Settings.kb_settings.KB_JOB_WORKERS):
+            process = Process(
+                target=run_kb_worker,
+                name=f"KB Job Worker {i}",
+                kwargs=dict(index=i),
+                daemon=False,
+            )
+            processes[f"kb_job_worker_{i}"] = process
+
     webui_started = manager.Event()
     if args.webui:
         process = Process(
@@ -305,6 +349,11 @@ async def start_main_server(args):
             p.name = f"{p.name} ({p.pid})"
             api_started.wait()  # 等待api.py启动完成
 
+        for name, p in processes.items():
+            if name.startswith("kb_job_worker_"):
+                p.start()
+                p.name = f"{p.name} ({p.pid})"
+
         if p := processes.get("webui"):
             p.start()
             p.name = f"{p.name} ({p.pid})"
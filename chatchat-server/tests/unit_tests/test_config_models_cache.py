@@ -0,0 +1,74 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import pytest
+import yaml
+
+# CHATCHAT_ROOT 在导入 chatchat.settings 时读取，需要在导入之前设置
+os.environ.setdefault("CHATCHAT_ROOT", tempfile.mkdtemp(prefix="chatchat_test_"))
+
+from chatchat.settings import ApiModelSettings  # noqa: E402
+from chatchat.server.utils import (  # noqa: E402
+    get_config_models,
+    get_default_embedding,
+    get_default_llm,
+)
+
+
+def write_model_settings(
+    file: Path,
+    llm_models: List[str],
+    embed_models: List[str],
+    default_llm: str,
+    mtime: float,
+):
+    data = {
+        "DEFAULT_LLM_MODEL": default_llm,
+        "DEFAULT_EMBEDDING_MODEL": embed_models[0],
+        "MODEL_PLATFORMS": [
+            {
+                "platform_name": "test",
+                "platform_type": "openai",
+                "api_base_url": "http://127.0.0.1:9997/v1",
+                "api_key": "EMPTY",
+                "auto_detect_model": False,
+                "llm_models": llm_models,
+                "embed_models": embed_models,
+            }
+        ],
+    }
+    file.write_text(yaml.safe_dump(data), encoding="utf-8")
+    # 配置按文件修改时间（秒）重新加载，显式设置不同的修改时间
+    os.utime(file, (mtime, mtime))
+
+
+@pytest.fixture
+def model_settings_file(tmp_path, monkeypatch):
+    file = tmp_path / "model_settings.yaml"
+    monkeypatch.setenv("CHATCHAT_ROOT", str(tmp_path))
+    monkeypatch.setitem(ApiModelSettings.model_config, "yaml_file", file)
+    return file
+
+
+def test_config_models_refresh_after_yaml_change(model_settings_file):
+    now = time.time()
+    write_model_settings(model_settings_file, ["llm-a"], ["embed-a"], "llm-a", now - 100)
+    assert set(get_config_models(model_type="llm")) == {"llm-a"}
+    assert get_default_llm() == "llm-a"
+    assert get_default_embedding() == "embed-a"
+
+    write_model_settings(model_settings_file, ["llm-b", "llm-c"], ["embed-b"], "llm-c", now)
+    assert set(get_config_models(model_type="llm")) == {"llm-b", "llm-c"}
+    assert get_default_llm() == "llm-c"
+    assert get_default_embedding() == "embed-b"
+
+
+def test_config_models_returns_copies(model_settings_file):
+    write_model_settings(model_settings_file, ["llm-a"], ["embed-a"], "llm-a", time.time())
+    models = get_config_models(model_type="llm")
+    models["llm-a"]["api_key"] = "changed"
+    models.pop("llm-a")
+    assert get_config_models(model_type="llm")["llm-a"]["api_key"] == "EMPTY"